@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+
+# Each scenario is (records in Knackly, how many of them already have a document, whether those documents are outdated).
+SCENARIOS = {
+    "new-10k": (10_000, 0, False),
+    "stale-100k": (100_000, 100_000, True),
+    "current-100k": (100_000, 100_000, False),
+}
+
+# The benchmarks wipe the collections they use, so they only ever run against this database.
+BENCHMARK_DATABASE = "double_checker_benchmark"
+
+# How long a whole main.py process with nothing to reconcile may take, cold or warm, before the benchmark fails.
+# The interpreter and imports take about 0.4s of it, and a cold start's login and catalog listing against the fake Knackly about 0.05s.
+DEFAULT_STARTUP_BUDGET = 2.5
+
+# Set on the processes that run a single scenario for `--scenario all`.
+CHILD_ENV = "DOUBLE_CHECKER_BENCHMARK_CHILD"
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the benchmark settings
+    """
+    parser = argparse.ArgumentParser(
+        description="Runs main.main() end to end against a fake Knackly server and a local MongoDB, and reports records/s, per-call latency and peak memory."
+    )
+    parser.add_argument(
+        "--scenario",
+        choices=[*SCENARIOS, "startup", "all"],
+        default="all",
+        help="which scenario to run. `startup` times whole main.py processes that have nothing to reconcile. Defaults to all of them",
+    )
+    parser.add_argument("--records", type=int, help="overrides how many records the scenario has")
+    parser.add_argument("--catalogs", type=int, default=10, help="how many catalogs the records are spread over. Defaults to 10")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds the fake Knackly adds to every response. Defaults to 0.01")
+    parser.add_argument("--jitter", type=float, default=0.01, help="up to this many more seconds are added at random. Defaults to 0.01")
+    parser.add_argument("--rate-limit", type=float, help="the fake Knackly's requests-per-second limit. Defaults to no limit")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the fraction of requests that get a random 429 or 503. Defaults to 0")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017", help="the local MongoDB to use. Defaults to mongodb://localhost:27017")
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=DEFAULT_STARTUP_BUDGET,
+        help=f"fail (exit code 1) if a cold or warm start of main.py takes longer than this many seconds. 0 turns the check off. Defaults to {DEFAULT_STARTUP_BUDGET}",
+    )
+    parser.add_argument("--json", help="also write the results to this file, one JSON object per line")
+    parser.add_argument("main_args", nargs=argparse.REMAINDER, help="anything after `--` is passed on to main.py, such as `-- --workers 16 --requests-per-second 200`")
+    args = parser.parse_args()
+    if args.main_args and args.main_args[0] == "--":
+        args.main_args = args.main_args[1:]
+    if args.startup_budget < 0:
+        parser.error(f"--startup-budget can't be negative. received: {args.startup_budget}")
+    if urlparse(args.mongo_uri).hostname not in ("localhost", "127.0.0.1", "::1"):
+        parser.error(f"the benchmarks wipe their collections, so --mongo-uri has to point at a local MongoDB. received: {args.mongo_uri}")
+    return args
+
+
+def peak_rss_mb() -> float:
+    """The peak resident memory of this process in MB, or None where the `resource` module isn't available (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS reports bytes.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class CallTimer:
+    """Times every HTTP request that this process sends, grouped by the kind of Knackly call."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def install(self) -> None:
+        original = requests.Session.request
+        timer = self
+
+        def timed_request(session, method, url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(session, method, url, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                path = urlparse(url).path
+                kind = "login" if path.endswith("/auth/login") else "catalogs" if path.endswith("/catalogs") else "list" if path.endswith("/items") else "detail"
+                with timer.lock:
+                    timer.latencies.setdefault(kind, []).append(elapsed)
+
+        requests.Session.request = timed_request
+
+
+def seed_mongo(db, catalogs: dict[str, list[dict]], count: int, outdated: bool) -> None:
+    """Writes documents for the first `count` records, either as they are in Knackly or as an older version of them."""
+    from fake_knackly import make_record
+    from mongo_db import format_document
+
+    collection = db["real_Records"]
+    batch = []
+    seeded = 0
+    for name, records in catalogs.items():
+        for i, record in enumerate(records):
+            if seeded >= count:
+                break
+            seeded += 1
+            if outdated:
+                modified = datetime.fromisoformat(record["lastModified"].replace("Z", "+00:00")) - timedelta(days=1)
+                record = make_record(name, i, modified, version=0)
+            batch.append(format_document(dict(record), name))
+            if len(batch) >= 5000:
+                collection.insert_many(batch, ordered=False)
+                batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> dict:
+    """Runs one scenario in this process: starts a fake Knackly, prepares the benchmark database, and runs main.main() against them."""
+    from pymongo import MongoClient
+
+    from fake_knackly import FakeKnackly, make_catalogs
+    from mongo_db import HISTORY_COLLECTION
+    from watermarks import STATE_COLLECTION
+
+    total, existing, outdated = SCENARIOS[name]
+    total = args.records or total
+    existing = min(existing, total)
+    per_catalog = max(1, total // args.catalogs)
+    catalogs = make_catalogs(args.catalogs, per_catalog, days=2)
+
+    db = MongoClient(args.mongo_uri)[BENCHMARK_DATABASE]
+    for collection in ("real_Records", HISTORY_COLLECTION, STATE_COLLECTION):
+        db.drop_collection(collection)
+    seed_mongo(db, catalogs, existing, outdated)
+
+    fake = FakeKnackly(catalogs, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, error_rate=args.error_rate)
+    os.environ.update(
+        {
+            "KNACKLY_BASE_URL": fake.start(),
+            "KEY": "benchmark",
+            "SECRET": "benchmark",
+            "TENANCY": fake.tenancy,
+            "MONGO_URI": args.mongo_uri,
+            "MONGO_DATABASE": BENCHMARK_DATABASE,
+        }
+    )
+
+    import main
+
+    timer = CallTimer()
+    timer.install()
+    # The fake Knackly's catalogs live in this process too, so the job's own memory is the growth past this point.
+    baseline = peak_rss_mb()
+    start_date = (datetime.now(tz=UTC) - timedelta(days=3)).strftime("%Y-%m-%d")
+    # The job runs in a temporary directory, like `measure_startup`'s do, so that its logs, metrics and startup cache don't overwrite the real ones.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            sys.argv = ["main.py", "--date", start_date, "--no-explain", *args.main_args]
+            start_time = time.perf_counter()
+            main.main(main.parse_arguments())
+            elapsed = time.perf_counter() - start_time
+        finally:
+            os.chdir(cwd)
+            fake.stop()
+
+    records = per_catalog * args.catalogs
+    peak = peak_rss_mb()
+    result = {
+        "scenario": name,
+        "records": records,
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(records / elapsed, 1),
+        "peak_rss_mb": round(peak, 1) if peak is not None else None,
+        "job_rss_growth_mb": round(peak - baseline, 1) if peak is not None else None,
+        "documents": db["real_Records"].count_documents({}),
+        "server_calls": fake.calls,
+        "latency_ms": {
+            kind: {
+                "calls": len(values),
+                "p50": round(1000 * percentile(values, 0.5), 2),
+                "p99": round(1000 * percentile(values, 0.99), 2),
+            }
+            for kind, values in sorted(timer.latencies.items())
+        },
+    }
+    return result
+
+
+def measure_startup(args: argparse.Namespace) -> dict:
+    """Times whole main.py processes against a fake Knackly with nothing to reconcile, so that all that is left is what it costs to start
+    (the interpreter and imports, logging in, listing the catalogs and connecting to MongoDB) and to finish.
+    The cold start has no startup cache, and the warm start reuses the one that the cold start wrote."""
+    from fake_knackly import FakeKnackly, make_catalogs
+    from metrics import find
+
+    fake = FakeKnackly(make_catalogs(args.catalogs, 0), latency=args.latency, jitter=args.jitter)
+    env = {
+        **os.environ,
+        "KNACKLY_BASE_URL": fake.start(),
+        "KEY": "benchmark",
+        "SECRET": "benchmark",
+        "TENANCY": fake.tenancy,
+        "MONGO_URI": args.mongo_uri,
+        "MONGO_DATABASE": BENCHMARK_DATABASE,
+    }
+    start_date = (datetime.now(tz=UTC) - timedelta(days=3)).strftime("%Y-%m-%d")
+    result = {"scenario": "startup"}
+    # The runs happen in a temporary directory, so that their logs, metrics and startup cache don't mix with the real ones.
+    with tempfile.TemporaryDirectory() as directory:
+        for run in ("cold", "warm"):
+            calls_before = dict(fake.calls)
+            metrics_path = os.path.join(directory, f"{run}.json")
+            command = [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                *("--date", start_date, "--no-explain", "--metrics-json", metrics_path),
+                *args.main_args,
+            ]
+            start_time = time.perf_counter()
+            output = subprocess.run(command, capture_output=True, text=True, env=env, cwd=directory)
+            elapsed = time.perf_counter() - start_time
+            if output.returncode != 0:
+                raise RuntimeError(f"the {run} start of main.py failed:\n{output.stderr[-2000:]}")
+            with open(metrics_path, encoding="utf-8") as f:
+                startup = find(json.load(f), "counters", "phase_seconds", phase="startup")
+            result[run] = {
+                "process_seconds": round(elapsed, 3),
+                "startup_seconds": round(startup[0]["value"], 3) if startup else None,
+                "server_calls": {k: v - calls_before.get(k, 0) for k, v in fake.calls.items() if v != calls_before.get(k, 0)},
+            }
+    fake.stop()
+    return result
+
+
+def print_startup(result: dict) -> None:
+    print("\n== startup ==")
+    for run in ("cold", "warm"):
+        stats = result[run]
+        print(f"  {run}: {stats['process_seconds']}s for the whole process, {stats['startup_seconds']}s inside main() | server calls {stats['server_calls']}")
+
+
+def print_result(result: dict) -> None:
+    if result["scenario"] == "startup":
+        print_startup(result)
+        return
+    print(f"\n== {result['scenario']} ==")
+    print(
+        f"{result['records']} records in {result['seconds']}s = {result['records_per_second']} records/s | "
+        f"peak RSS {result['peak_rss_mb']} MB (+{result['job_rss_growth_mb']} MB during the run) | {result['documents']} documents in MongoDB afterwards"
+    )
+    for kind, stats in result["latency_ms"].items():
+        print(f"  {kind.ljust(10)} {str(stats['calls']).rjust(8)} calls | p50 {stats['p50']}ms | p99 {stats['p99']}ms")
+    print(f"  server responses: {result['server_calls']}")
+
+
+def write_json(path: str, results: list[dict]) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps({"run_at": datetime.now(tz=UTC).isoformat(), **result}) + "\n")
+
+
+def check_startup_budget(results: list[dict], budget: float) -> bool:
+    """Whether both the cold and the warm start stayed within the budget. A budget of 0 always passes."""
+    within = True
+    for result in results:
+        if not budget or result["scenario"] != "startup":
+            continue
+        for run in ("cold", "warm"):
+            seconds = result[run]["process_seconds"]
+            print(f"{run.capitalize()} start: {seconds}s of a {budget}s budget.")
+            if seconds > budget:
+                print(f"\nA {run} start took {seconds}s, which is over the {budget}s budget.")
+                within = False
+    return within
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.scenario == "startup":
+        result = measure_startup(args)
+        print_result(result)
+        if args.json:
+            write_json(args.json, [result])
+        sys.exit(0 if check_startup_budget([result], args.startup_budget) else 1)
+
+    if args.scenario != "all":
+        result = run_scenario(args.scenario, args)
+        if os.getenv(CHILD_ENV):
+            # Hand the result back to the parent process, which prints and saves every scenario together.
+            print(f"BENCHMARK_RESULT {json.dumps(result)}")
+            return
+        print_result(result)
+        if args.json:
+            write_json(args.json, [result])
+        return
+
+    # Each scenario runs in its own process, so that peak memory is measured per scenario.
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    results = []
+    for name in SCENARIOS:
+        command = [sys.executable, __file__, *argv[:split], "--scenario", name, *argv[split:]]
+        output = subprocess.run(command, capture_output=True, text=True, env={**os.environ, CHILD_ENV: "1"})
+        lines = [line for line in output.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+        if output.returncode != 0 or not lines:
+            print(f"The {name} scenario failed:\n{output.stderr[-2000:]}")
+            continue
+        results.append(json.loads(lines[-1].removeprefix("BENCHMARK_RESULT ")))
+    results.append(measure_startup(args))
+
+    for result in results:
+        print_result(result)
+    if args.json:
+        write_json(args.json, results)
+    if not check_startup_budget(results, args.startup_budget):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
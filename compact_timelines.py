@@ -0,0 +1,112 @@
+import argparse
+import time
+
+import bson
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from tqdm import tqdm
+
+from logger import initialize_logger
+from mongo_db import get_database
+from timeline import encode_timeline
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the compaction settings
+    """
+    parser = argparse.ArgumentParser(description="Rewrites the timelines of existing real_Records documents into the delta encoded format.")
+    parser.add_argument("--batch-size", type=int, default=100, help="how many documents to rewrite per bulk write. Defaults to 100")
+    parser.add_argument("--snapshot-interval", type=int, default=10, help="how many timeline entries there are per full snapshot. Defaults to 10")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many documents. Defaults to 0, meaning no limit")
+    parser.add_argument("--dry-run", action="store_true", help="report how many bytes would be saved without writing anything")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error(f"--batch-size must be at least 1. received: {args.batch_size}")
+    if args.snapshot_interval < 1:
+        parser.error(f"--snapshot-interval must be at least 1. received: {args.snapshot_interval}")
+    return args
+
+
+def compact_timelines(col: Collection, batch_size: int, snapshot_interval: int, limit: int = 0, dry_run: bool = False) -> dict:
+    """Rewrites every document that isn't in the delta format yet, in place.
+
+    The compaction can be stopped and started again at any time, because converted documents are marked with `timeline_format: "delta"`
+    and skipped. Each rewrite only applies if the timeline still has the length it was read with, so an entry pushed by a running job
+    in the meantime is never lost (that document is just picked up again next time).
+
+    Args:
+        col (Collection): The pymongo collection object
+        batch_size (int): How many documents to rewrite per bulk write
+        snapshot_interval (int): How many timeline entries there are per full snapshot
+        limit (int, optional): Stop after this many documents. Defaults to 0, meaning no limit.
+        dry_run (bool, optional): Only measure, don't write anything. Defaults to False.
+
+    Returns:
+        dict: Counts of the documents that were examined and rewritten, and the timeline bytes before and after.
+    """
+    stats = {"documents": 0, "rewritten": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    # Documents that keep their timeline in the history collection don't have one to compact.
+    query = {"timeline_format": {"$ne": "delta"}, "history": {"$exists": False}}
+    cursor = col.find(query, projection={"timeline": 1}, batch_size=batch_size).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    operations = []
+    for document in tqdm(cursor, unit=" documents"):
+        stats["documents"] += 1
+        timeline = document.get("timeline", [])
+        try:
+            encoded = encode_timeline(timeline, snapshot_interval)
+        except ValueError:
+            stats["skipped"] += 1
+            continue
+        stats["bytes_before"] += len(bson.encode({"timeline": timeline}))
+        stats["bytes_after"] += len(bson.encode({"timeline": encoded}))
+        operations.append(
+            UpdateOne(
+                {"_id": document["_id"], "timeline": {"$size": len(timeline)}},
+                {"$set": {"timeline": encoded, "timeline_format": "delta"}},
+            )
+        )
+        if len(operations) >= batch_size:
+            stats["rewritten"] += 0 if dry_run else col.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations and not dry_run:
+        stats["rewritten"] += col.bulk_write(operations, ordered=False).modified_count
+    return stats
+
+
+def main(args: argparse.Namespace):
+    log = initialize_logger()
+    load_dotenv()
+    collection = get_database()["real_Records"]
+
+    start_time = time.monotonic()
+    stats = compact_timelines(
+        col=collection,
+        batch_size=args.batch_size,
+        snapshot_interval=args.snapshot_interval,
+        limit=args.limit,
+        dry_run=args.dry_run,
+    )
+    elapsed = time.monotonic() - start_time
+
+    def report(message: str) -> None:
+        print(message)
+        log.info(message)
+
+    saved = stats["bytes_before"] - stats["bytes_after"]
+    percent = (100 * saved / stats["bytes_before"]) if stats["bytes_before"] else 0
+    report(f"Examined {stats['documents']} documents and rewrote {stats['rewritten']} of them in {elapsed:.1f}s ({stats['documents'] / max(elapsed, 1e-9):.1f} documents/s).")
+    report(f"{stats['skipped']} documents were skipped because their timeline couldn't be rebuilt.")
+    report(f"Timelines went from {stats['bytes_before']} to {stats['bytes_after']} bytes, saving {saved} bytes ({percent:.1f}%).")
+    if args.dry_run:
+        report("This was a dry run, so nothing was written.")
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
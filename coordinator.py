@@ -0,0 +1,74 @@
+import argparse
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from leases import COORDINATION_COLLECTION, merge_summaries, outstanding_catalogs
+from logger import initialize_logger
+from mongo_db import get_database
+from notify_teams import send_teams_message
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the coordinator settings
+    """
+    parser = argparse.ArgumentParser(description="Merges the summaries of every worker in a distributed run, and sends the totals to Teams.")
+    parser.add_argument("--run-id", required=True, help="the run to merge, as given to main.py --run-id")
+    parser.add_argument("--wait", type=int, default=0, help="how many seconds to wait for every catalog in the run to be done before merging. Defaults to 0")
+    parser.add_argument("--poll-interval", type=int, default=15, help="how many seconds to wait between checks while waiting. Defaults to 15")
+    parser.add_argument("--no-notify", action="store_true", help="only print the merged totals, without sending them to Teams")
+    args = parser.parse_args()
+    if args.wait < 0:
+        parser.error(f"--wait can't be negative. received: {args.wait}")
+    if args.poll_interval < 1:
+        parser.error(f"--poll-interval must be at least 1. received: {args.poll_interval}")
+    return args
+
+
+def summary_message(summary: dict) -> str:
+    """Turns merged summaries into the message for Teams."""
+    counts = summary["counts"]
+    lines = [
+        f"{len(summary['workers'])} workers reconciled {summary['catalogs']} catalogs.",
+        f"{counts.get('new', 0)} id's found in Knackly that didn't exist in MongoDB, and {counts.get('inserted', 0)} of them were inserted.",
+        f"{counts.get('modified', 0)} out of the {counts.get('matching', 0)} matching documents were replaced with their latest versions.",
+        f"{counts.get('unchanged', 0)} outdated documents had no meaningful changes ({counts.get('bytes_avoided', 0)} bytes of timeline writes avoided).",
+    ]
+    if summary["errors"]:
+        lines.append(f"{summary['errors']} records couldn't be fetched, formatted or written to MongoDB.")
+    if summary["failed"]:
+        lines.append(f"These workers failed: {', '.join(summary['failed'])}.")
+    if summary["outstanding"]:
+        lines.append(f"These catalogs were never finished: {', '.join(summary['outstanding'])}.")
+    return "\n\n".join(lines)
+
+
+def main(args: argparse.Namespace) -> bool:
+    log = initialize_logger()
+    load_dotenv()
+    col = get_database()[COORDINATION_COLLECTION]
+
+    deadline = time.monotonic() + args.wait
+    while outstanding_catalogs(col, args.run_id) and time.monotonic() < deadline:
+        time.sleep(args.poll_interval)
+
+    summary = merge_summaries(col, args.run_id)
+    success = bool(summary["workers"]) and not (summary["errors"] or summary["failed"] or summary["outstanding"])
+    message = summary_message(summary) if summary["workers"] else f"No worker wrote a summary for run {args.run_id}."
+    title = f"[{args.run_id}] ETL {'Succeeded' if success else 'FAILED'}"
+    print(title)
+    print(message)
+    log.info(f"{title}: {message}")
+
+    if not args.no_notify:
+        send_teams_message(os.getenv("TEAMS_WEBHOOK_URL"), title, message, success)
+    return success
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(parse_arguments()) else 1)
@@ -0,0 +1,154 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class QueuedEvent:
+    """A record that has had at least one webhook event since it was last applied."""
+
+    record_id: str
+    catalog: str
+    # The newest lastModified that any of the record's events carried, or None if none of them had one.
+    last_modified: str
+    # How many events were coalesced into this one.
+    hits: int
+    attempts: int
+    # Bumped by every new event, so that an event arriving while the record is being applied isn't acknowledged with it.
+    version: int
+
+
+class DurableEventQueue:
+    """A queue of webhook events in a local SQLite file, so that nothing that was accepted is lost if the daemon stops.
+
+    Events are coalesced per record: a record has at most one row, and repeat events only bump it. A row becomes due
+    `coalesce_seconds` after its latest event (but never later than `max_delay_seconds` after its first), so a burst of edits to
+    the same record is applied once. Claimed rows are leased rather than removed, and only deleted once they have been acknowledged.
+    """
+
+    def __init__(self, path: str, coalesce_seconds: float = 10.0, max_delay_seconds: float = 60.0, lease_seconds: float = 300.0):
+        """
+        Args:
+            path (str): The SQLite file to keep the queue in. Created if it doesn't exist.
+            coalesce_seconds (float, optional): How long to wait for more events for the same record. Defaults to 10.
+            max_delay_seconds (float, optional): The longest that a record which keeps getting events is held back. Defaults to 60.
+            lease_seconds (float, optional): How long a claimed row stays hidden before it is handed out again,
+                in case the daemon died while applying it. Defaults to 300.
+        """
+        self.coalesce_seconds = coalesce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                record_id TEXT PRIMARY KEY,
+                catalog TEXT NOT NULL,
+                last_modified TEXT,
+                first_seen REAL NOT NULL,
+                due REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 1,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 1,
+                leased_until REAL,
+                dead INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_due ON events (dead, due)")
+
+    def put(self, events: list[tuple[str, str, str]]) -> None:
+        """Adds events to the queue, coalescing them with any that are already waiting for the same record.
+        The events are on disk once this returns.
+
+        Args:
+            events (list[tuple[str, str, str]]): (record_id, catalog, last_modified) for every event. last_modified may be None.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(
+                    """
+                    INSERT INTO events (record_id, catalog, last_modified, first_seen, due) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (record_id) DO UPDATE SET
+                        catalog = excluded.catalog,
+                        last_modified = max(coalesce(last_modified, ''), coalesce(excluded.last_modified, '')),
+                        due = CASE WHEN dead THEN excluded.due ELSE min(excluded.due, first_seen + ?) END,
+                        first_seen = CASE WHEN dead THEN excluded.first_seen ELSE first_seen END,
+                        hits = hits + 1,
+                        version = version + 1,
+                        attempts = CASE WHEN dead THEN 0 ELSE attempts END,
+                        dead = 0
+                    """,
+                    [(record_id, catalog, last_modified, now, now + self.coalesce_seconds, self.max_delay_seconds) for record_id, catalog, last_modified in events],
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def claim(self, limit: int) -> list[QueuedEvent]:
+        """Leases up to `limit` rows that are due, oldest first."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    """
+                    SELECT record_id, catalog, nullif(last_modified, ''), hits, attempts, version FROM events
+                    WHERE dead = 0 AND due <= ? AND (leased_until IS NULL OR leased_until < ?)
+                    ORDER BY due LIMIT ?
+                    """,
+                    (now, now, limit),
+                ).fetchall()
+                self.db.executemany("UPDATE events SET leased_until = ? WHERE record_id = ?", [(now + self.lease_seconds, row[0]) for row in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [QueuedEvent(*row) for row in rows]
+
+    def ack(self, events: list[QueuedEvent]) -> None:
+        """Removes applied events. A record that got another event while it was being applied stays queued, and is applied again."""
+        with self.lock:
+            self.db.executemany("DELETE FROM events WHERE record_id = ? AND version = ?", [(e.record_id, e.version) for e in events])
+            self.db.executemany("UPDATE events SET leased_until = NULL WHERE record_id = ?", [(e.record_id,) for e in events])
+
+    def retry(self, events: list[QueuedEvent], error: str, max_attempts: int) -> int:
+        """Puts events that couldn't be applied back, to be tried again after an exponential backoff.
+        Events that have failed `max_attempts` times are set aside (until a new event for the same record arrives).
+
+        Returns:
+            int: How many of the events were set aside.
+        """
+        now = time.time()
+        dead = 0
+        with self.lock:
+            for e in events:
+                attempts = e.attempts + 1
+                if attempts >= max_attempts:
+                    dead += 1
+                self.db.execute(
+                    "UPDATE events SET attempts = ?, due = ?, leased_until = NULL, dead = ?, error = ? WHERE record_id = ?",
+                    (attempts, now + min(5 * 2**attempts, 3600), int(attempts >= max_attempts), error, e.record_id),
+                )
+        return dead
+
+    def depth(self) -> dict[str, int]:
+        """How many records are waiting, how many of those are due, and how many were set aside."""
+        now = time.time()
+        with self.lock:
+            waiting, due, dead = self.db.execute(
+                "SELECT coalesce(sum(dead = 0), 0), coalesce(sum(dead = 0 AND due <= ?), 0), coalesce(sum(dead), 0) FROM events", (now,)
+            ).fetchone()
+        return {"waiting": waiting, "due": due, "dead": dead}
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
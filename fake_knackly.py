@@ -0,0 +1,265 @@
+import argparse
+import bisect
+import json
+import random
+import secrets
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# The format that Knackly returns timestamps in.
+KNACKLY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def knackly_time(value: datetime) -> str:
+    return value.strftime(KNACKLY_TIME_FORMAT)[:-4] + "Z"
+
+
+def make_record(catalog: str, index: int, last_modified: datetime, version: int = 1) -> dict:
+    """Builds the details of a synthetic record, shaped like what `KnacklyAPI.get_record_details` returns."""
+    created = last_modified - timedelta(days=index % 30)
+    apps = [
+        {"name": f"App{(index + n) % 7}", "lastRun": knackly_time(last_modified - timedelta(minutes=n)), "status": "Ok"}
+        for n in range(1 + index % 3)
+    ]
+    return {
+        "id": f"{catalog}-{index:08d}",
+        "catalog": catalog,
+        "status": "Ok",
+        "created": knackly_time(created),
+        "lastModified": knackly_time(last_modified),
+        "apps": apps,
+        "data": {
+            "ClientName": f"Client {index % 997}",
+            "MatterNumber": f"M-{index:08d}",
+            "Amount": (index * 37) % 100_000,
+            "Version": version,
+            "isTestFile": index % 50 == 0,
+            "Parties": {"Borrower": f"Borrower {index}", "Lender": f"Lender {index % 13}"},
+        },
+    }
+
+
+def make_catalogs(catalog_count: int, records_per_catalog: int, days: float = 7, seed: int = 0, now: datetime = None) -> dict[str, list[dict]]:
+    """Builds synthetic catalogs whose records were last modified at random times over the last `days` days.
+
+    Returns:
+        dict[str, list[dict]]: A mapping of catalog name to the details of every record in it.
+    """
+    rng = random.Random(seed)
+    now = (now or datetime.now(tz=UTC)).replace(second=0, microsecond=0) - timedelta(minutes=1)
+    catalogs = {}
+    for c in range(catalog_count):
+        name = f"Catalog{c:03d}"
+        catalogs[name] = [make_record(name, i, now - timedelta(seconds=rng.uniform(0, days * 86400))) for i in range(records_per_catalog)]
+    return catalogs
+
+
+class FakeKnackly:
+    """A local HTTP server that speaks just enough of the Knackly API for the job to run against it:
+    `/auth/login`, `/catalogs`, `/catalogs/{catalog}/items` (with the `lastmod` filter and skip/limit) and `/catalogs/{catalog}/items/{id}`.
+
+    It can add latency to every response, enforce a requests-per-second limit with 429 responses,
+    and inject random 429/503 responses, to see how the job copes with a slow or unhappy Knackly.
+    """
+
+    def __init__(
+        self,
+        catalogs: dict[str, list[dict]],
+        tenancy: str = "benchmark",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit: float = None,
+        error_rate: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """
+        Args:
+            catalogs (dict[str, list[dict]]): The records to serve, as returned by `make_catalogs`.
+            tenancy (str, optional): The tenancy in the url path. Defaults to "benchmark".
+            latency (float, optional): Seconds added to every response. Defaults to 0.
+            jitter (float, optional): Up to this many more seconds are added at random. Defaults to 0.
+            rate_limit (float, optional): The most requests per second before answering 429. Defaults to None, meaning no limit.
+            error_rate (float, optional): The fraction of requests that get a random 429 or 503. Defaults to 0.
+            host (str, optional): The address to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 0, meaning any free port.
+        """
+        self.tenancy = tenancy
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.calls = {}
+
+        self.records = {}
+        self.by_catalog = {}
+        for name, records in catalogs.items():
+            ordered = sorted(records, key=lambda r: r["lastModified"])
+            # The minute each record was modified in, which is what the lastmod filter compares against.
+            self.by_catalog[name] = ([r["lastModified"][:16] for r in ordered], ordered)
+            for r in ordered:
+                self.records[(name, r["id"])] = r
+
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/{self.tenancy}/api/v1"
+
+    def start(self) -> str:
+        """Starts serving on a background thread, and returns the base url to give `KnacklyAPI`."""
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-knackly", daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, route: str, status: int) -> None:
+        with self.lock:
+            key = f"{route} {status}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def _throttled(self) -> bool:
+        """Whether this request goes over the requests-per-second limit (or was picked for a random error)."""
+        if self.error_rate and random.random() < self.error_rate:
+            return True
+        if self.rate_limit is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start, self.window_count = now, 0
+            self.window_count += 1
+            return self.window_count > self.rate_limit
+
+    def list_items(self, catalog: str, query: dict) -> list[dict]:
+        keys, ordered = self.by_catalog.get(catalog, ([], []))
+        lo, hi = 0, len(ordered)
+        if "f" in query:
+            lastmod = json.loads(query["f"][0]).get("lastmod", {})
+            # Knackly's lastmod filter works on whole minutes, and both ends of a range include their minute.
+            if lastmod.get("c") == "after":
+                lo = bisect.bisect_left(keys, lastmod["v"])
+            elif lastmod.get("c") == "before":
+                hi = bisect.bisect_left(keys, lastmod["v"])
+            elif lastmod.get("c") == "range":
+                lo = bisect.bisect_left(keys, lastmod["dateStart"])
+                hi = bisect.bisect_right(keys, lastmod["dateEnd"])
+        matches = ordered[lo:hi]
+        if "status" in query:
+            matches = [r for r in matches if r["status"] == query["status"][0]]
+        skip = int(query.get("skip", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])
+        return [{k: r[k] for k in ("id", "created", "lastModified", "status")} for r in matches[skip : skip + limit]]
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        fake = self
+        prefix = f"/{self.tenancy}/api/v1"
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out as separate writes, which Nagle's algorithm would hold back on a keep-alive connection.
+            disable_nagle_algorithm = True
+
+            def respond(self, route: str, status: int, body, headers: dict = None) -> None:
+                fake._count(route, status)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_request(self, method: str) -> None:
+                url = urlparse(self.path)
+                parts = url.path[len(prefix) :].strip("/").split("/") if url.path.startswith(prefix) else []
+                if method == "POST" and parts == ["auth", "login"]:
+                    route = "login"
+                elif method == "GET" and parts == ["catalogs"]:
+                    route = "catalogs"
+                elif method == "GET" and len(parts) == 3 and parts[0] == "catalogs" and parts[2] == "items":
+                    route = "list"
+                elif method == "GET" and len(parts) == 4 and parts[0] == "catalogs" and parts[2] == "items":
+                    route = "detail"
+                else:
+                    self.respond("unknown", 404, {"error": "not found"})
+                    return
+
+                if fake.latency or fake.jitter:
+                    time.sleep(fake.latency + random.uniform(0, fake.jitter))
+                if fake._throttled():
+                    if random.random() < 0.5:
+                        self.respond(route, 429, {"error": "too many requests"}, {"Retry-After": "1"})
+                    else:
+                        self.respond(route, 503, {"error": "service unavailable"})
+                    return
+
+                if route == "login":
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    token = secrets.token_hex(16)
+                    with fake.lock:
+                        fake.tokens.add(token)
+                    self.respond(route, 200, {"token": token})
+                    return
+                if self.headers.get("Authorization", "").removeprefix("Bearer ") not in fake.tokens:
+                    self.respond(route, 401, {"error": "unauthorized"})
+                    return
+
+                if route == "catalogs":
+                    self.respond(route, 200, [{"name": name} for name in fake.by_catalog])
+                elif route == "list":
+                    self.respond(route, 200, fake.list_items(parts[1], parse_qs(url.query)))
+                else:
+                    record = fake.records.get((parts[1], parts[3]))
+                    if record is None:
+                        self.respond(route, 404, {"error": "not found"})
+                    else:
+                        self.respond(route, 200, record)
+
+            def do_GET(self) -> None:
+                self.handle_request("GET")
+
+            def do_POST(self) -> None:
+                self.handle_request("POST")
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves synthetic catalogs through a fake Knackly API, for trying the job out locally.")
+    parser.add_argument("--port", type=int, default=8900, help="the port to listen on. Defaults to 8900")
+    parser.add_argument("--catalogs", type=int, default=5, help="how many catalogs to serve. Defaults to 5")
+    parser.add_argument("--records", type=int, default=1000, help="how many records each catalog has. Defaults to 1000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response. Defaults to 0")
+    parser.add_argument("--rate-limit", type=float, help="the most requests per second before answering 429. Defaults to no limit")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the fraction of requests that get a random 429 or 503. Defaults to 0")
+    args = parser.parse_args()
+    fake = FakeKnackly(
+        make_catalogs(args.catalogs, args.records),
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        port=args.port,
+    )
+    print(f"Serving {args.catalogs * args.records} records. Set KNACKLY_BASE_URL={fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,81 @@
+import queue
+import threading
+import time
+from collections.abc import Iterable
+
+from knackly_api import KnacklyAPI
+
+
+class DetailFetcher:
+    """Runs `KnacklyAPI.get_record_details` calls on a pool of worker threads.
+
+    The workers don't sleep between calls themselves. Pacing comes from the `TokenBucket` attached to the `KnacklyAPI` instance,
+    which is shared by every worker, so adding workers only helps up to the configured requests-per-second budget.
+    """
+
+    def __init__(self, knackly: KnacklyAPI, max_workers: int = 8):
+        """
+        Args:
+            knackly (KnacklyAPI): The (rate limited) Knackly API client that workers will use.
+            max_workers (int, optional): How many detail requests may be in flight at once. Defaults to 8.
+        """
+        self.knackly = knackly
+        self.max_workers = max_workers
+
+    def fetch_into(self, jobs: Iterable, results: queue.Queue, stop: threading.Event = None) -> None:
+        """Fetches the details for a (possibly endless) stream of jobs, putting each result onto `results` as soon as it arrives.
+        Each job only needs `record_id` and `catalog` attributes, plus `last_modified` for the details to be taken from the cache. Returns once `jobs` is exhausted and every request has finished.
+
+        Args:
+            jobs (Iterable): The jobs to fetch details for. Only `max_workers` jobs are read ahead of the finished ones.
+            results (queue.Queue): Receives a (job, record_details, error, seconds) tuple per job. `error` is None unless the request raised,
+                and `seconds` is how long the request took (including waiting for the rate limiter and any retries).
+            stop (threading.Event, optional): Once set, no more jobs are read or results put, and this returns as soon as the requests
+                in flight finish, even if nothing takes results off of `results` anymore. Defaults to None, which never stops early.
+        """
+        stop = stop or threading.Event()
+        pending = queue.Queue(maxsize=self.max_workers)
+        done = object()
+
+        def put(q: queue.Queue, item) -> bool:
+            """Puts an item onto a queue, unless `stop` is set first. Returns whether it was put."""
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: queue.Queue):
+            """Takes an item off of a queue, or returns `done` once `stop` is set."""
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+            return done
+
+        def worker() -> None:
+            while (job := get(pending)) is not done:
+                started = time.perf_counter()
+                try:
+                    record_details = self.knackly.get_record_details(job.record_id, job.catalog, getattr(job, "last_modified", None))
+                except Exception as e:
+                    put(results, (job, None, e, time.perf_counter() - started))
+                    continue
+                put(results, (job, record_details, None, time.perf_counter() - started))
+
+        threads = [threading.Thread(target=worker, name=f"knackly-fetch-{i}", daemon=True) for i in range(self.max_workers)]
+        for t in threads:
+            t.start()
+        try:
+            for job in jobs:
+                if not put(pending, job):
+                    break
+        finally:
+            # Once stopped, the workers give up on their own, so a full queue that nobody empties can't hang this.
+            for _ in threads:
+                put(pending, done)
+            for t in threads:
+                t.join()
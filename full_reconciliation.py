@@ -0,0 +1,175 @@
+import heapq
+import os
+import tempfile
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from datetime import UTC, datetime
+
+from pymongo.collection import Collection
+
+from knackly_api import KnacklyAPI, parse_knackly_datetime
+from pipeline import STALE_TOLERANCE
+
+# A full listing starts here, which is before any Knackly record was modified.
+FULL_LISTING_START = datetime(2000, 1, 1, tzinfo=UTC)
+
+# The index that the MongoDB side of the diff is read in order of. `ensure_indexes` creates it, and it covers the projection.
+RECORD_ID_INDEX = [("record_id", 1), ("internally_modified", 1)]
+
+MISSING = "missing"
+STALE = "stale"
+ORPHANED = "orphaned"
+
+
+def iter_knackly_ids(knackly: KnacklyAPI, catalogs: list[str], page_size: int = 1000, max_concurrent_pages: int = 4) -> Iterator[tuple]:
+    """Streams the id of every record in every catalog, whatever its status or age.
+
+    Yields:
+        tuple: (record_id, catalog, lastModified, status, created) for every listed record. Fields that Knackly left out are "".
+    """
+    for catalog in catalogs:
+        pages = knackly.iter_records_in_catalog(catalog=catalog, start=FULL_LISTING_START, page_size=page_size, max_concurrent_pages=max_concurrent_pages)
+        for records in pages:
+            for r in records:
+                if "id" in r:
+                    yield (str(r["id"]), catalog, r.get("lastModified", ""), r.get("status", ""), r.get("created", ""))
+
+
+def external_sort(items: Iterable[tuple], run_size: int = 500_000, directory: str = None) -> Iterator[tuple]:
+    """Sorts a stream of string tuples that is too big to hold in memory, by writing sorted runs to temporary files and merging them.
+    At most `run_size` items (plus one line per run while merging) are held in memory at a time.
+
+    Args:
+        items (Iterable[tuple]): Tuples of strings, none of which contain tabs or newlines. They are sorted by their first element.
+        run_size (int, optional): How many items to sort in memory before writing them out as a run. Defaults to 500,000.
+        directory (str, optional): Where the temporary files go. Defaults to the system's temporary directory.
+
+    Yields:
+        tuple: The items, in order.
+    """
+    with tempfile.TemporaryDirectory(prefix="double-checker-sort-", dir=directory) as tmp:
+        paths = []
+        run = []
+
+        def write_run() -> None:
+            run.sort(key=lambda item: item[0])
+            path = os.path.join(tmp, f"run-{len(paths)}.tsv")
+            with open(path, "w", encoding="utf-8", newline="\n") as f:
+                f.writelines("\t".join(item) + "\n" for item in run)
+            paths.append(path)
+            run.clear()
+
+        for item in items:
+            run.append(item)
+            if len(run) >= run_size:
+                write_run()
+
+        if not paths:
+            # Everything fit in memory, so there's no need to touch the disk.
+            run.sort(key=lambda item: item[0])
+            yield from run
+            return
+        if run:
+            write_run()
+
+        files = [open(path, encoding="utf-8", newline="\n") for path in paths]
+        try:
+            streams = [(tuple(line.rstrip("\n").split("\t")) for line in f) for f in files]
+            yield from heapq.merge(*streams, key=lambda item: item[0])
+        finally:
+            for f in files:
+                f.close()
+
+
+def iter_mongo_ids(col: Collection, batch_size: int = 10_000) -> Iterator[dict]:
+    """Streams `record_id` and `internally_modified` for every document, in `record_id` order, straight from the index."""
+    cursor = (
+        col.find({"record_id": {"$type": "string"}}, projection={"_id": 0, "record_id": 1, "internally_modified": 1}, batch_size=batch_size)
+        .sort(RECORD_ID_INDEX)
+        .hint(RECORD_ID_INDEX)
+    )
+    yield from cursor
+
+
+def is_ok(knackly_item: tuple) -> bool:
+    """Whether a listed record (a tuple from `iter_knackly_ids`) is one that gets reconciled. A record without a status is."""
+    status = knackly_item[3]
+    return not status or status == "Ok"
+
+
+def merge_diff(knackly_ids: Iterable[tuple], mongo_documents: Iterable[dict], stats: Counter) -> Iterator[tuple]:
+    """Walks both sorted streams side by side, like the merge step of a merge sort, so only one item of each is held at a time.
+    A missing or stale record whose status isn't `Ok` is only counted (under `not_ok`), the same as the regular job leaves it alone.
+
+    Args:
+        knackly_ids (Iterable[tuple]): The tuples from `iter_knackly_ids`, sorted by record_id.
+        mongo_documents (Iterable[dict]): {"record_id", "internally_modified"} documents, sorted by record_id.
+        stats (Counter): Counts every record that was compared, by outcome (including `up_to_date`, `duplicate` and `not_ok`).
+
+    Yields:
+        tuple: (MISSING, knackly_item) for a record that has no document, (STALE, knackly_item) for a document that is out of date,
+            and (ORPHANED, mongo_document) for a document whose record isn't in Knackly anymore.
+    """
+    knackly_ids = iter(knackly_ids)
+    mongo_documents = iter(mongo_documents)
+    k = next(knackly_ids, None)
+    m = next(mongo_documents, None)
+    previous_id = None
+    while k is not None or m is not None:
+        if k is not None and k[0] == previous_id:
+            # The same id was listed twice (it moved catalogs mid-listing, for example). The first listing already covered it.
+            stats["duplicate"] += 1
+            k = next(knackly_ids, None)
+            continue
+
+        if m is None or (k is not None and k[0] < m["record_id"]):
+            if is_ok(k):
+                stats[MISSING] += 1
+                yield MISSING, k
+            else:
+                stats["not_ok"] += 1
+            previous_id = k[0]
+            k = next(knackly_ids, None)
+        elif k is None or m["record_id"] < k[0]:
+            stats[ORPHANED] += 1
+            yield ORPHANED, m
+            m = next(mongo_documents, None)
+        else:
+            internally_modified = m.get("internally_modified")
+            if k[2] and (internally_modified is None or parse_knackly_datetime(k[2]).replace(tzinfo=None) > internally_modified + STALE_TOLERANCE):
+                if is_ok(k):
+                    stats[STALE] += 1
+                    yield STALE, k
+                else:
+                    stats["not_ok"] += 1
+            else:
+                stats["up_to_date"] += 1
+            previous_id = k[0]
+            k = next(knackly_ids, None)
+            m = next(mongo_documents, None)
+
+
+def iter_reconciliation_pages(differences: Iterable[tuple], page_size: int, on_orphan=None) -> Iterator[tuple]:
+    """Groups the missing and stale records from `merge_diff` into per-catalog pages for the reconciliation pipeline.
+
+    Args:
+        differences (Iterable[tuple]): The output of `merge_diff`.
+        page_size (int): The most records per page.
+        on_orphan (Callable[[dict], None], optional): Called with every orphaned document. Defaults to None.
+
+    Yields:
+        tuple: (catalog, records) pages, in the shape that `ReconciliationPipeline` expects from the catalog listing.
+    """
+    pages = {}
+    for kind, item in differences:
+        if kind == ORPHANED:
+            if on_orphan is not None:
+                on_orphan(item)
+            continue
+        record_id, catalog, last_modified, status, created = item
+        page = pages.setdefault(catalog, [])
+        page.append({"id": record_id, "lastModified": last_modified, "status": status, "created": created})
+        if len(page) >= page_size:
+            yield catalog, pages.pop(catalog)
+    for catalog, page in pages.items():
+        yield catalog, page
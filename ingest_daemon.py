@@ -0,0 +1,266 @@
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import signal
+import threading
+import time
+from datetime import UTC, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from event_queue import DurableEventQueue, QueuedEvent
+from knackly_api import KnacklyAPI, parse_knackly_datetime
+from logger import initialize_logger
+from mongo_db import HISTORY_COLLECTION, BulkWriter, ensure_history_indexes, ensure_indexes, get_database
+from pipeline import ReconciliationPipeline
+from rate_limiter import TokenBucket
+from watermarks import STATE_COLLECTION
+
+# The lastModified format that the reconciliation pipeline reads.
+KNACKLY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Webhook payloads are a handful of small events, so anything much bigger than this is refused before it is read.
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the daemon settings
+    """
+    parser = argparse.ArgumentParser(
+        description="Accepts Knackly webhook events, queues them durably, and applies them to MongoDB within seconds. main.py stays the nightly safety net."
+    )
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="the address to listen on. Anything but a loopback address needs WEBHOOK_SECRET to be set. Defaults to 127.0.0.1"
+    )
+    parser.add_argument("--port", type=int, default=8080, help="the port to listen on. Defaults to 8080")
+    parser.add_argument("--path", default="/webhook", help="the path that webhook events are POSTed to. Defaults to /webhook")
+    parser.add_argument("--max-body-bytes", type=int, default=MAX_BODY_BYTES, help=f"the largest webhook POST body that is accepted. Defaults to {MAX_BODY_BYTES}")
+    parser.add_argument("--queue-file", default="webhook_events.sqlite3", help="the SQLite file that accepted events are kept in. Defaults to webhook_events.sqlite3")
+    parser.add_argument("--coalesce-seconds", type=float, default=10, help="how long to wait for more events for the same record before applying it. Defaults to 10")
+    parser.add_argument("--max-delay", type=float, default=60, help="the longest that a record which keeps getting events is held back, in seconds. Defaults to 60")
+    parser.add_argument("--batch-size", type=int, default=100, help="the most events to apply at once. Defaults to 100")
+    parser.add_argument("--poll-interval", type=float, default=1, help="how many seconds to wait before checking for due events again when there are none. Defaults to 1")
+    parser.add_argument("--max-attempts", type=int, default=10, help="how many times an event is tried before it is set aside. Defaults to 10")
+    parser.add_argument("--requests-per-second", type=float, default=5, help="the most Knackly API requests to send per second. Defaults to 5")
+    parser.add_argument("--workers", type=int, default=4, help="how many record details to fetch from Knackly at the same time. Defaults to 4")
+    parser.add_argument("--max-retries", type=int, default=5, help="how many times a Knackly request that got a 429/5xx response is retried. Defaults to 5")
+    parser.add_argument("--timeline-format", choices=["full", "delta"], default="full", help="how new timeline entries are stored. Defaults to full")
+    parser.add_argument("--snapshot-interval", type=int, default=10, help="how many timeline entries there are per full snapshot with --timeline-format delta. Defaults to 10")
+    parser.add_argument("--timeline-storage", choices=["embedded", "history"], default="embedded", help="where new documents keep their timeline. Defaults to embedded")
+    parser.add_argument("--bucket-size", type=int, default=100, help="how many timeline entries each history bucket holds. Defaults to 100")
+    args = parser.parse_args()
+
+    for name in ("batch_size", "max_attempts", "workers", "snapshot_interval", "bucket_size", "max_body_bytes"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1. received: {getattr(args, name)}")
+    for name in ("coalesce_seconds", "max_delay", "poll_interval", "requests_per_second"):
+        if getattr(args, name) <= 0:
+            parser.error(f"--{name.replace('_', '-')} must be greater than 0. received: {getattr(args, name)}")
+
+    # The reconciliation pipeline is reused to apply events, and these are the rest of the settings it reads.
+    args.date = datetime.now(tz=UTC).strftime("%Y-%m-%dT%H:%M")
+    args.queue_depth = args.batch_size
+    args.mongo_chunk_size = args.batch_size
+    args.page_size = args.batch_size
+    args.write_batch_size = args.batch_size
+    args.flush_interval = 5.0
+    return args
+
+
+def parse_webhook_events(payload) -> list[tuple[str, str, str]]:
+    """Pulls the record id, catalog and (if there is one) lastModified out of a webhook payload.
+    A payload can be a single event or a list of them, and the id can be given as `id`, `recordId` or `record_id`.
+
+    Raises:
+        ValueError: If an event doesn't name both a record and a catalog.
+
+    Returns:
+        list[tuple[str, str, str]]: (record_id, catalog, last_modified) for every event. last_modified is None if the event didn't have one.
+    """
+    events = []
+    for event in payload if isinstance(payload, list) else [payload]:
+        if not isinstance(event, dict):
+            raise ValueError(f"expected an event object, received: {event!r}")
+        record_id = event.get("id") or event.get("recordId") or event.get("record_id")
+        catalog = event.get("catalog") or event.get("catalogName")
+        if not record_id or not catalog:
+            raise ValueError(f"every event needs a record id and a catalog, received: {event!r}")
+        last_modified = event.get("lastModified")
+        if last_modified:
+            last_modified = parse_knackly_datetime(last_modified).astimezone(UTC).strftime(KNACKLY_TIME_FORMAT)
+        events.append((str(record_id), str(catalog), last_modified))
+    return events
+
+
+def is_loopback(host: str) -> bool:
+    """Whether `host` only accepts connections from this machine, such as 127.0.0.1, ::1 or localhost."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_handler(events: DurableEventQueue, path: str, secret: str, log, max_body_bytes: int = MAX_BODY_BYTES) -> type[BaseHTTPRequestHandler]:
+    """Builds the request handler for the webhook server.
+
+    Args:
+        events (DurableEventQueue): Where accepted events go.
+        path (str): The path that events are POSTed to.
+        secret (str): If set, every POST has to carry it in an `X-Webhook-Secret` header.
+        log (logging.Logger): Where rejected requests are logged.
+        max_body_bytes (int, optional): Bodies longer than this are rejected with 413 without being read. Defaults to MAX_BODY_BYTES.
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def respond(self, status: int, body: dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self.respond(200, {"ok": True, **events.depth()})
+            else:
+                self.respond(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if self.path != path:
+                self.respond(404, {"error": "not found"})
+                return
+            if secret and not hmac.compare_digest(self.headers.get("X-Webhook-Secret", ""), secret):
+                log.warning(f"Rejected a webhook POST from {self.client_address[0]} with a missing or wrong secret.")
+                self.respond(401, {"error": "unauthorized"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                self.respond(400, {"error": "invalid Content-Length"})
+                return
+            if length < 0 or length > max_body_bytes:
+                log.warning(f"Rejected a webhook POST from {self.client_address[0]} with a body of {length} bytes.")
+                # The body is left unread, so the connection can't be reused for another request.
+                self.close_connection = True
+                self.respond(413, {"error": f"the body may be at most {max_body_bytes} bytes"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(length))
+                accepted = parse_webhook_events(payload)
+            except ValueError as e:
+                log.warning(f"Rejected a webhook POST from {self.client_address[0]}: {e}")
+                self.respond(400, {"error": str(e)})
+                return
+            # Only acknowledge the events once they are on disk, so that Knackly retries them if the daemon is down.
+            events.put(accepted)
+            self.respond(202, {"queued": len(accepted)})
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return WebhookHandler
+
+
+def apply_events(batch: list[QueuedEvent], events: DurableEventQueue, knackly: KnacklyAPI, db, args: argparse.Namespace, log) -> dict:
+    """Applies one batch of events by running them through the reconciliation pipeline, so that they are written exactly the way
+    the nightly job would write them. Events whose records were written (or turned out to be deleted from Knackly) are acknowledged,
+    and only the ones whose fetch, format or write failed are retried later.
+
+    Returns:
+        dict: How many events were applied, retried, and set aside.
+    """
+    now = datetime.now(tz=UTC).strftime(KNACKLY_TIME_FORMAT)
+    pages = {}
+    for e in batch:
+        pages.setdefault(e.catalog, []).append({"id": e.record_id, "lastModified": e.last_modified or now, "created": None, "changed": True})
+
+    def report_write_error(record_id: str, error: Exception) -> None:
+        log.error(f"{str(record_id).ljust(23)} | ERROR: {type(error).__name__}: {error}")
+
+    # The pipeline logs its own per-record failures.
+
+    writer = BulkWriter(
+        col=db["real_Records"],
+        batch_size=args.write_batch_size,
+        flush_interval=args.flush_interval,
+        on_error=report_write_error,
+        snapshot_interval=args.snapshot_interval,
+        history_col=db[HISTORY_COLLECTION],
+        history_for_new_documents=args.timeline_storage == "history",
+        bucket_size=args.bucket_size,
+        timeline_format=args.timeline_format,
+    )
+    pipeline = ReconciliationPipeline(knackly=knackly, collection=db["real_Records"], args=args, log=log)
+    try:
+        pipeline.run(catalogs=list(pages), writer=writer, pages=list(pages.items()), show_progress=False)
+    except Exception as e:
+        log.error(f"Applying {len(batch)} events failed, so they will be retried: {type(e).__name__}: {e}")
+        return {"applied": 0, "retried": len(batch), "dead": events.retry(batch, f"{type(e).__name__}: {e}", args.max_attempts)}
+
+    errors = {record_id: error for record_id, error in pipeline.errors + writer.errors}
+    failed = [e for e in batch if e.record_id in errors]
+    events.ack([e for e in batch if e.record_id not in errors])
+    dead = 0
+    for e in failed:
+        dead += events.retry([e], f"{type(errors[e.record_id]).__name__}: {errors[e.record_id]}", args.max_attempts)
+    return {"applied": len(batch) - len(failed), "retried": len(failed), "dead": dead}
+
+
+def main(args: argparse.Namespace):
+    log = initialize_logger()
+    load_dotenv()
+    secret = os.getenv("WEBHOOK_SECRET")
+    # Without a secret anyone who can reach the port can queue events, so only this machine may reach it.
+    if not secret and not is_loopback(args.host):
+        raise SystemExit(f"Refusing to listen on {args.host} without WEBHOOK_SECRET set. Set it, or listen on 127.0.0.1 behind a proxy that checks the caller.")
+    knackly = KnacklyAPI(
+        key_id=os.getenv("KEY"),
+        secret=os.getenv("SECRET"),
+        tenancy=os.getenv("TENANCY"),
+        rate_limiter=TokenBucket(rate=args.requests_per_second),
+        pool_size=args.workers,
+        max_retries=args.max_retries,
+        base_url=os.getenv("KNACKLY_BASE_URL"),
+    )
+    db = get_database()
+    for message in ensure_indexes(db["real_Records"], state_col=db[STATE_COLLECTION]):
+        log.info(message)
+    # Migrated documents get their history written whatever --timeline-storage is, and those writes need the unique bucket index.
+    ensure_history_indexes(db[HISTORY_COLLECTION])
+
+    events = DurableEventQueue(path=args.queue_file, coalesce_seconds=args.coalesce_seconds, max_delay_seconds=args.max_delay)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(events, args.path, secret, log, args.max_body_bytes))
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+    log.info(f"Listening for webhook events on http://{args.host}:{args.port}{args.path} ({events.depth()['waiting']} events already queued).")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.is_set():
+            batch = events.claim(args.batch_size)
+            if not batch:
+                stop.wait(args.poll_interval)
+                continue
+            start_time = time.monotonic()
+            result = apply_events(batch, events, knackly, db, args, log)
+            log.info(
+                f"Applied {result['applied']} of {len(batch)} records ({sum(e.hits for e in batch)} events) in {time.monotonic() - start_time:.2f}s. "
+                f"{result['retried']} will be retried and {result['dead']} were set aside."
+            )
+    finally:
+        server.shutdown()
+        events.close()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
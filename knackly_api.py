@@ -1,6 +1,42 @@
 import json
+import random
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from email.utils import parsedate_to_datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Metrics
+from rate_limiter import TokenBucket
+from response_cache import DetailCache
+from startup_cache import StartupCache, token_ttl
+
+# Responses with these status codes are worth trying again after waiting a bit.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# The lastmod filter only understands minutes, so that is the smallest window a listing can be split into.
+FILTER_TIME_FORMAT = "%Y-%m-%dT%H:%M"
+MIN_WINDOW = timedelta(minutes=1)
+
+
+class RecordNotFound(Exception):
+    """Raised when Knackly answers a detail request with 404, meaning the record was deleted since it was listed (or since its event was sent)."""
+
+
+def parse_knackly_datetime(value: str) -> datetime:
+    """Parses a timestamp from Knackly (such as `2024-07-01T12:34:56.789Z`) into a timezone aware datetime.
+
+    Args:
+        value (str): The timestamp string.
+
+    Returns:
+        datetime: The parsed UTC datetime.
+    """
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
 
 def guess_responsible_app(apps: list) -> str:
@@ -20,14 +56,154 @@ def guess_responsible_app(apps: list) -> str:
     return filtered_apps[0][0]
 
 
+def parse_retry_after(value: str) -> float:
+    """Converts the value of a Retry-After header into a number of seconds to wait.
+
+    Args:
+        value (str): Either a number of seconds, or an HTTP date.
+
+    Returns:
+        float: How many seconds to wait, or None if the header was missing or couldn't be understood.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
 class KnacklyAPI:
-    def __init__(self, key_id: str, secret: str, tenancy: str):
+    def __init__(
+        self,
+        key_id: str,
+        secret: str,
+        tenancy: str,
+        rate_limiter: TokenBucket = None,
+        pool_size: int = 10,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 60.0,
+        timeout: float = 60.0,
+        base_url: str = None,
+        metrics: Metrics = None,
+        cache: DetailCache = None,
+        startup_cache: StartupCache = None,
+        catalogs_ttl: float = 3600.0,
+    ):
         self.key_id = key_id
         self.secret = secret
         self.tenancy = tenancy
-        self.base_url = f"https://lightningdocs.api.knackly.io/{tenancy}/api/v1"
-        self.authorization_header = {"Authorization": f"Bearer {self.get_access_token()}"}
-        print("Successfully connected to Knackly.")
+        # base_url can point somewhere else, such as the fake Knackly server that the benchmarks run against.
+        self.base_url = base_url.rstrip("/") if base_url else f"https://lightningdocs.api.knackly.io/{tenancy}/api/v1"
+        # Optional token bucket shared by every thread using this instance, so that concurrent workers stay under one request budget.
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        # Optional metrics that every request's latency and status are recorded in.
+        self.metrics = metrics
+        # Optional local cache of record details, which `get_record_details` checks before asking Knackly.
+        self.cache = cache
+        # Optional encrypted cache of the bearer token and the catalog list, so that a run started soon after another one
+        # doesn't have to log in and list the catalogs again. Catalog lists are reused for catalogs_ttl seconds.
+        self.startup_cache = startup_cache
+        self.catalogs_ttl = catalogs_ttl
+
+        # One pooled, keep-alive session for every request, so that connections (and their TLS handshakes) get reused.
+        # pool_block stops the pool from opening more than pool_size connections when more threads than that are sending requests.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.token_lock = threading.Lock()
+        token = self.startup_cache.get("token") if self.startup_cache is not None else None
+        if token is not None:
+            # A cached token that has been revoked early is replaced by the usual 401 handling in `_request`.
+            self.authorization_header = {"Authorization": f"Bearer {token}"}
+            print("Reusing a cached Knackly token.")
+        else:
+            self.authorization_header = {"Authorization": f"Bearer {self.get_access_token()}"}
+            print("Successfully connected to Knackly.")
+
+    def _throttle(self) -> None:
+        """Waits for a token from the shared rate limiter (if there is one) before a request is sent."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def _backoff(self, attempt: int, retry_after: float = None) -> None:
+        """Sleeps before the next retry. Uses "full jitter" exponential backoff, but never waits less than the server asked for.
+
+        Args:
+            attempt (int): How many attempts have already failed (starting at 0).
+            retry_after (float, optional): Seconds requested by the server's Retry-After header. Defaults to None.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_factor * (2**attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.backoff_factor))
+        time.sleep(delay)
+
+    def refresh_access_token(self, stale_header: dict) -> None:
+        """Logs in again to get a new bearer token.
+        If another thread already replaced `stale_header` while this one was waiting on the lock, nothing else happens.
+
+        Args:
+            stale_header (dict): The authorization header that was rejected.
+        """
+        with self.token_lock:
+            if self.authorization_header is stale_header:
+                self.authorization_header = {"Authorization": f"Bearer {self.get_access_token()}"}
+
+    def _request(self, method: str, url: str, authenticated: bool = True, call: str = "request", **kwargs) -> requests.Response:
+        """Sends a request through the pooled session.
+        429 and 5xx responses (and dropped connections) are retried with backoff,
+        and an expired bearer token is refreshed once before trying again.
+
+        Args:
+            method (str): The HTTP method, such as "GET".
+            url (str): The full url to send the request to.
+            authenticated (bool, optional): Whether to send the bearer token. Defaults to True.
+            call (str, optional): What kind of call this is, for the metrics. Defaults to "request".
+
+        Returns:
+            requests.Response: The last response that was received.
+        """
+        token_refreshed = False
+        attempt = 0
+        while True:
+            headers = self.authorization_header if authenticated else None
+            self._throttle()
+            sent = time.perf_counter()
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if self.metrics is not None:
+                    self.metrics.inc("knackly_requests_total", call=call, status="connection error")
+                if attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt)
+                attempt += 1
+                continue
+            if self.metrics is not None:
+                self.metrics.observe("knackly_request_seconds", time.perf_counter() - sent, call=call)
+                self.metrics.inc("knackly_requests_total", call=call, status=str(response.status_code))
+
+            if authenticated and response.status_code in (401, 403) and not token_refreshed:
+                token_refreshed = True
+                self.refresh_access_token(stale_header=headers)
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                self._backoff(attempt, parse_retry_after(response.headers.get("Retry-After")))
+                attempt += 1
+                continue
+            return response
 
     def get_access_token(self) -> str:
         """Get an access token needed for other Knackly API requests.
@@ -37,8 +213,11 @@ class KnacklyAPI:
         """
         url = f"{self.base_url}/auth/login"
         payload = {"KeyID": self.key_id, "Secret": self.secret}
-        r = requests.post(url, data=payload)
-        return r.json()["token"]
+        r = self._request("POST", url, authenticated=False, call="login", data=payload)
+        token = r.json()["token"]
+        if self.startup_cache is not None:
+            self.startup_cache.set("token", token, token_ttl(token))
+        return token
 
     def get_available_catalogs(self) -> list[dict]:
         """Lists the catalogs available to the api key.
@@ -46,11 +225,16 @@ class KnacklyAPI:
         Returns:
             list[dict]: A list of catalog dictionaries containing metadata about each catalog.
         """
+        if self.startup_cache is not None and (catalogs := self.startup_cache.get("catalogs")) is not None:
+            return catalogs
         url = f"{self.base_url}/catalogs"
-        response = requests.get(url, headers=self.authorization_header)
+        response = self._request("GET", url, call="catalogs")
 
         response.raise_for_status()
-        return response.json()
+        catalogs = response.json()
+        if self.startup_cache is not None:
+            self.startup_cache.set("catalogs", catalogs, self.catalogs_ttl)
+        return catalogs
 
     def get_records_in_catalog(
         self,
@@ -93,7 +277,7 @@ class KnacklyAPI:
         # Remove any None values from params
         params = {k: v for k, v in params.items() if v is not None}
 
-        response = requests.get(url, headers=self.authorization_header, params=params)
+        response = self._request("GET", url, call="list", params=params)
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as e:
@@ -105,21 +289,120 @@ class KnacklyAPI:
         result = response.json()
         return result
 
-    def get_record_details(self, record_id: str, catalog: str) -> dict:
+    def iter_records_in_catalog(
+        self,
+        catalog: str,
+        start: datetime,
+        end: datetime = None,
+        status: str = None,
+        page_size: int = 1000,
+        max_concurrent_pages: int = 4,
+        on_window_listed: Callable[[datetime], None] = None,
+    ) -> Iterator[list[dict]]:
+        """Streams the metadata about every record in a catalog that was last modified in [start, end), one page at a time.
+
+        Rather than trusting a single `skip=0` page, the time range is listed as a series of `{"c":"range", ...}` windows.
+        Whenever a window fills up an entire page it is split in half and each half is listed separately,
+        so every window that is finally yielded fits in one request. A window that can't be split any further (one minute wide)
+        but still has more than a page worth of records falls back to paging through it with skip/limit.
+        Up to `max_concurrent_pages` requests run at the same time, and pages are always yielded oldest window first.
+
+        Args:
+            catalog (str): Name of the catalog
+            start (datetime): Only records last modified at or after this time will be listed. Must be timezone aware.
+            end (datetime, optional): Only records last modified before this time will be listed.
+                Defaults to the start of the current minute, so that the listing never covers a minute that is still in progress.
+            status (str, optional): Status filter of the record. Can be either `Ok` or `Needs Updating`. Defaults to None.
+            page_size (int, optional): How many records to ask for per request. Defaults to 1000.
+            max_concurrent_pages (int, optional): How many listing requests may be in flight at once. Defaults to 4.
+            on_window_listed (Callable[[datetime], None], optional): Called with a window's end once every page in it has been yielded (and handled),
+                meaning that every record modified before that time has been listed. Defaults to None.
+
+        Yields:
+            list[dict]: Pages of record metadata. Each record shows up exactly once.
+        """
+        start = start.replace(second=0, microsecond=0)
+        if end is None:
+            end = datetime.now(tz=UTC).replace(second=0, microsecond=0)
+
+        def list_window(window_start: datetime, window_end: datetime, skip: int = 0) -> list[dict]:
+            last_modified = {"c": "range", "dateStart": window_start.strftime(FILTER_TIME_FORMAT), "dateEnd": window_end.strftime(FILTER_TIME_FORMAT)}
+            return self.get_records_in_catalog(catalog=catalog, status=status, last_modified=last_modified, skip=skip, limit=page_size)
+
+        def in_window(records: list[dict], window_start: datetime, window_end: datetime) -> list[dict]:
+            # Neighbouring windows share a boundary minute, so only keep the records that belong to this half-open window.
+            return [r for r in records if "lastModified" not in r or window_start <= parse_knackly_datetime(r["lastModified"]) < window_end]
+
+        with ThreadPoolExecutor(max_workers=max_concurrent_pages, thread_name_prefix=f"knackly-list-{catalog}") as executor:
+            # Windows still to be listed, in time order. Each entry is [window_start, window_end, future_or_None].
+            pending = [[start, end, None]]
+            while pending:
+                # Keep the first few windows' requests in flight while the oldest one is being looked at.
+                for window in pending[:max_concurrent_pages]:
+                    if window[2] is None:
+                        window[2] = executor.submit(list_window, window[0], window[1])
+
+                window_start, window_end, future = pending.pop(0)
+                records = future.result()
+                if len(records) < page_size:
+                    yield in_window(records, window_start, window_end)
+                    if on_window_listed is not None:
+                        on_window_listed(window_end)
+                    continue
+
+                if window_end - window_start > MIN_WINDOW:
+                    # Too dense. Split the window (on a minute boundary) and list each half instead.
+                    middle = window_start + ((window_end - window_start) // 2 // MIN_WINDOW) * MIN_WINDOW
+                    pending[0:0] = [[window_start, middle, None], [middle, window_end, None]]
+                    continue
+
+                # A single minute that is still full: page through it with skip, a batch of pages at a time.
+                yield in_window(records, window_start, window_end)
+                skip = page_size
+                while True:
+                    futures = [executor.submit(list_window, window_start, window_end, skip + i * page_size) for i in range(max_concurrent_pages)]
+                    pages = [f.result() for f in futures]
+                    for page in pages:
+                        yield in_window(page, window_start, window_end)
+                    if len(pages[-1]) < page_size:
+                        break
+                    skip += max_concurrent_pages * page_size
+                if on_window_listed is not None:
+                    on_window_listed(window_end)
+
+    def get_record_details(self, record_id: str, catalog: str, last_modified: int = None) -> dict:
         """Query's the Knackly API for information regarding a specific record
 
         Args:
             record_id (str): The unique id of the record, typically gotten from a webhook event firing
             catalog (str): The catalog that the record resides in
+            last_modified (int, optional): The record's listed lastModified in microseconds since the epoch. If given and the details
+                for it are in the cache, they are returned without a request. Defaults to None.
+
+        Raises:
+            RecordNotFound: If the record doesn't exist (anymore).
+            RuntimeError: If Knackly answered with any other error.
 
         Returns:
             dict: A python object containing information about the record
         """
+        if self.cache is not None and last_modified is not None:
+            cached = self.cache.get(record_id, last_modified)
+            if self.metrics is not None:
+                self.metrics.inc("detail_cache_total", result="miss" if cached is None else "hit")
+            if cached is not None:
+                return cached
+
         url = f"{self.base_url}/catalogs/{catalog}/items/{record_id}"
-        r = requests.get(url, headers=self.authorization_header)
-        if r.status_code == 400 or r.status_code == 403:
+        r = self._request("GET", url, call="detail")
+        if r.status_code == 404:
+            raise RecordNotFound(f"{record_id} no longer exists in {catalog}")
+        if not r.ok:
             raise RuntimeError(f"{r.status_code}: something went wrong while trying to get {record_id} in {catalog}: {r.text}")
-        return r.json()
+        record_details = r.json()
+        if self.cache is not None:
+            self.cache.put(record_details)
+        return record_details
 
     def pretty_print_request_details(self, req: requests.Request) -> None:
         """Helper function to print out the full information that python is sending to the server
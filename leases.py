@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+
+# The collection that distributed workers coordinate through: one lease document per catalog per run, and one summary per worker.
+COORDINATION_COLLECTION = "double_checker_leases"
+
+LEASE = "lease"
+SUMMARY = "summary"
+
+
+def lease_id(run_id: str, catalog: str) -> str:
+    return f"{run_id}:{LEASE}:{catalog}"
+
+
+def summary_id(run_id: str, worker_id: str) -> str:
+    return f"{run_id}:{SUMMARY}:{worker_id}"
+
+
+class CatalogLeases:
+    """Shares the catalogs of one run between any number of workers, on any number of machines.
+
+    Every catalog gets a lease document. A worker takes a catalog by claiming its lease until `lease_duration` from now,
+    and keeps renewing it while it works. If a worker dies, its lease runs out and the next worker to ask for a catalog takes it over.
+    Once a catalog has been reconciled and its writes flushed, its lease is marked done and nobody takes it again.
+    """
+
+    def __init__(self, col: Collection, run_id: str, worker_id: str, lease_duration: timedelta = timedelta(minutes=5)):
+        """
+        Args:
+            col (Collection): The pymongo collection that holds the lease and summary documents.
+            run_id (str): Identifies the run. Every worker that should share the catalogs has to use the same one.
+            worker_id (str): Identifies this worker. Must be unique within the run.
+            lease_duration (timedelta, optional): How long a lease lasts without being renewed. Defaults to 5 minutes.
+        """
+        self.col = col
+        self.run_id = run_id
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+        # Catalogs whose lease was taken over by another worker while this one was still working on them.
+        self.lost = set()
+
+    def register(self, catalogs: list[str]) -> None:
+        """Creates a lease for every catalog that doesn't have one in this run yet. Every worker can call this, in any order."""
+        operations = [
+            UpdateOne(
+                {"_id": lease_id(self.run_id, c)},
+                {
+                    "$setOnInsert": {
+                        "run_id": self.run_id,
+                        "kind": LEASE,
+                        "catalog": c,
+                        "status": "pending",
+                        "owner": None,
+                        "expires": None,
+                        "attempts": 0,
+                    }
+                },
+                upsert=True,
+            )
+            for c in catalogs
+        ]
+        if operations:
+            self.col.bulk_write(operations, ordered=False)
+
+    def acquire(self) -> str:
+        """Claims the next catalog that is either unclaimed or whose lease has run out.
+
+        Returns:
+            str: The name of the catalog, or None if every catalog is either done or currently leased by a live worker.
+        """
+        now = datetime.now(tz=UTC)
+        lease = self.col.find_one_and_update(
+            {
+                "run_id": self.run_id,
+                "kind": LEASE,
+                "$or": [{"status": "pending"}, {"status": "running", "expires": {"$lt": now}}],
+            },
+            {
+                "$set": {"status": "running", "owner": self.worker_id, "expires": now + self.lease_duration, "acquired": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("attempts", 1), ("catalog", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return lease["catalog"] if lease else None
+
+    def next_catalog(self) -> str:
+        """Waits for the next catalog this worker can take. While the only catalogs left are leased by other workers, it checks again
+        every third of `lease_duration`, so that a catalog whose worker died is taken over once its lease runs out.
+
+        Returns:
+            str: The name of the catalog, or None once every catalog in the run is done.
+        """
+        while (catalog := self.acquire()) is None:
+            if not outstanding_catalogs(self.col, self.run_id):
+                return None
+            time.sleep(self.lease_duration.total_seconds() / 3)
+        return catalog
+
+    def renew(self, catalog: str) -> bool:
+        """Pushes a lease's expiry forward. Returns False if the lease isn't held by this worker anymore."""
+        result = self.col.update_one(
+            {"_id": lease_id(self.run_id, catalog), "owner": self.worker_id, "status": "running"},
+            {"$set": {"expires": datetime.now(tz=UTC) + self.lease_duration}},
+        )
+        if result.matched_count == 0:
+            self.lost.add(catalog)
+            return False
+        return True
+
+    def complete(self, catalog: str, counts: dict) -> bool:
+        """Marks a catalog as done, along with its counts. Returns False if the lease had been taken over by another worker."""
+        result = self.col.update_one(
+            {"_id": lease_id(self.run_id, catalog), "owner": self.worker_id, "status": "running"},
+            {"$set": {"status": "done", "expires": None, "finished": datetime.now(tz=UTC), "counts": counts}},
+        )
+        return result.matched_count == 1
+
+    def release(self, catalog: str) -> None:
+        """Gives a catalog back without finishing it, so that another worker can pick it up straight away."""
+        self.col.update_one(
+            {"_id": lease_id(self.run_id, catalog), "owner": self.worker_id, "status": "running"},
+            {"$set": {"status": "pending", "owner": None, "expires": None}},
+        )
+
+    @contextmanager
+    def held(self, catalog: str):
+        """Keeps renewing a catalog's lease on a background thread for as long as the block runs."""
+        stop = threading.Event()
+
+        def heartbeat() -> None:
+            while not stop.wait(self.lease_duration.total_seconds() / 3):
+                if not self.renew(catalog):
+                    return
+
+        thread = threading.Thread(target=heartbeat, name=f"lease-{catalog}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def save_summary(self, status: str, counts: dict, catalogs: list[str], errors: int, started: datetime) -> None:
+        """Writes this worker's summary of the run, for the coordinator to merge."""
+        self.col.replace_one(
+            {"_id": summary_id(self.run_id, self.worker_id)},
+            {
+                "run_id": self.run_id,
+                "kind": SUMMARY,
+                "worker": self.worker_id,
+                "status": status,
+                "counts": counts,
+                "catalogs": catalogs,
+                "errors": errors,
+                "started": started,
+                "finished": datetime.now(tz=UTC),
+            },
+            upsert=True,
+        )
+
+
+def outstanding_catalogs(col: Collection, run_id: str) -> list[dict]:
+    """Returns the lease of every catalog in a run that isn't done yet."""
+    return list(col.find({"run_id": run_id, "kind": LEASE, "status": {"$ne": "done"}}, projection={"catalog": 1, "status": 1, "owner": 1, "expires": 1}))
+
+
+def merge_summaries(col: Collection, run_id: str) -> dict:
+    """Adds up the summaries that every worker wrote for a run.
+
+    Returns:
+        dict: The summed `counts`, the number of failed records (`errors`), the `workers` that took part, the ones whose run `failed`,
+            how many `catalogs` were reconciled, and the catalogs that are still `outstanding`.
+    """
+    counts = Counter()
+    errors = 0
+    workers = []
+    failed = []
+    catalogs = 0
+    for summary in col.find({"run_id": run_id, "kind": SUMMARY}).sort("worker", 1):
+        counts.update(summary.get("counts", {}))
+        errors += summary.get("errors", 0)
+        catalogs += len(summary.get("catalogs", []))
+        workers.append(summary["worker"])
+        if summary.get("status") != "ok":
+            failed.append(summary["worker"])
+    return {
+        "counts": dict(counts),
+        "errors": errors,
+        "workers": workers,
+        "failed": failed,
+        "catalogs": catalogs,
+        "outstanding": [lease["catalog"] for lease in outstanding_catalogs(col, run_id)],
+    }
@@ -1,6 +1,11 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import time
+from datetime import UTC, datetime
 from pathlib import Path
-from datetime import datetime
 
 
 def show_only_debug(record: logging.LogRecord) -> bool:
@@ -15,11 +20,67 @@ def show_only_debug(record: logging.LogRecord) -> bool:
     return record.levelname == "DEBUG"
 
 
-def initialize_logger() -> logging.Logger:
+def human_readable(record: logging.LogRecord) -> bool:
+    """Filter for the console and text file handlers, which leave out records that only exist for the JSONL events file."""
+    return not getattr(record, "event_only", False)
+
+
+def has_event(record: logging.LogRecord) -> bool:
+    """Filter for the JSONL handler, which only writes records that carry a structured `event`."""
+    return getattr(record, "event", None) is not None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record's structured `event` (passed as `extra={"event": {...}}`) as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({"time": datetime.fromtimestamp(record.created, tz=UTC).isoformat(), "level": record.levelname, **record.event}, default=str)
+
+
+class LogListener(logging.handlers.QueueListener):
+    """Runs the handlers on a background thread. Besides ordinary log records, it takes the (created, level, message, event) tuples
+    that `log_event` puts on the same queue, and only turns those into log records here, off of the thread that logged them."""
+
+    def __init__(self, logger: logging.Logger, records: queue.SimpleQueue, *handlers: logging.Handler):
+        super().__init__(records, *handlers, respect_handler_level=True)
+        self.logger_name = logger.name
+
+    def handle(self, record) -> None:
+        if isinstance(record, tuple):
+            created, level, message, event = record
+            record = logging.LogRecord(self.logger_name, level, __file__, 0, message or "", None, None)
+            record.created, record.msecs = created, (created - int(created)) * 1000
+            record.event = event
+            record.event_only = message is None
+        super().handle(record)
+
+
+def log_event(logger: logging.Logger, level: int, message: str, event: dict) -> None:
+    """Logs one record action: a line for the human readable log (or None for none), and its structured event for the JSONL events file.
+
+    With a logger from `initialize_logger`, this only puts a tuple on the logging queue, so the thread that is writing records doesn't pay
+    for building and formatting a log record. Any other logger gets an ordinary log call with the event in `extra`.
+    """
+    records = getattr(logger, "records", None)
+    if records is None:
+        if message is not None:
+            logger.log(level, message, extra={"event": event})
+        return
+    if logger.isEnabledFor(level):
+        records.put((time.time(), level, message, event))
+
+
+def initialize_logger(events: bool = True) -> logging.Logger:
     """Sets up a logger with handlers to the console and the /logs/ folder.
     Also ensures that a folder called ./logs/ is created if not already existing.
     DEBUG level logs will show up in the console, and INFO+ level logs will show up in a separate file in the logs folder.
 
+    The handlers run on a background thread behind a queue, so logging a line never waits on the console or the disk.
+    Events logged with `log_event` (or with `extra={"event": {...}}`) are also written to a .jsonl file next to the text log, one JSON object per line.
+
+    Args:
+        events (bool, optional): Whether to write the JSONL events file. It is only created once there is an event to write. Defaults to True.
+
     Returns:
         logging.Logger: A customized instance of the Logger class.
     """
@@ -28,11 +89,17 @@ def initialize_logger() -> logging.Logger:
     today = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
     logger = logging.getLogger(__name__)
     logger.setLevel("DEBUG")
+    # Calling this again (such as for another benchmark scenario) replaces the previous handlers instead of adding to them.
+    previous = getattr(logger, "listener", None)
+    if previous is not None:
+        previous.stop()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel("DEBUG")
     console_handler.addFilter(show_only_debug)
-    logger.addHandler(console_handler)
+    console_handler.addFilter(human_readable)
 
     file_handler = logging.FileHandler(f"logs/{today}.txt", mode="w", encoding="utf-8")
     file_handler.setLevel("INFO")
@@ -42,6 +109,20 @@ def initialize_logger() -> logging.Logger:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
+    file_handler.addFilter(human_readable)
+    handlers = [console_handler, file_handler]
+
+    if events:
+        events_handler = logging.FileHandler(f"logs/{today}.jsonl", mode="w", encoding="utf-8", delay=True)
+        events_handler.setFormatter(JsonLinesFormatter())
+        events_handler.addFilter(has_event)
+        handlers.append(events_handler)
+
+    logger.records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(logger.records))
+    logger.listener = LogListener(logger, logger.records, *handlers)
+    logger.listener.start()
+    # Whatever is still queued is written out when the program exits.
+    atexit.register(logger.listener.stop)
 
     return logger
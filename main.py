@@ -1,15 +1,27 @@
 import argparse
 import os
+import socket
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import UTC, datetime, timedelta
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from tqdm import tqdm
+from pymongo.database import Database
 
-from knackly_api import KnacklyAPI, guess_responsible_app
+from full_reconciliation import MISSING, ORPHANED, STALE, external_sort, iter_knackly_ids, iter_mongo_ids, iter_reconciliation_pages, merge_diff
+from knackly_api import KnacklyAPI
+from leases import COORDINATION_COLLECTION, CatalogLeases, outstanding_catalogs
 from logger import initialize_logger
-from mongo_db import add_to_billing_array, add_to_timeline, format_document, update_internally_modified, update_mongodb_modified
+from metrics import Metrics, MongoCommandMetrics, perf_table
+from mongo_db import HISTORY_COLLECTION, BulkWriter, ensure_history_indexes, ensure_indexes, explain_query_shapes, get_database
+from pipeline import ReconciliationPipeline
+from notify_teams import send_teams_message
+from plan import INSERT, UPDATE, build_plan, estimate_cost, iter_plan_pages, plan_catalogs, write_summary
+from rate_limiter import TokenBucket
+from response_cache import DetailCache
+from startup_cache import StartupCache
+from watermarks import STATE_COLLECTION, WatermarkTracker
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -24,14 +36,233 @@ def parse_arguments() -> argparse.Namespace:
         parser.add_argument(
             "-d",
             "--date",
-            help="specify a date in the format `YYYY-MM-DD`. Any records with a lastModified date greater than or equal to this date will be what is searched. Defaults to 6:00 UTC the day before this program is being ran. For example, if this script is ran on 2024-04-12, the date argument will be 2024-04-11",
+            help="specify a date in the format `YYYY-MM-DD`. Any records with a lastModified date greater than or equal to this date will be what is searched. Overrides the saved per-catalog watermarks. Without it, each catalog starts from its watermark, or 6:00 UTC the day before this program is being ran if it doesn't have one yet. For example, if this script is ran on 2024-04-12, the date argument will be 2024-04-11",
+        )
+        parser.add_argument(
+            "--requests-per-second",
+            type=float,
+            default=5.0,
+            help="the most requests per second that will be sent to Knackly, shared across every worker. Defaults to 5",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="how many record detail requests may be in flight at the same time. Defaults to 8",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=1000,
+            help="how many records to ask for per catalog listing request. Denser time windows are split until they fit. Defaults to 1000",
+        )
+        parser.add_argument(
+            "--mongo-chunk-size",
+            type=int,
+            default=1000,
+            help="how many record ids to send to MongoDB per lookup query. Defaults to 1000",
+        )
+        parser.add_argument(
+            "--write-batch-size",
+            type=int,
+            default=500,
+            help="the most inserts/updates to send to MongoDB per bulk write. Defaults to 500",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=5.0,
+            help="the most seconds a queued write waits before its batch is sent to MongoDB. Defaults to 5",
+        )
+        parser.add_argument(
+            "--queue-depth",
+            type=int,
+            default=1000,
+            help="how many items each pipeline stage may queue up for the next one, which caps how much is held in memory. Defaults to 1000",
+        )
+        parser.add_argument(
+            "--timeline-format",
+            choices=["full", "delta"],
+            default="full",
+            help="how new timeline entries are stored. `full` pushes a full copy of the record every time, `delta` stores a full snapshot every --snapshot-interval entries with field-level diffs in between. Defaults to full",
+        )
+        parser.add_argument(
+            "--snapshot-interval",
+            type=int,
+            default=10,
+            help="how many timeline entries there are per full snapshot when --timeline-format is delta. Defaults to 10",
+        )
+        parser.add_argument(
+            "--timeline-storage",
+            choices=["embedded", "history"],
+            default="embedded",
+            help="where new documents keep their timeline. `embedded` keeps it in the document itself, `history` keeps it in buckets in a separate history collection (documents that already use the history collection always keep using it). Defaults to embedded",
+        )
+        parser.add_argument(
+            "--bucket-size",
+            type=int,
+            default=100,
+            help="how many timeline entries each history bucket holds, for new documents stored with --timeline-storage history. Defaults to 100",
+        )
+        parser.add_argument(
+            "--pool-size",
+            type=int,
+            help="how many keep-alive connections to hold open to Knackly. Defaults to the number of workers",
+        )
+        parser.add_argument(
+            "--max-retries",
+            type=int,
+            default=5,
+            help="how many times a Knackly request that got a 429/5xx response (or lost its connection) is retried. Defaults to 5",
+        )
+        parser.add_argument(
+            "--no-explain",
+            action="store_true",
+            help="skip logging the explain() stats of the job's MongoDB queries at startup",
+        )
+        parser.add_argument(
+            "--retry-unique-index",
+            action="store_true",
+            help="try to create the unique record_id index again, even though an earlier run found duplicate record ids and recorded that it couldn't",
+        )
+        parser.add_argument(
+            "--distributed",
+            action="store_true",
+            help="run as one of several workers that share the catalogs through leases in MongoDB. Start any number of them with the same --run-id, then run coordinator.py to merge their summaries",
+        )
+        parser.add_argument(
+            "--run-id",
+            help="with --distributed (where it is required), identifies the run that this worker takes part in. Every worker started with the same run id shares its catalogs, and a run whose catalogs are all done has nothing left to reconcile, so use a new one for every run",
+        )
+        parser.add_argument(
+            "--worker-id",
+            help="with --distributed, identifies this worker within the run. Defaults to `<hostname>:<process id>`",
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            type=int,
+            default=300,
+            help="with --distributed, how long a catalog stays claimed by a worker that has stopped renewing it, before another worker takes it over. Defaults to 300",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="compare every record id in Knackly against every document in MongoDB, regardless of --date or watermarks. Missing and stale documents are written, and orphaned documents (whose record isn't in Knackly anymore) are reported",
+        )
+        parser.add_argument(
+            "--sort-run-size",
+            type=int,
+            default=500_000,
+            help="with --full, how many Knackly ids are sorted in memory at a time before being spilled to a temporary file. Defaults to 500000",
+        )
+        parser.add_argument(
+            "--sort-dir",
+            help="with --full, where the temporary sort files go. Defaults to the system's temporary directory",
+        )
+        parser.add_argument(
+            "--plan",
+            help="don't write anything. Instead, work out every insert and timeline update the run would make from the listing alone, and write them to this JSONL file along with an estimate of what applying them would cost",
+        )
+        parser.add_argument(
+            "--apply",
+            help="apply a plan written by --plan, instead of listing the catalogs",
+        )
+        parser.add_argument(
+            "--detail-cache",
+            help="keep record details in this local SQLite file, keyed by record id and lastModified, so that a rerun doesn't fetch unchanged details from Knackly again",
+        )
+        parser.add_argument(
+            "--detail-cache-mb",
+            type=float,
+            default=512,
+            help="with --detail-cache, how big the cache may get before the least recently used details are dropped. Defaults to 512",
+        )
+        parser.add_argument(
+            "--detail-cache-ttl-hours",
+            type=float,
+            default=168,
+            help="with --detail-cache, how long cached details are trusted for. Defaults to 168 (a week)",
+        )
+        parser.add_argument(
+            "--startup-cache",
+            default="startup_cache.bin",
+            help="where the Knackly token and catalog list are cached (encrypted) between runs, so that a run started soon after another one doesn't log in and list the catalogs again. Defaults to startup_cache.bin",
+        )
+        parser.add_argument(
+            "--no-startup-cache",
+            action="store_true",
+            help="always log in and list the catalogs, without reading or writing the startup cache",
+        )
+        parser.add_argument(
+            "--catalog-cache-minutes",
+            type=float,
+            default=60,
+            help="how long a cached catalog list is reused for. 0 only caches the token. Defaults to 60",
+        )
+        parser.add_argument(
+            "--notify-teams",
+            action="store_true",
+            help="send the Teams notification, with the performance table, from this process once the run has finished or failed",
+        )
+        parser.add_argument(
+            "--log-file",
+            help="with --notify-teams, the log file that a failure notification points to",
+        )
+        parser.add_argument(
+            "--metrics-json",
+            default="metrics.json",
+            help="where to write the run's timings, call counts and latency histograms as JSON. notify_teams.py reads it for the performance table. Defaults to metrics.json",
+        )
+        parser.add_argument(
+            "--metrics-prom",
+            help="also write the metrics in the Prometheus text format to this file, such as a .prom file in node_exporter's textfile collector directory",
         )
         return parser
 
     parser = init_argparse()
     args = parser.parse_args()
 
+    if args.requests_per_second <= 0:
+        parser.error(f"--requests-per-second must be greater than 0. received: {args.requests_per_second}")
+    if args.workers < 1:
+        parser.error(f"--workers must be at least 1. received: {args.workers}")
+    if args.page_size < 1:
+        parser.error(f"--page-size must be at least 1. received: {args.page_size}")
+    if args.mongo_chunk_size < 1:
+        parser.error(f"--mongo-chunk-size must be at least 1. received: {args.mongo_chunk_size}")
+    if args.write_batch_size < 1:
+        parser.error(f"--write-batch-size must be at least 1. received: {args.write_batch_size}")
+    if args.queue_depth < 1:
+        parser.error(f"--queue-depth must be at least 1. received: {args.queue_depth}")
+    if args.snapshot_interval < 1:
+        parser.error(f"--snapshot-interval must be at least 1. received: {args.snapshot_interval}")
+    if args.bucket_size < 1:
+        parser.error(f"--bucket-size must be at least 1. received: {args.bucket_size}")
+    if args.pool_size is None:
+        args.pool_size = args.workers
+    elif args.pool_size < 1:
+        parser.error(f"--pool-size must be at least 1. received: {args.pool_size}")
+    if args.sort_run_size < 1:
+        parser.error(f"--sort-run-size must be at least 1. received: {args.sort_run_size}")
+    if sum(bool(mode) for mode in (args.plan, args.apply, args.full, args.distributed)) > 1:
+        parser.error("only one of --plan, --apply, --full and --distributed can be used at a time")
+    if args.apply and not os.path.exists(args.apply):
+        parser.error(f"the plan to apply doesn't exist. received: {args.apply}")
+    if args.detail_cache_mb <= 0:
+        parser.error(f"--detail-cache-mb must be greater than 0. received: {args.detail_cache_mb}")
+    if args.detail_cache_ttl_hours <= 0:
+        parser.error(f"--detail-cache-ttl-hours must be greater than 0. received: {args.detail_cache_ttl_hours}")
+    if args.catalog_cache_minutes < 0:
+        parser.error(f"--catalog-cache-minutes can't be negative. received: {args.catalog_cache_minutes}")
+    if args.lease_seconds < 3:
+        parser.error(f"--lease-seconds must be at least 3. received: {args.lease_seconds}")
+    if args.distributed and args.run_id is None:
+        parser.error("--run-id is required with --distributed, since a run whose catalogs are all done has nothing left for another worker to do")
+    if args.worker_id is None:
+        args.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
     # Validate that args.date is in the format YYYY-MM-DD.
+    args.date_given = args.date is not None
     if args.date:
         try:
             args.date = datetime.strptime(args.date, "%Y-%m-%d")
@@ -49,134 +280,308 @@ def parse_arguments() -> argparse.Namespace:
     return args
 
 
-def main(args: argparse.Namespace):
+def reconcile_leased_catalogs(
+    leases: CatalogLeases,
+    catalogs: list[str],
+    new_pipeline,
+    writer: BulkWriter,
+    tracker: WatermarkTracker,
+    log,
+) -> dict[str, int]:
+    """Reconciles catalogs one at a time until every catalog in the run is done, then writes this worker's summary for the coordinator.
+    While the only catalogs left are leased by other workers, it keeps waiting, so that it can take over any whose worker dies.
+
+    A catalog's lease is only marked done once its writes have been flushed. If reconciling it fails,
+    the lease is handed back so that another worker can retry it, and the error is raised once the summary has been written.
+
+    Args:
+        leases (CatalogLeases): The run's leases.
+        catalogs (list[str]): Every catalog in the run. Leases are created for any that don't have one yet.
+        new_pipeline: Called with no arguments to build the pipeline for each catalog.
+        writer (BulkWriter): Where the inserts and updates are sent.
+        tracker (WatermarkTracker): Saved after each catalog, so its watermark moves forward as soon as it is done.
+        log (logging.Logger): Where the progress lines are logged.
+
+    Raises:
+        RuntimeError: If every catalog in the run was already done before this worker started, such as when a finished run's id is reused.
+
+    Returns:
+        dict[str, int]: This worker's counters, added up over every catalog it reconciled.
+    """
+    leases.register(catalogs)
+    # Reusing the id of a finished run would otherwise reconcile nothing and still look like a success.
+    if catalogs and not outstanding_catalogs(leases.col, leases.run_id):
+        raise RuntimeError(f"Every catalog in run {leases.run_id} was already done, so there was nothing to reconcile. Start the workers with a new --run-id.")
+    started = datetime.now(tz=UTC)
+    totals = dict.fromkeys(("new", "inserted", "matching", "modified", "unchanged", "bytes_avoided", "deleted", "failed"), 0)
+    done = []
+    status = "failed"
+    try:
+        while (catalog := leases.next_catalog()) is not None:
+            log.info(f"{str(catalog).ljust(20)} | leased by worker {leases.worker_id} for run {leases.run_id}")
+            pipeline = new_pipeline()
+            try:
+                with leases.held(catalog):
+                    pipeline.run(catalogs=[catalog], writer=writer)
+            except BaseException:
+                leases.release(catalog)
+                raise
+            tracker.save()
+            # Only a worker that still held the lease counts the catalog, so the merged totals never count one twice.
+            if leases.complete(catalog, pipeline.counts()):
+                done.append(catalog)
+                for name, value in pipeline.counts().items():
+                    totals[name] += value
+            else:
+                log.warning(f"{str(catalog).ljust(20)} | WARNING: the lease ran out and was taken over by another worker before this one finished.")
+        status = "ok"
+    finally:
+        leases.save_summary(status=status, counts=totals, catalogs=done, errors=len(writer.errors) + totals["failed"], started=started)
+    return totals
+
+
+def reconcile_everything(knackly: KnacklyAPI, collection, catalogs: list[str], pipeline: ReconciliationPipeline, writer: BulkWriter, args, log) -> Counter:
+    """Finds every difference between Knackly and MongoDB, then reconciles the missing and stale documents through the pipeline.
+
+    Every Knackly id is listed and sorted with an external merge sort, every MongoDB `record_id` is read in index order,
+    and the two sorted streams are diffed side by side, so memory use stays flat however many ids there are.
+
+    Returns:
+        Counter: How many ids were missing, stale, orphaned, up to date, listed twice, or skipped because of their status.
+    """
+    stats = Counter()
+    orphan_heading_printed = False
+
+    def report_orphan(document: dict) -> None:
+        nonlocal orphan_heading_printed
+        if not orphan_heading_printed:
+            orphan_heading_printed = True
+            log.info(f"{'-' * 63}")
+            log.info(f"{'Orphaned record id'.ljust(23)} | Internally Modified")
+            log.info(f"{'-' * 63}")
+        log.info(f"{str(document['record_id']).ljust(23)} | {document.get('internally_modified')}")
+
+    knackly_ids = external_sort(
+        iter_knackly_ids(knackly, catalogs, page_size=args.page_size, max_concurrent_pages=args.workers),
+        run_size=args.sort_run_size,
+        directory=args.sort_dir,
+    )
+    differences = merge_diff(knackly_ids, iter_mongo_ids(collection, batch_size=args.mongo_chunk_size), stats)
+    pages = iter_reconciliation_pages(differences, page_size=args.page_size, on_orphan=report_orphan)
+    pipeline.run(catalogs=catalogs, writer=writer, pages=pages)
+    return stats
+
+
+def write_metrics(metrics: Metrics, args: argparse.Namespace) -> None:
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+
+
+def connect_to_mongo(metrics: Metrics) -> Database:
+    """Connects to MongoDB and waits for the first round trip, which for Atlas includes the SRV lookup and the TLS handshake."""
+    db = get_database(event_listeners=[MongoCommandMetrics(metrics)])
+    db.command("ping")
+    return db
+
+
+def notify_teams(metrics: Metrics, error: BaseException, log_file: str) -> None:
+    """Sends the run's Teams notification from this process, with the performance table from its metrics.
+    A notification that can't be sent is only printed, so that it never hides how the run itself went."""
+    load_dotenv()
+    stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if error is None:
+        title, message = f"[{stamp}] ETL Succeeded", "The ETL job completed successfully."
+    else:
+        title = f"[{stamp}] ETL FAILED"
+        message = f"The ETL job failed with {type(error).__name__}: {error}." + (f" Check logs: {log_file}" if log_file else "")
+    try:
+        send_teams_message(os.getenv("TEAMS_WEBHOOK_URL"), title, message, error is None, perf_table(metrics.snapshot()))
+    except Exception as e:
+        print(f"Couldn't send the Teams notification: {type(e).__name__}: {e}")
+
+
+def main(args: argparse.Namespace, metrics: Metrics = None):
+    metrics = metrics or Metrics()
+    started = time.perf_counter()
     now = datetime.now(tz=UTC)
     lm = datetime.strptime(args.date, "%Y-%m-%dT%H:%M").replace(tzinfo=UTC)
     print(f"Now = {now.strftime('%Y-%m-%dT%H:%M')}. Searching for Knackly records last modified after {args.date}, which was {now - lm} ago.")
     log = initialize_logger()
     # Setup API credentials
     load_dotenv()
+    # MongoDB is connected to while Knackly is logged into and the catalogs are listed, instead of one after the other.
+    connecting = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo-connect")
+    connected = connecting.submit(connect_to_mongo, metrics)
+    connecting.shutdown(wait=False)
+    startup_cache = None
+    if not args.no_startup_cache:
+        scope = f"{os.getenv('KNACKLY_BASE_URL') or os.getenv('TENANCY')}|{os.getenv('KEY')}"
+        startup_cache = StartupCache(path=args.startup_cache, secret=os.getenv("SECRET") or "", scope=scope)
+    cache = None
+    if args.detail_cache:
+        cache = DetailCache(path=args.detail_cache, max_bytes=int(args.detail_cache_mb * 1024 * 1024), ttl_seconds=args.detail_cache_ttl_hours * 3600)
     knackly = KnacklyAPI(
         key_id=os.getenv("KEY"),
         secret=os.getenv("SECRET"),
         tenancy=os.getenv("TENANCY"),
+        rate_limiter=TokenBucket(rate=args.requests_per_second),
+        pool_size=args.pool_size,
+        max_retries=args.max_retries,
+        base_url=os.getenv("KNACKLY_BASE_URL"),
+        metrics=metrics,
+        cache=cache,
+        startup_cache=startup_cache,
+        catalogs_ttl=args.catalog_cache_minutes * 60,
     )
-    mongo_user = os.getenv("MONGO_USER")
-    mongo_pass = os.getenv("MONGO_PASSWORD")
-    mongo_cluster = os.getenv("MONGO_CLUSTER")
-    client = MongoClient(f"mongodb+srv://{mongo_user}:{mongo_pass}@{mongo_cluster}/?retryWrites=true&w=majority")
-    db = client["LightningDocs"]
-    collection = db["real_Records"]
-
     # Get a list of all catalogs available to this API key
     catalog_objects = knackly.get_available_catalogs()
     catalogs = [c["name"] for c in catalog_objects if "name" in c]
 
-    # Build a dictionary consisting of the key:value pairs record_id:record
-    # (record is itself a dictionary, containing metadata about the record and what catalog it came from)
-    log.debug(f"Collecting record metadata across {len(catalogs)} catalogs...")
-    record_id_map = {}
-    pbar = tqdm(catalogs, total=len(catalogs))
-    for c in pbar:
-        pbar.set_description(str(c).ljust(15))
-
-        records = knackly.get_records_in_catalog(
-            catalog=c,
-            status="Ok",
-            limit=1000,
-            last_modified={"c": "after", "v": f"{args.date}"},
-        )
-
-        # Break out of this iteration if there weren't any records found matching the various filters.
-        if len(records) == 0:
-            continue
-
-        # Inject the catalog into the metadata about each record, and then add this new record_id:record key:value pair into the map
-        for r in records:
-            r.update({"catalog": c})
-        record_id_map.update({r["id"]: r for r in records if "id" in r})
-
-        time.sleep(1)
-
-    # Using the record_id_map, create a subset for id's already in mongodb and a subset for id's not in mongodb.
-    record_ids = list(record_id_map.keys())
-    matching_docs = collection.find(filter={"record_id": {"$in": record_ids}}, projection=["record_id"])
-
-    matching_ids = {document["record_id"] for document in matching_docs if "record_id" in document}
-    non_matching_ids = set(record_ids) - matching_ids
-
-    # For each non-matching id: add it to mongodb
-    log.debug(f"Adding {len(non_matching_ids)} new documents to MongoDB...")
-    if non_matching_ids:
-        log.info(f"{'-' * 63}")
-        log.info(f"{'Record id'.ljust(23)} | {'Catalog'.ljust(20)} | Created Date")
-        log.info(f"{'-' * 63}")
-        for id in tqdm(non_matching_ids):
-            catalog = record_id_map[id].get("catalog")
-
-            record_details = knackly.get_record_details(id, catalog)
-            if len(record_details["apps"]) == 0:
-                log.warning(
-                    f"{str(id).ljust(23)} | {str(catalog).ljust(20)} | WARNING: Apps array was empty for this record. Not uploading anything to MongoDB."
-                )
-                continue
-            document = format_document(record_details, catalog)
-            result = collection.insert_one(document)
-            created_date = record_id_map[id].get("created")
-            log.info(f"{str(id).ljust(23)} | {str(catalog).ljust(20)} | {created_date}")
-
-            time.sleep(1)
-    log.info(f"{len(non_matching_ids)} id's found in Knackly that don't currently exist in MongoDB.")
-
-    # For each matching id: check if it was modified past what we have stored in mongodb
-    matching_ids_metadata = [r for r in record_id_map.values() if r.get("id") in matching_ids]
-    log.debug(f"Searching through {len(matching_ids)} existing id's for outdated documents to replace...")
-    modified_document_count = 0
-    heading_already_printed = False
-    pbar = tqdm(matching_ids_metadata)
-    for r in pbar:
-        pbar.set_description(f"{modified_document_count} documents replaced")
-        mongo_document = collection.find_one({"record_id": r.get("id")})
-        knackly_last_modified = datetime.strptime(r.get("lastModified"), "%Y-%m-%dT%H:%M:%S.%fZ")
-        mongo_last_modified = mongo_document.get("internally_modified")
-
-        if knackly_last_modified > (mongo_last_modified + timedelta(minutes=5)):
-            # Modify the document to make it conform to what MongoDB expects.
-            record_details = knackly.get_record_details(r.get("id"), catalog=r.get("catalog"))
-            responsible_app = guess_responsible_app(record_details.get("apps"))
-            mongo_apps = [e.get("app") for e in mongo_document.get("billing")]
-            if (responsible_app is not None) and (responsible_app not in mongo_apps):
-                add_to_billing_array(col=collection, record_id=record_details.get("id"), app_name=responsible_app)
-                log.info(f"Added the {responsible_app} app to the billing array for record: {r.get('id')} ({mongo_apps})")
-            add_to_timeline(
-                col=collection,
-                record_id=record_details.get("id"),
-                record_details=record_details,
-            )
-            new_internally_modified = datetime.fromisoformat(record_details.get("lastModified").replace("Z", "+00:00"))
-            update_internally_modified(col=collection, record_id=record_details.get("id"), new_time=new_internally_modified)
-            update_mongodb_modified(col=collection, record_id=record_details.get("id"))
-
-            modified_document_count += 1
-
-            # Log the heading information for this section
-            if not heading_already_printed:
-                heading_already_printed = True
-                log.info(f"{'-' * 117}")
-                log.info(
-                    f"{str('Record id').ljust(23)} | {str('Catalog').ljust(20)} | {'Knackly last modified'.ljust(26)} | {'Mongo last modified'.ljust(26)} | Difference"
-                )
-                log.info(f"{'-' * 117}")
+    db = connected.result()
+    collection = db["real_Records"]
+    history_collection = db[HISTORY_COLLECTION]
+    # A plan doesn't write anything, not even indexes. Documents migrated by `migrate_history.py` get their history written whatever
+    # --timeline-storage is, and those writes rely on the unique bucket index to stay idempotent.
+    if not args.plan:
+        ensure_history_indexes(history_collection)
+    for message in [] if args.plan else ensure_indexes(collection, state_col=db[STATE_COLLECTION], retry_unique=args.retry_unique_index):
+        log.info(message)
+    if not (args.no_explain or args.plan):
+        # Log how each query shape is served, so a missing index or a lookup that stopped being covered is easy to spot.
+        for shape, stats in explain_query_shapes(collection).items():
             log.info(
-                f"{r.get('id').ljust(23)} | {r.get('catalog').ljust(20)} | {str(knackly_last_modified).ljust(26)} | {str(mongo_last_modified).ljust(26)} | {knackly_last_modified - mongo_last_modified}"
+                f"explain {shape}: {' <- '.join(stats['stages'])} | keys examined {stats['keys_examined']} | docs examined {stats['docs_examined']}"
+                f" | returned {stats['returned']} | {stats['millis']}ms | covered: {stats['covered']}"
             )
 
-            time.sleep(1)
-    log.info(f"{modified_document_count} out of the {len(matching_ids)} matching documents were replaced with their latest versions.")
+    # Each catalog picks up from its own watermark (where the last run got to), unless a date was asked for explicitly.
+    tracker = WatermarkTracker(col=db[STATE_COLLECTION])
+    starts = tracker.load(catalogs=catalogs, default_start=lm)
+    if args.date_given:
+        starts = {c: lm for c in catalogs}
+    for c, start in starts.items():
+        log.debug(f"{str(c).ljust(20)} | listing records last modified after {start.strftime('%Y-%m-%dT%H:%M')}")
+    metrics.inc("phase_seconds", time.perf_counter() - started, phase="startup")
+
+    if args.plan:
+        with open(args.plan, "w", encoding="utf-8") as out:
+            planned = build_plan(
+                knackly=knackly,
+                collection=collection,
+                catalogs=catalogs,
+                starts=starts,
+                out=out,
+                page_size=args.page_size,
+                max_concurrent_pages=args.workers,
+                chunk_size=args.mongo_chunk_size,
+            )
+            cost = estimate_cost(planned, metrics, requests_per_second=args.requests_per_second, workers=args.workers)
+            write_summary(out, planned, cost, starts)
+        summary = (
+            f"Planned {planned[INSERT]} inserts and {planned[UPDATE]} timeline updates ({planned['up_to_date']} listed records are up to date) in {args.plan}. "
+            f"Applying it will take {cost['detail_calls']} detail calls and roughly {timedelta(seconds=cost['estimated_seconds'])}."
+        )
+        print(summary)
+        log.info(summary)
+        return
+
+    # Stream every recently modified record through the listing -> lookup -> fetch -> write pipeline.
+    def report_write_error(record_id: str, error: Exception) -> None:
+        log.error(f"{str(record_id).ljust(23)} | ERROR: {type(error).__name__}: {error}")
+
+    def commit_watermarks(record_ids: list[str]) -> None:
+        tracker.done(record_ids)
+        tracker.save()
+
+    writer = BulkWriter(
+        col=collection,
+        batch_size=args.write_batch_size,
+        flush_interval=args.flush_interval,
+        on_error=report_write_error,
+        on_commit=commit_watermarks,
+        snapshot_interval=args.snapshot_interval,
+        history_col=history_collection,
+        history_for_new_documents=args.timeline_storage == "history",
+        bucket_size=args.bucket_size,
+        timeline_format=args.timeline_format,
+    )
+
+    # Records whose details couldn't be fetched or formatted, from every pipeline in this run. The pipeline logs them itself.
+    record_errors = []
+
+    def new_pipeline() -> ReconciliationPipeline:
+        return ReconciliationPipeline(
+            knackly=knackly, collection=collection, args=args, log=log, starts=starts, tracker=tracker, metrics=metrics, on_error=lambda *error: record_errors.append(error)
+        )
+
+    if args.distributed:
+        leases = CatalogLeases(
+            col=db[COORDINATION_COLLECTION],
+            run_id=args.run_id,
+            worker_id=args.worker_id,
+            lease_duration=timedelta(seconds=args.lease_seconds),
+        )
+        counts = reconcile_leased_catalogs(leases=leases, catalogs=catalogs, new_pipeline=new_pipeline, writer=writer, tracker=tracker, log=log)
+    elif args.apply:
+        pipeline = new_pipeline()
+        pipeline.run(catalogs=plan_catalogs(args.apply), writer=writer, pages=iter_plan_pages(args.apply, page_size=args.page_size))
+        counts = pipeline.counts()
+    elif args.full:
+        pipeline = new_pipeline()
+        stats = reconcile_everything(knackly=knackly, collection=collection, catalogs=catalogs, pipeline=pipeline, writer=writer, args=args, log=log)
+        counts = pipeline.counts()
+        log.info(
+            f"Full reconciliation: {stats[MISSING]} missing, {stats[STALE]} stale, {stats[ORPHANED]} orphaned and {stats['up_to_date']} up to date documents "
+            f"({stats['duplicate']} ids listed twice, {stats['not_ok']} records skipped because their status isn't Ok)."
+        )
+    else:
+        pipeline = new_pipeline()
+        pipeline.run(catalogs=catalogs, writer=writer)
+        tracker.save()
+        counts = pipeline.counts()
+
+    for name, value in counts.items():
+        if name == "bytes_avoided":
+            metrics.inc("timeline_bytes_avoided_total", value)
+        else:
+            metrics.inc("records_total", value, outcome=name)
+    log.info(f"{counts['new']} id's found in Knackly that don't currently exist in MongoDB.")
+    if counts["deleted"]:
+        log.info(f"{counts['deleted']} records were deleted from Knackly before their details could be fetched.")
+    log.info(f"{counts['modified']} out of the {counts['matching']} matching documents were replaced with their latest versions.")
+    log.info(
+        f"{counts['unchanged']} outdated documents had no meaningful changes, so only their timestamps were updated. "
+        f"This avoided {counts['unchanged']} timeline writes totalling {counts['bytes_avoided']} bytes."
+    )
+    if cache is not None:
+        stats = cache.stats()
+        log.info(
+            f"Detail cache: {stats['hits']} hits and {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate, {stats['expired']} expired). "
+            f"{stats['evicted']} entries were evicted, and it holds {stats['size_bytes'] / 1e6:.1f} MB."
+        )
+        cache.close()
+
+    # Every record was still attempted, but a failed one should fail the run just like it used to.
+    if record_errors or writer.errors:
+        raise ExceptionGroup(
+            f"{len(record_errors)} records couldn't be fetched or formatted and {len(writer.errors)} writes to MongoDB failed", [e for _, e in record_errors + writer.errors]
+        )
 
 
 if __name__ == "__main__":
     args = parse_arguments()
     start_time = datetime.now()
-    main(args)
+    metrics = Metrics()
+    error = None
+    try:
+        main(args, metrics)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        write_metrics(metrics, args)
+        if args.notify_teams:
+            notify_teams(metrics, error, args.log_file)
     print(f"Script took roughly {datetime.now() - start_time} to complete.")
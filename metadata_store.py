@@ -0,0 +1,130 @@
+from array import array
+from datetime import UTC, datetime, timedelta
+
+# Listed timestamps are kept as microseconds since this epoch in typed arrays, instead of as one string or datetime per record.
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+MICROSECOND = timedelta(microseconds=1)
+
+# Stands in for a record that was listed without a lastModified. It is older than anything in MongoDB, so it never counts as outdated.
+NO_TIME = -(2**63)
+
+
+def knackly_epoch(value: str) -> int:
+    """Parses a Knackly timestamp (such as `2024-07-01T12:34:56.789Z`) into microseconds since the Unix epoch, or NO_TIME if there isn't one."""
+    if not value:
+        return NO_TIME
+    return (datetime.fromisoformat(value.replace("Z", "+00:00")) - EPOCH) // MICROSECOND
+
+
+def epoch_of(value: datetime) -> int:
+    """Microseconds since the Unix epoch for a datetime. Naive datetimes, which is how pymongo returns them, are taken to be UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return (value - EPOCH) // MICROSECOND
+
+
+def from_epoch(value: int) -> datetime:
+    """The timezone aware datetime for microseconds since the Unix epoch, or None for NO_TIME."""
+    if value == NO_TIME:
+        return None
+    return EPOCH + value * MICROSECOND
+
+
+class CatalogTable:
+    """Interns catalog names as small ints, so that a record carries 4 bytes for its catalog instead of a reference to a string."""
+
+    __slots__ = ("names", "index")
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+
+    def intern(self, name: str) -> int:
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def name(self, i: int) -> str:
+        return self.names[i]
+
+
+class MetadataPage:
+    """One page of listed records from a single catalog, kept as columns instead of one dict per record.
+    Only what the reconciliation reads is kept: the id, lastModified (pre-parsed), created (for the log), and whether the record is known to have changed.
+    """
+
+    __slots__ = ("catalog", "ids", "last_modified", "created", "changed")
+
+    def __init__(self, catalog: int, records: list[dict]):
+        """
+        Args:
+            catalog (int): The catalog's index in a `CatalogTable`.
+            records (list[dict]): The records as Knackly listed them. Records without an id are dropped.
+        """
+        records = [r for r in records if "id" in r]
+        self.catalog = catalog
+        self.ids = [r["id"] for r in records]
+        self.last_modified = array("q", [knackly_epoch(r.get("lastModified")) for r in records])
+        self.created = [r.get("created") for r in records]
+        self.changed = bytearray(bool(r.get("changed")) for r in records)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class MetadataBatch:
+    """The listed records that go into one MongoDB lookup, gathered from one or more pages into the same columns."""
+
+    __slots__ = ("ids", "catalogs", "last_modified", "created", "changed", "seen")
+
+    def __init__(self):
+        self.ids = []
+        self.catalogs = array("I")
+        self.last_modified = array("q")
+        self.created = []
+        self.changed = bytearray()
+        self.seen = set()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, page: MetadataPage) -> None:
+        """Adds a page's records. A record that is already in the batch keeps its first listing."""
+        if self.seen.isdisjoint(page.ids):
+            self.ids.extend(page.ids)
+            self.catalogs.extend([page.catalog] * len(page))
+            self.last_modified.extend(page.last_modified)
+            self.created.extend(page.created)
+            self.changed.extend(page.changed)
+            self.seen.update(page.ids)
+            return
+        for i, record_id in enumerate(page.ids):
+            if record_id not in self.seen:
+                self.seen.add(record_id)
+                self.ids.append(record_id)
+                self.catalogs.append(page.catalog)
+                self.last_modified.append(page.last_modified[i])
+                self.created.append(page.created[i])
+                self.changed.append(page.changed[i])
+
+    def split(self, existing: dict[str, dict], tolerance: timedelta) -> tuple[list[int], list[int], list[int]]:
+        """Splits the batch into new, outdated and up to date records, by comparing the whole lastModified column
+        against the matching `internally_modified` values from MongoDB in one pass.
+
+        Args:
+            existing (dict[str, dict]): The documents that already exist, as returned by `find_existing_documents`.
+            tolerance (timedelta): How far past internally_modified lastModified has to be for a document to count as outdated.
+
+        Returns:
+            tuple[list[int], list[int], list[int]]: The positions in the batch of the new, outdated and up to date records.
+        """
+        documents = [existing.get(record_id) for record_id in self.ids]
+        threshold = array("q", [NO_TIME if d is None else epoch_of(d["internally_modified"]) + tolerance // MICROSECOND for d in documents])
+        # A record that is known to have changed (such as one named by a webhook event) skips the comparison.
+        outdated_mask = [c or k > t for k, t, c in zip(self.last_modified, threshold, self.changed)]
+        new, outdated, up_to_date = [], [], []
+        for i, (d, o) in enumerate(zip(documents, outdated_mask)):
+            (new if d is None else outdated if o else up_to_date).append(i)
+        return new, outdated, up_to_date
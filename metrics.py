@@ -0,0 +1,218 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import UTC, datetime
+
+from pymongo import monitoring
+
+# Every metric is exported with this prefix.
+PREFIX = "double_checker"
+
+# Upper bounds (in seconds) of the latency histogram buckets. Anything slower lands in the +Inf bucket.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The MongoDB write commands, and the field of each that holds the documents (or update and delete statements) it sends.
+WRITE_COMMANDS = {"insert": "documents", "update": "updates", "delete": "deletes"}
+
+
+class Histogram:
+    """Counts observations into fixed buckets, the same way a Prometheus histogram does."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile as the upper bound of the bucket it falls in (or the largest bound, for the +Inf bucket)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Collects the job's counters, timings and latency histograms, and exports them as JSON or as a Prometheus textfile.
+    Safe to use from every thread. Metrics are identified by a name plus optional labels, such as `phase="inserts"`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Adds to a counter."""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Adds an observation to a histogram."""
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Adds the wall time that the block takes to a counter."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """Everything that has been collected so far, as plain JSON-friendly data."""
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.5),
+                    "p99": h.quantile(0.99),
+                    "buckets": dict(zip([*map(str, h.buckets), "+Inf"], h.counts)),
+                }
+                for (name, labels), h in sorted(self.histograms.items())
+            ]
+        return {
+            "generated": datetime.now(tz=UTC).isoformat(),
+            "run_seconds": time.monotonic() - self.started,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the metrics in the Prometheus text format, for node_exporter's textfile collector.
+        The file is written next to its final name first and then renamed, so the collector never reads half of it."""
+
+        def labels_text(labels: dict, **extra) -> str:
+            labels = {**labels, **extra}
+            if not labels:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {PREFIX}_run_seconds gauge", f"{PREFIX}_run_seconds {snapshot['run_seconds']}"]
+        typed = set()
+        for c in snapshot["counters"]:
+            name = f"{PREFIX}_{c['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{labels_text(c['labels'])} {c['value']}")
+        for h in snapshot["histograms"]:
+            name = f"{PREFIX}_{h['name']}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in h["buckets"].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{labels_text(h['labels'], le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{labels_text(h['labels'])} {h['sum']}")
+            lines.append(f"{name}_count{labels_text(h['labels'])} {h['count']}")
+
+        with open(f"{path}.tmp", "w", encoding="utf-8", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Counts every MongoDB round trip, times it, and counts how many documents each write command sent.
+    Time spent in insert and update commands is also added to the `inserts` and `updates` phases."""
+
+    PHASES = {"insert": "inserts", "update": "updates"}
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        # Only the length of the batch, which is already at hand; encoding the command again to measure it would double the cost of every bulk write.
+        if event.command_name in WRITE_COMMANDS:
+            self.metrics.inc("mongo_documents_written_total", len(event.command.get(WRITE_COMMANDS[event.command_name], ())), command=event.command_name)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event.command_name, event.duration_micros / 1e6, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event.command_name, event.duration_micros / 1e6, "failed")
+
+    def _finished(self, command: str, seconds: float, outcome: str) -> None:
+        self.metrics.inc("mongo_round_trips_total", command=command, outcome=outcome)
+        self.metrics.observe("mongo_command_seconds", seconds, command=command)
+        if command in self.PHASES:
+            self.metrics.inc("phase_seconds", seconds, phase=self.PHASES[command])
+
+
+def find(snapshot: dict, kind: str, name: str, **labels) -> list[dict]:
+    """Picks the counters or histograms with a given name (and labels) out of a snapshot."""
+    return [m for m in snapshot[kind] if m["name"] == name and all(m["labels"].get(k) == v for k, v in labels.items())]
+
+
+def perf_table(snapshot: dict, slowest_catalogs: int = 3) -> list[tuple[str, str]]:
+    """Boils a metrics snapshot down to a few lines for the Teams notification.
+
+    Returns:
+        list[tuple[str, str]]: (title, value) pairs.
+    """
+
+    def total(name: str, **labels) -> float:
+        return sum(m["value"] for m in find(snapshot, "counters", name, **labels))
+
+    rows = [("Run time", f"{snapshot['run_seconds']:.1f}s")]
+    phases = " | ".join(f"{m['labels']['phase']} {m['value']:.1f}s" for m in find(snapshot, "counters", "phase_seconds"))
+    if phases:
+        rows.append(("Phases", phases))
+
+    calls = find(snapshot, "histograms", "knackly_request_seconds")
+    if calls:
+        latencies = ", ".join(
+            f"{h['labels']['call']} {h['count']} (p50 {1000 * h['p50']:.0f}ms, p99 {1000 * h['p99']:.0f}ms)" for h in sorted(calls, key=lambda h: -h["count"])
+        )
+        rows.append(("Knackly calls", f"{sum(h['count'] for h in calls)}: {latencies}"))
+        cache_hits = total("detail_cache_total", result="hit")
+        cache_lookups = total("detail_cache_total")
+        if cache_lookups:
+            rows.append(("Detail cache", f"{cache_hits:.0f} of {cache_lookups:.0f} hits ({cache_hits / cache_lookups:.0%})"))
+        throttled = total("knackly_requests_total", status="429")
+        if throttled:
+            rows.append(("Knackly 429s", f"{throttled:.0f}"))
+
+    round_trips = total("mongo_round_trips_total")
+    if round_trips:
+        rows.append(("MongoDB round trips", f"{round_trips:.0f} ({total('mongo_documents_written_total'):.0f} documents written)"))
+
+    catalogs = sorted(find(snapshot, "counters", "catalog_listing_seconds"), key=lambda m: -m["value"])[:slowest_catalogs]
+    if catalogs:
+        rows.append(("Slowest catalogs", ", ".join(f"{m['labels']['catalog']} {m['value']:.1f}s" for m in catalogs)))
+    return rows
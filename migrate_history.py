@@ -0,0 +1,152 @@
+import argparse
+import time
+from datetime import UTC, datetime
+
+import bson
+from dotenv import load_dotenv
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+from tqdm import tqdm
+
+from logger import initialize_logger
+from mongo_db import HISTORY_COLLECTION, ensure_history_indexes, get_database
+from timeline import encode_timeline, rebuild
+from watermarks import STATE_COLLECTION
+
+# The state document that remembers how far the migration got, so that it can pick up from there.
+PROGRESS_ID = "migration:history"
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the migration settings
+    """
+    parser = argparse.ArgumentParser(description="Moves the timelines of existing real_Records documents into bucketed documents in the history collection.")
+    parser.add_argument("--batch-size", type=int, default=100, help="how many documents to move per batch. Defaults to 100")
+    parser.add_argument("--bucket-size", type=int, default=100, help="how many timeline entries each history bucket holds. Defaults to 100")
+    parser.add_argument(
+        "--timeline-format",
+        choices=["full", "delta"],
+        default="full",
+        help="`full` moves the timeline entries as they are, `delta` re-encodes them into the delta format on the way. Defaults to full",
+    )
+    parser.add_argument("--snapshot-interval", type=int, default=10, help="how many timeline entries there are per full snapshot with --timeline-format delta. Defaults to 10")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many documents. Defaults to 0, meaning no limit")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved progress and scan the collection from the beginning")
+    args = parser.parse_args()
+    for name in ("batch_size", "bucket_size", "snapshot_interval"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1. received: {getattr(args, name)}")
+    return args
+
+
+def migrate_batch(col: Collection, history_col: Collection, documents: list[dict], args: argparse.Namespace) -> dict:
+    """Moves one batch of documents' timelines into the history collection.
+
+    Buckets are written with upserting replaces, so a batch that gets interrupted can simply be run again.
+    Each main document is only switched over if its timeline still has the length it was read with,
+    so an entry pushed by a running job in the meantime is never lost.
+
+    Returns:
+        dict: How many documents were moved, and how many timeline bytes were moved out of the main collection.
+    """
+    history_operations = []
+    operations = []
+    moved_bytes = 0
+    for document in documents:
+        timeline = document.get("timeline", [])
+        entries = encode_timeline(timeline, args.snapshot_interval) if args.timeline_format == "delta" else timeline
+        moved_bytes += len(bson.encode({"timeline": timeline}))
+
+        for bucket, start in enumerate(range(0, len(entries), args.bucket_size)):
+            bucket_entries = entries[start : start + args.bucket_size]
+            history_operations.append(
+                ReplaceOne(
+                    {"record_id": document["record_id"], "bucket": bucket},
+                    {"record_id": document["record_id"], "bucket": bucket, "count": len(bucket_entries), "entries": bucket_entries},
+                    upsert=True,
+                )
+            )
+        pointer = {"collection": history_col.name, "entries": len(entries), "bucket_size": args.bucket_size}
+        unchanged = {"$size": len(timeline)} if "timeline" in document else {"$exists": False}
+        operations.append(
+            UpdateOne(
+                {"_id": document["_id"], "timeline": unchanged},
+                {
+                    "$set": {"history": pointer, "latest": rebuild(timeline) if timeline else None},
+                    "$unset": {"timeline": "", "timeline_format": ""},
+                },
+            )
+        )
+
+    if history_operations:
+        history_col.bulk_write(history_operations, ordered=False)
+    moved = col.bulk_write(operations, ordered=False).modified_count if operations else 0
+    return {"moved": moved, "bytes": moved_bytes}
+
+
+def migrate(col: Collection, history_col: Collection, state_col: Collection, args: argparse.Namespace) -> dict:
+    """Moves every document that still has an embedded timeline over to the history collection, one batch at a time.
+    After every batch where all documents were moved, the last `_id` is saved so that the next run can start after it.
+
+    Returns:
+        dict: Counts of the documents that were examined and moved, and how many bytes were moved.
+    """
+    query = {"history": {"$exists": False}, "record_id": {"$exists": True}}
+    progress = None if args.restart else state_col.find_one({"_id": PROGRESS_ID})
+    if progress:
+        query["_id"] = {"$gt": progress["last_id"]}
+
+    cursor = col.find(query, projection={"record_id": 1, "timeline": 1}, batch_size=args.batch_size).sort("_id", 1)
+    if args.limit:
+        cursor = cursor.limit(args.limit)
+
+    stats = {"documents": 0, "moved": 0, "bytes": 0, "retry": 0}
+    batch = []
+
+    def run_batch() -> None:
+        result = migrate_batch(col, history_col, batch, args)
+        stats["documents"] += len(batch)
+        stats["moved"] += result["moved"]
+        stats["bytes"] += result["bytes"]
+        if result["moved"] < len(batch):
+            # Something was written to one of these documents in the meantime. Don't save progress past them, so they get picked up again.
+            stats["retry"] += len(batch) - result["moved"]
+        elif stats["retry"] == 0:
+            state_col.update_one({"_id": PROGRESS_ID}, {"$set": {"last_id": batch[-1]["_id"], "updated": datetime.now(tz=UTC)}}, upsert=True)
+        batch.clear()
+
+    for document in tqdm(cursor, unit=" documents"):
+        batch.append(document)
+        if len(batch) >= args.batch_size:
+            run_batch()
+    if batch:
+        run_batch()
+    return stats
+
+
+def main(args: argparse.Namespace):
+    log = initialize_logger()
+    load_dotenv()
+    db = get_database()
+    history_collection = db[HISTORY_COLLECTION]
+    ensure_history_indexes(history_collection)
+
+    start_time = time.monotonic()
+    stats = migrate(col=db["real_Records"], history_col=history_collection, state_col=db[STATE_COLLECTION], args=args)
+    elapsed = time.monotonic() - start_time
+
+    def report(message: str) -> None:
+        print(message)
+        log.info(message)
+
+    report(f"Examined {stats['documents']} documents and moved {stats['moved']} of them in {elapsed:.1f}s ({stats['documents'] / max(elapsed, 1e-9):.1f} documents/s).")
+    report(f"Moved {stats['bytes']} bytes of timeline out of real_Records ({stats['bytes'] / max(elapsed, 1e-9) / 1e6:.2f} MB/s).")
+    if stats["retry"]:
+        report(f"{stats['retry']} documents changed while they were being moved. Run the migration again to pick them up.")
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -1,16 +1,70 @@
+import hashlib
+import json
+import os
+import time
+from collections.abc import Callable
 from datetime import UTC, datetime
 
+from pymongo import InsertOne, MongoClient, UpdateOne
 from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 
 from knackly_api import guess_responsible_app
+from timeline import SNAPSHOT, encode_entry, encode_entry_at, rebuild
 
 
-def format_document(record_details: dict, catalog: str) -> dict:
+def get_database(event_listeners: list = None) -> Database:
+    """Connects to the LightningDocs database using the MONGO_USER, MONGO_PASSWORD and MONGO_CLUSTER environment variables.
+    If MONGO_URI is set, it is used as the connection string instead (such as a local mongod for the benchmarks),
+    and MONGO_DATABASE can name a different database.
+
+    Args:
+        event_listeners (list, optional): pymongo monitoring listeners to register on the client, such as `MongoCommandMetrics`. Defaults to None.
+
+    Returns:
+        Database: The pymongo database object.
+    """
+    uri = os.getenv("MONGO_URI")
+    if not uri:
+        mongo_user = os.getenv("MONGO_USER")
+        mongo_pass = os.getenv("MONGO_PASSWORD")
+        mongo_cluster = os.getenv("MONGO_CLUSTER")
+        uri = f"mongodb+srv://{mongo_user}:{mongo_pass}@{mongo_cluster}/?retryWrites=true&w=majority"
+    client = MongoClient(uri, event_listeners=event_listeners or [])
+    return client[os.getenv("MONGO_DATABASE") or "LightningDocs"]
+
+
+# Where timeline entries go when they are stored outside of the main documents (see `BulkWriter`'s history_col).
+HISTORY_COLLECTION = "real_Records_history"
+
+
+# The parts of a Knackly record that count as a real change. Knackly also bumps lastModified for changes outside of these.
+CONTENT_HASH_FIELDS = ("data", "apps")
+
+
+def content_hash(record_details: dict) -> str:
+    """Computes a canonical hash of the meaningful fields of a Knackly record, so that identical snapshots can be recognized.
+
+    Args:
+        record_details (dict): The results from calling the `get_record_details` method from the KnacklyAPI class.
+
+    Returns:
+        str: A hex encoded sha256 digest that doesn't depend on key order.
+    """
+    content = {field: record_details.get(field) for field in CONTENT_HASH_FIELDS}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def format_document(record_details: dict, catalog: str, timeline_format: str = "full") -> dict:
     """Formats a raw Knackly record into the MongoDB structure that we expect.
 
     Args:
         record_details (dict): The results from calling the `get_record_details` method from the KnacklyAPI class.
         catalog (str): The name of the catalog that this record came from
+        timeline_format (str, optional): "full" to store every timeline entry as a full copy of the record,
+            or "delta" to store full snapshots with field-level diffs in between (see timeline.py). Defaults to "full".
 
     Returns:
         dict: The slightly modified Knackly record
@@ -34,6 +88,7 @@ def format_document(record_details: dict, catalog: str) -> dict:
         "record_id": record_details.get("id"),
         "internally_modified": datetime.fromisoformat(record_details.get("lastModified").replace("Z", "+00:00")),
         "mongodb_modified": datetime.now(tz=UTC),
+        "content_hash": content_hash(record_details),
     }
 
     # Come up with an educated guess for what the responsible_app should be
@@ -46,7 +101,11 @@ def format_document(record_details: dict, catalog: str) -> dict:
     # Inject the responsible_app into the record details,
     # and then inject the record_details into the timeline array.
     record_details["responsible_app"] = responsible_app
-    document["timeline"].append(record_details)
+    if timeline_format == "delta":
+        document["timeline_format"] = "delta"
+        document["timeline"].append({"_kind": SNAPSHOT, "record": record_details})
+    else:
+        document["timeline"].append(record_details)
 
     # Fill the billing array (potentially)
     data = record_details["data"]
@@ -73,7 +132,8 @@ def add_to_timeline(
     record_details["responsible_app"] = responsible_app
 
     # If a document with the provided record_id cannot be found, throw an error
-    result = col.find_one_and_update({"record_id": record_id}, {"$push": {"timeline": record_details}})
+    update = {"$push": {"timeline": record_details}, "$set": {"content_hash": content_hash(record_details)}}
+    result = col.find_one_and_update({"record_id": record_id}, update)
     if not result:
         raise ReferenceError(f"could not find a document in {col.full_name} with the record id: {record_id}")
 
@@ -110,6 +170,586 @@ def add_to_billing_array(col: Collection, record_id: str, app_name: str) -> None
         raise ReferenceError(f"could not find a document in {col.full_name} with the record id: {record_id}")
 
 
+# The projection used by the existence/staleness lookup. Together with the (record_id, internally_modified) index,
+# it lets MongoDB answer that lookup from the index alone (a covered query), without reading any documents.
+EXISTENCE_PROJECTION = {"_id": 0, "record_id": 1, "internally_modified": 1}
+
+# The projection used for outdated documents only: everything else that's needed to write their update.
+OUTDATED_PROJECTION = {"_id": 0, "record_id": 1, "billing.app": 1, "content_hash": 1, "history": 1}
+
+
+def find_existing_documents(col: Collection, record_ids: list[str], chunk_size: int = 1000) -> dict[str, dict]:
+    """Looks up which of the given record ids already have a document, and when each of them was last modified.
+    The ids are sent in chunks of `chunk_size` per `$in` query, and only `record_id` and `internally_modified` are projected,
+    so the query is covered by the (record_id, internally_modified) index that `ensure_indexes` creates.
+
+    Args:
+        col (Collection): The pymongo collection object
+        record_ids (list[str]): The ids of the records to look for
+        chunk_size (int, optional): How many ids to send per query. Defaults to 1000.
+
+    Returns:
+        dict[str, dict]: A mapping of record_id to {"internally_modified": datetime} for every id that was found.
+    """
+    existing = {}
+    for i in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[i : i + chunk_size]
+        for document in col.find(filter={"record_id": {"$in": chunk}}, projection=EXISTENCE_PROJECTION):
+            if "record_id" not in document:
+                continue
+            existing[document["record_id"]] = {"internally_modified": document.get("internally_modified")}
+    return existing
+
+
+def find_outdated_details(col: Collection, record_ids: list[str], chunk_size: int = 1000) -> dict[str, dict]:
+    """Fetches what's needed to update documents that were found to be outdated: `billing.app`, `content_hash` and `history`.
+    The timeline array is never projected.
+
+    Args:
+        col (Collection): The pymongo collection object
+        record_ids (list[str]): The ids of the outdated records
+        chunk_size (int, optional): How many ids to send per query. Defaults to 1000.
+
+    Returns:
+        dict[str, dict]: A mapping of record_id to {"billing_apps": list[str], "content_hash": str, "history": dict}.
+            `content_hash` is None for documents written before content hashes existed,
+            and `history` is None unless the document keeps its timeline in the history collection.
+    """
+    details = {}
+    for i in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[i : i + chunk_size]
+        for document in col.find(filter={"record_id": {"$in": chunk}}, projection=OUTDATED_PROJECTION):
+            details[document["record_id"]] = {
+                "billing_apps": [e.get("app") for e in document.get("billing", [])],
+                "content_hash": document.get("content_hash"),
+                "history": document.get("history"),
+            }
+    return details
+
+
+# Where a failed build of the unique record_id index is recorded, in the state collection, so it isn't attempted again on every start.
+UNIQUE_INDEX_STATE_ID = "index:record_id_unique"
+
+# How many of the duplicated record ids are listed when the unique index can't be built.
+MAX_DUPLICATES_LISTED = 20
+
+
+def find_duplicate_record_ids(col: Collection, limit: int = MAX_DUPLICATES_LISTED) -> list[str]:
+    """Returns up to `limit` record ids that more than one document has. This reads the whole collection, so it is only run once the unique index has failed."""
+    pipeline = [{"$group": {"_id": "$record_id", "count": {"$sum": 1}}}, {"$match": {"count": {"$gt": 1}}}, {"$limit": limit}]
+    return [d["_id"] for d in col.aggregate(pipeline, allowDiskUse=True)]
+
+
+def ensure_indexes(col: Collection, state_col: Collection = None, retry_unique: bool = False) -> list[str]:
+    """Makes sure that every query the job sends can use an index:
+    a unique index on `record_id` (which every lookup and update filters on), and a compound index on
+    (`record_id`, `internally_modified`) that covers the existence/staleness lookup.
+
+    An index that already exists on the same keys and with the same uniqueness (under any name) is left alone. One with the same keys
+    but different uniqueness can't be replaced without dropping it, so a warning is returned instead.
+    If the unique index can't be built because of duplicate record ids, the failure and some of the duplicated ids are recorded in `state_col`,
+    and later calls only warn about it instead of building it again, until `retry_unique` is set. The compound index still serves the lookups.
+
+    Args:
+        col (Collection): The pymongo collection object
+        state_col (Collection, optional): Where a failed unique index build is recorded. If None, it is tried on every call. Defaults to None.
+        retry_unique (bool, optional): Whether to try the unique index again even if it failed before. Defaults to False.
+
+    Returns:
+        list[str]: A message for every index that was created, or couldn't be.
+    """
+    wanted = [
+        ([("record_id", 1)], {"name": "record_id_unique", "unique": True}),
+        ([("record_id", 1), ("internally_modified", 1)], {"name": "record_id_internally_modified"}),
+    ]
+    existing = {tuple(info["key"]): bool(info.get("unique")) for info in col.index_information().values()}
+    messages = []
+    for keys, options in wanted:
+        unique = options.get("unique", False)
+        if tuple(keys) in existing:
+            if existing[tuple(keys)] != unique:
+                messages.append(
+                    f"WARNING: {col.full_name} already has an index on {', '.join(k for k, _ in keys)} that is {'not ' if unique else ''}unique. "
+                    f"Drop it so that the {options['name']} index can be created."
+                )
+            continue
+        if unique and state_col is not None and not retry_unique:
+            failure = state_col.find_one({"_id": UNIQUE_INDEX_STATE_ID})
+            if failure is not None:
+                messages.append(
+                    f"WARNING: the {options['name']} index on {col.full_name} could not be created on {failure['failed']:%Y-%m-%d} because these record ids "
+                    f"are duplicated: {', '.join(failure['duplicates'])}. Remove the duplicates and run with --retry-unique-index to try again."
+                )
+                continue
+        try:
+            col.create_index(keys, **options)
+            messages.append(f"Created the {options['name']} index on {col.full_name}.")
+            if unique and state_col is not None:
+                state_col.delete_one({"_id": UNIQUE_INDEX_STATE_ID})
+        except (DuplicateKeyError, OperationFailure) as e:
+            messages.append(f"WARNING: could not create the {options['name']} index on {col.full_name}: {e}")
+            duplicates = find_duplicate_record_ids(col) if unique else []
+            if duplicates and state_col is not None:
+                state_col.replace_one(
+                    {"_id": UNIQUE_INDEX_STATE_ID},
+                    {"failed": datetime.now(tz=UTC), "error": str(e), "duplicates": [str(d) for d in duplicates]},
+                    upsert=True,
+                )
+                messages.append(f"These record ids are duplicated (showing at most {MAX_DUPLICATES_LISTED}): {', '.join(str(d) for d in duplicates)}")
+    return messages
+
+
+def summarize_explain(explain: dict) -> dict:
+    """Pulls the interesting numbers out of the output of `explain()`.
+
+    Args:
+        explain (dict): The output of `Cursor.explain()`.
+
+    Returns:
+        dict: The stages of the winning plan, the keys and documents examined, the documents returned, the time taken,
+            and whether the query was covered (answered from an index without reading any documents).
+    """
+    stages = []
+
+    def walk(stage: dict) -> None:
+        if "stage" in stage:
+            stages.append(stage["stage"])
+        for key in ("queryPlan", "inputStage"):
+            if isinstance(stage.get(key), dict):
+                walk(stage[key])
+        for child in stage.get("inputStages", []):
+            walk(child)
+
+    walk(explain.get("queryPlanner", {}).get("winningPlan", {}))
+    stats = explain.get("executionStats", {})
+    summary = {
+        "stages": stages,
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned"),
+        "millis": stats.get("executionTimeMillis"),
+    }
+    summary["covered"] = "COLLSCAN" not in stages and summary["docs_examined"] == 0 and bool(summary["returned"])
+    return summary
+
+
+def explain_query_shapes(col: Collection, sample_size: int = 100) -> dict[str, dict]:
+    """Runs `explain()` on each shape of query that the job sends, using a sample of real record ids,
+    so that a missing index or a lookup that stopped being covered shows up in the logs.
+
+    Args:
+        col (Collection): The pymongo collection object
+        sample_size (int, optional): How many record ids to use in the `$in` lookups. Defaults to 100.
+
+    Returns:
+        dict[str, dict]: A mapping of query shape name to its `summarize_explain` stats. Empty if the collection has no documents yet.
+    """
+    sample = [d["record_id"] for d in col.find({"record_id": {"$exists": True}}, projection=EXISTENCE_PROJECTION).limit(sample_size)]
+    if not sample:
+        return {}
+    shapes = {
+        "existence lookup": col.find({"record_id": {"$in": sample}}, projection=EXISTENCE_PROJECTION),
+        "outdated details": col.find({"record_id": {"$in": sample}}, projection=OUTDATED_PROJECTION),
+        "update by record_id": col.find({"record_id": sample[0]}, projection={"_id": 1}),
+    }
+    return {name: summarize_explain(cursor.explain()) for name, cursor in shapes.items()}
+
+
+def build_record_update(
+    record_details: dict,
+    billing_app: str = None,
+    timeline_tail: list[dict] = None,
+    snapshot_interval: int = 10,
+    in_history: bool = False,
+) -> dict:
+    """Builds a single update document that does everything `add_to_billing_array`, `add_to_timeline`,
+    `update_internally_modified` and `update_mongodb_modified` would do for one record, so it can be sent in one round-trip.
+
+    Args:
+        record_details (dict): The results from calling the `get_record_details` method from the KnacklyAPI class.
+        billing_app (str, optional): The name of an app to add to the billing array. Defaults to None, which leaves the billing array alone.
+        timeline_tail (list[dict], optional): The last `snapshot_interval` entries of the document's timeline (see `find_timeline_tails`).
+            When given, the new entry is delta encoded against them. Defaults to None, which pushes a full copy of the record.
+        snapshot_interval (int, optional): How many timeline entries there are per full snapshot in the delta format. Defaults to 10.
+        in_history (bool, optional): Whether the document keeps its timeline in the history collection. If so, the timeline entry is left
+            for the caller to write there, and the document's latest snapshot and entry count are updated instead. Defaults to False.
+
+    Returns:
+        dict: A MongoDB update document.
+    """
+    record_hash = content_hash(record_details)
+    record_details["responsible_app"] = guess_responsible_app(record_details["apps"])
+    update = {
+        "$push": {},
+        "$set": {
+            "internally_modified": datetime.fromisoformat(record_details.get("lastModified").replace("Z", "+00:00")),
+            "mongodb_modified": datetime.now(tz=UTC),
+            "content_hash": record_hash,
+        },
+    }
+    if in_history:
+        update["$set"]["latest"] = record_details
+        update["$inc"] = {"history.entries": 1}
+    elif timeline_tail is not None:
+        update["$push"]["timeline"] = encode_entry(timeline_tail, record_details, snapshot_interval)
+    else:
+        update["$push"]["timeline"] = record_details
+    if billing_app is not None:
+        update["$push"]["billing"] = {"app": billing_app, "billed": None}
+    if not update["$push"]:
+        del update["$push"]
+    return update
+
+
+def split_into_buckets(entries: list[dict], first_position: int, bucket_size: int) -> list[tuple[int, int, list[dict]]]:
+    """Splits timeline entries by the history bucket they belong in. Entry number `n` always lives in bucket `n // bucket_size`.
+
+    Returns:
+        list[tuple[int, int, list[dict]]]: (bucket, how many entries the bucket holds before these, the entries) for every bucket touched.
+    """
+    buckets = {}
+    for position, entry in enumerate(entries, start=first_position):
+        buckets.setdefault(position // bucket_size, (position % bucket_size, []))[1].append(entry)
+    return [(bucket, start, bucket_entries) for bucket, (start, bucket_entries) in buckets.items()]
+
+
+def history_updates(record_id: str, entries: list[dict], first_position: int, bucket_size: int) -> list[UpdateOne]:
+    """Builds the writes that append timeline entries to a record's buckets in the history collection.
+    Buckets are created the first time something is pushed onto them.
+
+    Each write only applies while its bucket holds exactly the entries that come before the new ones, so an entry can't be pushed twice,
+    or at a position that another writer already filled. Otherwise the upsert runs into the unique (record_id, bucket) index
+    from `ensure_history_indexes` and fails with a duplicate key error, which `BulkWriter` checks and reports.
+
+    Args:
+        record_id (str): The id of the particular record
+        entries (list[dict]): The timeline entries to append, oldest first
+        first_position (int): The index in the timeline of the first entry
+        bucket_size (int): How many entries each bucket holds
+
+    Returns:
+        list[UpdateOne]: One upsert per bucket touched, to be sent to the history collection.
+    """
+    return [
+        UpdateOne(
+            {"record_id": record_id, "bucket": bucket, "count": start},
+            {"$push": {"entries": {"$each": bucket_entries}}, "$inc": {"count": len(bucket_entries)}},
+            upsert=True,
+        )
+        for bucket, start, bucket_entries in split_into_buckets(entries, first_position, bucket_size)
+    ]
+
+
+def ensure_history_indexes(history_col: Collection) -> None:
+    """Makes sure the history collection can find (and upsert) a record's buckets without a collection scan."""
+    history_col.create_index([("record_id", 1), ("bucket", 1)], unique=True, name="record_id_bucket")
+
+
+def read_history(history_col: Collection, record_id: str) -> list[dict]:
+    """Reads every timeline entry of a record from its buckets in the history collection, oldest first."""
+    buckets = history_col.find({"record_id": record_id}, projection={"_id": 0, "entries": 1}).sort("bucket", 1)
+    return [entry for bucket in buckets for entry in bucket.get("entries", [])]
+
+
+def find_timeline_tails(col: Collection, record_ids: list[str], count: int, chunk_size: int = 1000) -> dict[str, list[dict]]:
+    """Fetches only the last `count` entries of each document's timeline, which is all that is needed to delta encode the next entry.
+
+    Args:
+        col (Collection): The pymongo collection object
+        record_ids (list[str]): The ids of the records to look for
+        count (int): How many of the newest timeline entries to return per document
+        chunk_size (int, optional): How many ids to send per query. Defaults to 1000.
+
+    Returns:
+        dict[str, list[dict]]: A mapping of record_id to the end of its timeline.
+    """
+    tails = {}
+    for i in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[i : i + chunk_size]
+        projection = {"_id": 0, "record_id": 1, "timeline": {"$slice": -count}}
+        for document in col.find(filter={"record_id": {"$in": chunk}}, projection=projection):
+            tails[document["record_id"]] = document.get("timeline", [])
+    return tails
+
+
+def find_latest_snapshots(col: Collection, record_ids: list[str], chunk_size: int = 1000) -> dict[str, dict]:
+    """Fetches the latest snapshot kept on documents whose timeline lives in the history collection,
+    which is what the next history entry is delta encoded against.
+
+    Args:
+        col (Collection): The pymongo collection object
+        record_ids (list[str]): The ids of the records to look for
+        chunk_size (int, optional): How many ids to send per query. Defaults to 1000.
+
+    Returns:
+        dict[str, dict]: A mapping of record_id to its latest full record.
+    """
+    latest = {}
+    for i in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[i : i + chunk_size]
+        for document in col.find(filter={"record_id": {"$in": chunk}}, projection={"_id": 0, "record_id": 1, "latest": 1}):
+            latest[document["record_id"]] = document.get("latest")
+    return latest
+
+
+def get_timeline_version(col: Collection, record_id: str, version: int = -1) -> dict:
+    """Reads one version of a record from its document's timeline, whichever format the timeline is stored in.
+
+    Args:
+        col (Collection): The pymongo collection object
+        record_id (str): The id of the particular record
+        version (int, optional): The index of the version to rebuild. Negative indexes count from the end. Defaults to -1, the latest version.
+
+    Returns:
+        dict: The full record as it was at that version.
+    """
+    document = col.find_one({"record_id": record_id}, projection={"_id": 0, "timeline": 1, "history": 1})
+    if not document:
+        raise ReferenceError(f"could not find a document in {col.full_name} with the record id: {record_id}")
+    if "history" in document:
+        # The timeline lives in the history collection instead (see `BulkWriter`'s history_col).
+        history_col = col.database[document["history"]["collection"]]
+        return rebuild(read_history(history_col, record_id), version)
+    return rebuild(document.get("timeline", []), version)
+
+
+# The condition of an update that pushes onto an embedded timeline, which only applies while the document has no history pointer.
+EMBEDDED = "embedded"
+
+
+def applied(document: dict, condition) -> bool:
+    """Whether a conditional update (see `BulkWriter`) shows up in the document as it is now, when it's unclear if the update matched."""
+    if condition == EMBEDDED:
+        return "history" not in document
+    # Another writer that got there first with the very same version leaves the document as this update would have.
+    return document.get("latest") == condition
+
+
+class BulkWriter:
+    """Buffers inserts and per-record updates, and sends them to MongoDB in unordered `bulk_write` batches.
+
+    Queuing a write never sends anything by itself, so that a record whose details can't be formatted is told apart from a failed write.
+    Call `flush_if_due` after each one: it flushes the batch once it holds `batch_size` operations, or more than `flush_interval` seconds
+    after the previous flush. Because a bulk write only reports totals for updates, any update that didn't match a document
+    is looked up afterwards so that it can still be reported per record as a `ReferenceError`, just like the single-document helpers do.
+
+    Documents can keep their timeline in `history_col` instead, in buckets of `bucket_size` entries, while the main document only holds
+    a pointer and the latest snapshot of the record. Documents that already do are always updated that way, and new documents are
+    only created that way when `history_for_new_documents` is set. The history writes of a batch are sent first,
+    and a record's main document is only updated if its history write succeeded.
+    """
+
+    def __init__(
+        self,
+        col: Collection,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        on_error: Callable[[str, Exception], None] = None,
+        on_commit: Callable[[list[str]], None] = None,
+        snapshot_interval: int = 10,
+        history_col: Collection = None,
+        history_for_new_documents: bool = False,
+        bucket_size: int = 100,
+        timeline_format: str = "full",
+    ):
+        """
+        Args:
+            col (Collection): The pymongo collection object
+            batch_size (int, optional): The most operations to send per bulk write. Defaults to 500.
+            flush_interval (float, optional): The most seconds an operation should wait before being sent. Defaults to 5.0.
+            on_error (Callable[[str, Exception], None], optional): Called with (record_id, exception) for every operation that failed. Defaults to None.
+            on_commit (Callable[[list[str]], None], optional): Called after every flush with the record ids that were written successfully. Defaults to None.
+            snapshot_interval (int, optional): How many timeline entries there are per full snapshot, for updates written in the delta format. Defaults to 10.
+            history_col (Collection, optional): The collection to keep timelines in, outside of the main documents. Defaults to None.
+            history_for_new_documents (bool, optional): Whether new documents should keep their timeline in `history_col`. Defaults to False.
+            bucket_size (int, optional): How many timeline entries each history bucket holds. Defaults to 100.
+            timeline_format (str, optional): "full" or "delta", the format of the entries written to the history collection. Defaults to "full".
+        """
+        self.col = col
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.on_commit = on_commit
+        self.snapshot_interval = snapshot_interval
+        self.history_col = history_col
+        self.history_for_new_documents = history_for_new_documents
+        self.bucket_size = bucket_size
+        self.timeline_format = timeline_format
+        self.operations = []
+        self.record_ids = []
+        # For every queued operation that only applies to the document as it was read: EMBEDDED for an update of an embedded timeline
+        # (which no longer applies once the document has a history pointer), or the `latest` snapshot that a history update sets.
+        self.conditions = []
+        self.history_operations = []
+        self.history_record_ids = []
+        # (bucket, entries already in it, new entries) for every queued history write, to tell a retry apart from a conflict.
+        self.history_buckets = []
+        self.errors = []
+        self.last_flush = time.monotonic()
+
+    def insert(self, document: dict) -> None:
+        """Queues a new document (as made by `format_document`) to be inserted."""
+        if self.history_for_new_documents:
+            # Move the timeline over to the history collection, and keep only a pointer and the latest snapshot on the document.
+            timeline = document.pop("timeline", [])
+            document["latest"] = rebuild(timeline) if timeline else None
+            document["history"] = {"collection": self.history_col.name, "entries": len(timeline), "bucket_size": self.bucket_size}
+            self._add_history(document.get("record_id"), timeline, 0, self.bucket_size)
+        self._add(InsertOne(document), document.get("record_id"))
+
+    def update(
+        self,
+        record_id: str,
+        record_details: dict,
+        billing_app: str = None,
+        timeline_tail: list[dict] = None,
+        history: dict = None,
+        latest: dict = None,
+    ) -> None:
+        """Queues every change for an outdated record as a single `UpdateOne`.
+
+        Args:
+            record_id (str): The id of the particular record
+            record_details (dict): The record_details to be used to inject into the timeline
+            billing_app (str, optional): The name of an app to add to the billing array. Defaults to None.
+            timeline_tail (list[dict], optional): The end of the document's timeline, to delta encode the new entry against. Defaults to None.
+            history (dict, optional): The document's history pointer, if its timeline lives in the history collection. Defaults to None.
+            latest (dict, optional): The document's latest snapshot, to delta encode a history entry against. Defaults to None.
+        """
+        if history is not None:
+            update = build_record_update(record_details, billing_app, in_history=True)
+            position = history["entries"]
+            if self.timeline_format == "delta":
+                entry = encode_entry_at(latest, record_details, position, self.snapshot_interval)
+            else:
+                entry = record_details
+            self._add_history(record_id, [entry], position, history["bucket_size"])
+            # Only counted if nobody else has added an entry since the document was read.
+            self._add(UpdateOne({"record_id": record_id, "history.entries": position}, update), record_id, condition=update["$set"]["latest"])
+        else:
+            update = build_record_update(record_details, billing_app, timeline_tail, self.snapshot_interval)
+            # If the document was moved to the history collection since it was read, this update no longer applies to it.
+            self._add(UpdateOne({"record_id": record_id, "history": {"$exists": False}}, update), record_id, condition=EMBEDDED)
+
+    def _add_history(self, record_id: str, entries: list[dict], first_position: int, bucket_size: int) -> None:
+        operations = history_updates(record_id, entries, first_position, bucket_size)
+        self.history_operations.extend(operations)
+        self.history_record_ids.extend([record_id] * len(operations))
+        self.history_buckets.extend(split_into_buckets(entries, first_position, bucket_size))
+
+    def touch(self, record_id: str, record_details: dict, billing_app: str = None) -> None:
+        """Queues an update for a record whose content hash didn't change: the timestamps move forward, but nothing is pushed onto the timeline.
+
+        Args:
+            record_id (str): The id of the particular record
+            record_details (dict): The record_details, used for its lastModified
+            billing_app (str, optional): The name of an app to add to the billing array. Defaults to None.
+        """
+        update = {
+            "$set": {
+                "internally_modified": datetime.fromisoformat(record_details.get("lastModified").replace("Z", "+00:00")),
+                "mongodb_modified": datetime.now(tz=UTC),
+            }
+        }
+        if billing_app is not None:
+            update["$push"] = {"billing": {"app": billing_app, "billed": None}}
+        self._add(UpdateOne({"record_id": record_id}, update), record_id)
+
+    def _add(self, operation, record_id: str, condition=None) -> None:
+        self.operations.append(operation)
+        self.record_ids.append(record_id)
+        self.conditions.append(condition)
+
+    def flush_if_due(self) -> None:
+        """Flushes the queued operations if there are `batch_size` of them, or if the last flush was more than `flush_interval` seconds ago."""
+        if len(self.operations) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _report(self, record_id: str, error: Exception) -> None:
+        self.errors.append((record_id, error))
+        if self.on_error is not None:
+            self.on_error(record_id, error)
+
+    def flush(self) -> None:
+        """Sends every queued operation to MongoDB in one unordered bulk write."""
+        self.last_flush = time.monotonic()
+        if not self.operations:
+            return
+        operations, record_ids, conditions = self.operations, self.record_ids, self.conditions
+        self.operations, self.record_ids, self.conditions = [], [], []
+
+        # History entries go first, so that a document never points at history that wasn't written.
+        history_failed = self._flush_history()
+        if history_failed:
+            kept = [i for i, record_id in enumerate(record_ids) if record_id not in history_failed]
+            operations, record_ids, conditions = [operations[i] for i in kept], [record_ids[i] for i in kept], [conditions[i] for i in kept]
+            if not operations:
+                return
+
+        failed = set()  # indexes into operations
+        try:
+            result = self.col.bulk_write(operations, ordered=False)
+            matched_count = result.matched_count
+        except BulkWriteError as e:
+            matched_count = e.details.get("nMatched", 0)
+            for write_error in e.details.get("writeErrors", []):
+                index = write_error["index"]
+                failed.add(index)
+                self._report(record_ids[index], RuntimeError(f"{write_error.get('code')}: {write_error.get('errmsg')}"))
+
+        # Any update that didn't match a document means that the document is missing, or that its timeline changed since it was read:
+        # another writer added an entry first, or `migrate_history.py` moved it to the history collection.
+        # Either way the record is reported, so it stays pending and is tried again against what the document looks like now.
+        update_ids = [record_ids[i] for i, op in enumerate(operations) if isinstance(op, UpdateOne) and i not in failed]
+        if matched_count < len(update_ids):
+            projection = {"_id": 0, "record_id": 1, "history": 1, "latest": 1}
+            found = {d["record_id"]: d for d in self.col.find({"record_id": {"$in": update_ids}}, projection=projection)}
+            for i, op in enumerate(operations):
+                if not isinstance(op, UpdateOne) or i in failed:
+                    continue
+                document = found.get(record_ids[i])
+                if document is None:
+                    failed.add(i)
+                    self._report(record_ids[i], ReferenceError(f"could not find a document in {self.col.full_name} with the record id: {record_ids[i]}"))
+                elif conditions[i] is not None and not applied(document, conditions[i]):
+                    failed.add(i)
+                    self._report(record_ids[i], RuntimeError(f"the timeline of {record_ids[i]} changed since it was read, so the update was not applied"))
+
+        if self.on_commit is not None:
+            self.on_commit([record_id for i, record_id in enumerate(record_ids) if i not in failed])
+
+    def _flush_history(self) -> set[str]:
+        """Sends the queued history bucket writes. Returns the ids of the records whose history couldn't be written."""
+        if not self.history_operations:
+            return set()
+        operations, record_ids, buckets = self.history_operations, self.history_record_ids, self.history_buckets
+        self.history_operations, self.history_record_ids, self.history_buckets = [], [], []
+
+        failed = set()
+        try:
+            self.history_col.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                index = write_error["index"]
+                record_id = record_ids[index]
+                # A bucket that didn't hold the expected number of entries is fine if it already holds these exact ones:
+                # that is a retry of a record whose main document couldn't be updated last time.
+                if write_error.get("code") == 11000 and self._already_written(record_id, *buckets[index]):
+                    continue
+                if record_id not in failed:
+                    failed.add(record_id)
+                    if write_error.get("code") == 11000:
+                        error = RuntimeError(f"the history of {record_id} changed since it was read, so its new entry was not written")
+                    else:
+                        error = RuntimeError(f"{write_error.get('code')}: {write_error.get('errmsg')}")
+                    self._report(record_id, error)
+        return failed
+
+    def _already_written(self, record_id: str, bucket: int, start: int, entries: list[dict]) -> bool:
+        document = self.history_col.find_one({"record_id": record_id, "bucket": bucket}, projection={"_id": 0, "entries": {"$slice": [start, len(entries)]}})
+        return document is not None and document.get("entries") == entries
+
+
 def main():
     pass
 
@@ -5,12 +5,20 @@ import sys
 import requests
 from dotenv import load_dotenv
 
+from metrics import perf_table
+
 
 def str2bool(s):
     return s.lower() in ("true", "1", "yes", "y")
 
 
-def send_teams_message(webhook_url: str, title: str, message: str, is_success: bool):
+def send_teams_message(webhook_url: str, title: str, message: str, is_success: bool, facts: list[tuple[str, str]] = None):
+    body = [
+        {"type": "TextBlock", "text": title, "weight": "Bolder", "size": "Medium", "color": ("good" if is_success else "attention")},
+        {"type": "TextBlock", "text": message, "wrap": True},
+    ]
+    if facts:
+        body.append({"type": "FactSet", "facts": [{"title": t, "value": v} for t, v in facts]})
     payload = {
         "type": "message",
         "attachments": [
@@ -20,10 +28,7 @@ def send_teams_message(webhook_url: str, title: str, message: str, is_success: b
                     "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
                     "type": "AdaptiveCard",
                     "version": "1.4",
-                    "body": [
-                        {"type": "TextBlock", "text": title, "weight": "Bolder", "size": "Medium", "color": ("good" if is_success else "attention")},
-                        {"type": "TextBlock", "text": message, "wrap": True},
-                    ],
+                    "body": body,
                 },
             }
         ],
@@ -36,9 +41,15 @@ if __name__ == "__main__":
     load_dotenv()
     webhook_url = os.getenv("TEAMS_WEBHOOK_URL")
 
-    # Usage: uv run notify_teams.py "Title" "Message"
+    # Usage: uv run notify_teams.py "Title" "Message" "True" [metrics.json]
     title = sys.argv[1]
     message = sys.argv[2]
     status = str2bool(sys.argv[3])
 
-    send_teams_message(webhook_url, title, message, status)
+    # Add a performance table from the run's metrics, if they were written.
+    facts = None
+    if len(sys.argv) > 4 and os.path.exists(sys.argv[4]):
+        with open(sys.argv[4], encoding="utf-8") as f:
+            facts = perf_table(json.load(f))
+
+    send_teams_message(webhook_url, title, message, status, facts)
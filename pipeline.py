@@ -0,0 +1,465 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
+from datetime import UTC, datetime, timedelta
+
+import bson
+from pymongo.collection import Collection
+
+from fetch_engine import DetailFetcher
+from knackly_api import KnacklyAPI, RecordNotFound, guess_responsible_app
+from logger import log_event
+from metadata_store import NO_TIME, CatalogTable, MetadataBatch, MetadataPage, from_epoch
+from metrics import Metrics
+from mongo_db import (
+    BulkWriter,
+    content_hash,
+    find_existing_documents,
+    find_latest_snapshots,
+    find_outdated_details,
+    find_timeline_tails,
+    format_document,
+)
+from watermarks import WatermarkTracker
+
+# Marks the end of a stage's output.
+END = object()
+
+# How often the progress bar's description is updated, in seconds.
+PROGRESS_INTERVAL = 0.5
+
+# The mistakes that formatting an unexpected detail response can run into. Anything else (such as losing MongoDB) still stops the pipeline.
+FORMAT_ERRORS = (KeyError, IndexError, TypeError, ValueError, AttributeError)
+
+# A document counts as outdated once Knackly's lastModified is more than this far past its internally_modified.
+STALE_TOLERANCE = timedelta(minutes=5)
+
+
+@dataclass(slots=True)
+class RecordJob:
+    """A record that needs its details fetched from Knackly and written to MongoDB."""
+
+    record_id: str
+    catalog: str
+    # Only kept for the log line of a new record.
+    created: str = None
+    # None for a record that isn't in MongoDB yet, otherwise the projection from `find_existing_documents`.
+    existing: dict = None
+    # The listed lastModified in microseconds since the epoch, which is also what cached details are keyed by.
+    last_modified: int = NO_TIME
+    # When the lookup stage found that the record needs writing, for the time it spends in the pipeline.
+    found_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def is_new(self) -> bool:
+        return self.existing is None
+
+    @property
+    def knackly_last_modified(self) -> datetime:
+        """The listed lastModified as a naive UTC datetime, like the ones pymongo returns, or None if the listing didn't have one."""
+        last_modified = from_epoch(self.last_modified)
+        return last_modified.replace(tzinfo=None) if last_modified else None
+
+
+class StageFailed(Exception):
+    """Raised inside a stage when another stage has already failed and the pipeline is shutting down."""
+
+
+class ReconciliationPipeline:
+    """Streams records from the catalog listing all the way to MongoDB, with every stage running at the same time:
+
+        catalog listing -> MongoDB existence/staleness lookup -> detail fetch -> bulk write
+
+    Each stage runs on its own thread(s) and hands work to the next through a bounded queue of `queue_depth` items,
+    so a slow stage holds the earlier ones back instead of letting metadata pile up in memory,
+    and the first records are written while later catalogs are still being listed.
+    """
+
+    def __init__(
+        self,
+        knackly: KnacklyAPI,
+        collection: Collection,
+        args: argparse.Namespace,
+        log: logging.Logger,
+        starts: dict[str, datetime] = None,
+        tracker: WatermarkTracker = None,
+        metrics: Metrics = None,
+        on_error: Callable[[str, Exception], None] = None,
+    ):
+        """
+        Args:
+            knackly (KnacklyAPI): The Knackly API client.
+            collection (Collection): The pymongo collection that records are written to.
+            args (argparse.Namespace): The parsed command line arguments.
+            log (logging.Logger): Where the per-record lines are logged.
+            starts (dict[str, datetime], optional): Where each catalog's listing starts. Catalogs not in here start at `args.date`. Defaults to None.
+            tracker (WatermarkTracker, optional): Told about every listed and finished record, so that watermarks can move forward. Defaults to None.
+            metrics (Metrics, optional): Where the time spent listing each catalog and diffing against MongoDB is recorded. Defaults to None.
+            on_error (Callable[[str, Exception], None], optional): Called with (record_id, exception) for every record whose details couldn't be
+                fetched or formatted. Defaults to None.
+        """
+        self.knackly = knackly
+        self.collection = collection
+        self.args = args
+        self.log = log
+        self.start = datetime.strptime(args.date, "%Y-%m-%dT%H:%M").replace(tzinfo=UTC)
+        self.starts = starts or {}
+        self.tracker = tracker
+        self.metrics = metrics or Metrics()
+        self.on_error = on_error
+        self.catalogs = CatalogTable()
+
+        self.page_queue = queue.Queue(maxsize=args.queue_depth)
+        self.job_queue = queue.Queue(maxsize=args.queue_depth)
+        self.result_queue = queue.Queue(maxsize=args.queue_depth)
+        self.failed = threading.Event()
+        self.stage_errors = []
+        # (record_id, exception) for every record that failed on its own, the same way `BulkWriter.errors` keeps failed writes.
+        self.errors = []
+
+        self.new_count = 0
+        self.inserted_count = 0
+        self.matching_count = 0
+        self.modified_count = 0
+        # Outdated records whose content hash hadn't changed, and the timeline bytes that weren't written because of it.
+        self.unchanged_count = 0
+        self.bytes_avoided = 0
+        # Records that were deleted from Knackly between being listed and having their details fetched.
+        self.deleted_count = 0
+        self.new_heading_printed = False
+        self.modified_heading_printed = False
+
+    def _put(self, q: queue.Queue, item) -> None:
+        """Puts an item onto a queue, giving up if another stage has failed in the meantime."""
+        while True:
+            if self.failed.is_set():
+                raise StageFailed
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue, timeout: float = None):
+        """Takes an item off of a queue, giving up if another stage has failed in the meantime.
+        Returns None if `timeout` seconds pass without an item showing up."""
+        waited = 0.0
+        while True:
+            if self.failed.is_set():
+                raise StageFailed
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                waited += 0.5
+                if timeout is not None and waited >= timeout:
+                    return None
+
+    def _stage(self, target, *stage_args) -> threading.Thread:
+        """Starts a stage on its own thread. If it raises, every other stage is told to stop."""
+
+        def run() -> None:
+            try:
+                target(*stage_args)
+            except StageFailed:
+                pass
+            except BaseException as e:
+                self.stage_errors.append(e)
+                self.failed.set()
+
+        thread = threading.Thread(target=run, name=target.__name__.strip("_"), daemon=True)
+        thread.start()
+        return thread
+
+    def _list_catalogs(self, catalogs: list[str], pages: Iterable[tuple] = None) -> None:
+        """Stage 1: stream every page of recently modified records from every catalog, or the given (catalog, records) pages instead."""
+        if pages is not None:
+            for c, records in pages:
+                self._put(self.page_queue, MetadataPage(self.catalogs.intern(c), records))
+            self._put(self.page_queue, END)
+            return
+        for c in catalogs:
+            pages = self.knackly.iter_records_in_catalog(
+                catalog=c,
+                start=self.starts.get(c, self.start),
+                status="Ok",
+                page_size=self.args.page_size,
+                max_concurrent_pages=self.args.workers,
+                on_window_listed=(lambda time, c=c: self.tracker.listed_up_to(c, time)) if self.tracker else None,
+            )
+            # Only the time spent waiting on Knackly counts towards listing, not the time spent waiting for room in the queue.
+            while True:
+                with self.metrics.timer("phase_seconds", phase="catalog listing"), self.metrics.timer("catalog_listing_seconds", catalog=c):
+                    records = next(pages, None)
+                if records is None:
+                    break
+                if records:
+                    # Each page is boiled down to compact columns right away, so the listed dicts don't wait around in the queues.
+                    page = MetadataPage(self.catalogs.intern(c), records)
+                    if self.tracker:
+                        self.tracker.listed(c, page)
+                    self._put(self.page_queue, page)
+        self._put(self.page_queue, END)
+
+    def _lookup(self) -> None:
+        """Stage 2: look up batches of listed records in MongoDB, and pass on the ones that are new or outdated."""
+        finished = False
+        while not finished:
+            # Wait for one page, then grab whatever else is already waiting, up to one lookup query's worth of records.
+            batch = MetadataBatch()
+            item = self._get(self.page_queue)
+            while True:
+                if item is END:
+                    finished = True
+                    break
+                batch.add(item)
+                if len(batch) >= self.args.mongo_chunk_size:
+                    break
+                try:
+                    item = self.page_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if not batch:
+                continue
+            with self.metrics.timer("phase_seconds", phase="mongo diff"):
+                existing_documents = find_existing_documents(col=self.collection, record_ids=batch.ids, chunk_size=self.args.mongo_chunk_size)
+            # For each matching id: check if it was modified past what we have stored in mongodb.
+            # A record named by a webhook event is known to have changed, so it skips the staleness check.
+            # Its content hash still keeps an event that changed nothing from growing the timeline.
+            new, stale, up_to_date = batch.split(existing_documents, STALE_TOLERANCE)
+            self.new_count += len(new)
+            self.matching_count += len(stale) + len(up_to_date)
+            for i in new:
+                job = RecordJob(record_id=batch.ids[i], catalog=self.catalogs.name(batch.catalogs[i]), created=batch.created[i], last_modified=batch.last_modified[i])
+                self._put(self.job_queue, job)
+            outdated = []
+            for i in stale:
+                outdated.append(
+                    RecordJob(
+                        record_id=batch.ids[i],
+                        catalog=self.catalogs.name(batch.catalogs[i]),
+                        existing=existing_documents[batch.ids[i]],
+                        last_modified=batch.last_modified[i],
+                    )
+                )
+            if self.tracker:
+                self.tracker.done([batch.ids[i] for i in up_to_date])
+
+            # The lookup above is covered by an index, so the rest of what an update needs is only fetched for the outdated documents.
+            if outdated:
+                with self.metrics.timer("phase_seconds", phase="mongo diff"):
+                    details = find_outdated_details(col=self.collection, record_ids=[job.record_id for job in outdated], chunk_size=self.args.mongo_chunk_size)
+                for job in outdated:
+                    job.existing.update(details.get(job.record_id, {"billing_apps": [], "content_hash": None, "history": None}))
+
+            # Delta encoded entries are diffed against the previous version. For an embedded timeline that means reading the end of it,
+            # and for a timeline in the history collection it means reading the latest snapshot kept on the document.
+            if outdated and self.args.timeline_format == "delta":
+                embedded = [job.record_id for job in outdated if job.existing["history"] is None]
+                in_history = [job.record_id for job in outdated if job.existing["history"] is not None]
+                chunk_size = self.args.mongo_chunk_size
+                with self.metrics.timer("phase_seconds", phase="mongo diff"):
+                    tails = find_timeline_tails(col=self.collection, record_ids=embedded, count=self.args.snapshot_interval, chunk_size=chunk_size)
+                    latest = find_latest_snapshots(col=self.collection, record_ids=in_history, chunk_size=chunk_size)
+                for job in outdated:
+                    if job.existing["history"] is None:
+                        job.existing["timeline_tail"] = tails.get(job.record_id, [])
+                    else:
+                        job.existing["latest"] = latest.get(job.record_id)
+            for job in outdated:
+                self._put(self.job_queue, job)
+        self._put(self.job_queue, END)
+
+    def _jobs(self):
+        while (job := self._get(self.job_queue)) is not END:
+            yield job
+
+    def _fetch(self) -> None:
+        """Stage 3: fetch the details of every new or outdated record, sharing one requests-per-second budget."""
+        DetailFetcher(self.knackly, max_workers=self.args.workers).fetch_into(self._jobs(), self.result_queue, stop=self.failed)
+        self._put(self.result_queue, END)
+
+    @staticmethod
+    def _event(action: str, job: RecordJob, fetch_seconds: float, **fields) -> dict:
+        """The structured event for what happened to a record, with how long its detail request took and how long it spent in the pipeline."""
+        return {
+            "action": action,
+            "record_id": job.record_id,
+            "catalog": job.catalog,
+            "fetch_ms": round(1000 * fetch_seconds, 2),
+            "pipeline_ms": round(1000 * (time.perf_counter() - job.found_at), 2),
+            **fields,
+        }
+
+    def _write(self, job: RecordJob, record_details: dict, writer: BulkWriter, fetch_seconds: float = 0.0) -> None:
+        """Stage 4: queue the insert or update for a record in the bulk writer, and log it."""
+        id, catalog = job.record_id, job.catalog
+        if job.is_new:
+            if len(record_details["apps"]) == 0:
+                log_event(
+                    self.log,
+                    logging.WARNING,
+                    f"{str(id).ljust(23)} | {str(catalog).ljust(20)} | WARNING: Apps array was empty for this record. Not uploading anything to MongoDB.",
+                    self._event("skipped", job, fetch_seconds, reason="no apps"),
+                )
+                if self.tracker:
+                    self.tracker.done([id])
+                return
+            writer.insert(format_document(record_details, catalog, timeline_format=self.args.timeline_format))
+            self.inserted_count += 1
+            if not self.new_heading_printed:
+                self.new_heading_printed = True
+                self.log.info(f"{'-' * 63}")
+                self.log.info(f"{'Record id'.ljust(23)} | {'Catalog'.ljust(20)} | Created Date")
+                self.log.info(f"{'-' * 63}")
+            log_event(self.log, logging.INFO, f"{str(id).ljust(23)} | {str(catalog).ljust(20)} | {job.created}", self._event("insert", job, fetch_seconds, created=job.created))
+            return
+
+        # Modify the document to make it conform to what MongoDB expects.
+        # Every change for this record (billing, timeline and both timestamps) goes out as a single batched update.
+        mongo_apps = job.existing["billing_apps"]
+        responsible_app = guess_responsible_app(record_details.get("apps"))
+        billing_app = None
+        if (responsible_app is not None) and (responsible_app not in mongo_apps):
+            billing_app = responsible_app
+            self.log.info(f"Added the {responsible_app} app to the billing array for record: {id} ({mongo_apps})")
+
+        # Knackly bumps lastModified for changes that don't touch the data or apps. Only the timestamps need to move forward for those.
+        if job.existing.get("content_hash") == content_hash(record_details):
+            writer.touch(record_id=record_details.get("id"), record_details=record_details, billing_app=billing_app)
+            self.unchanged_count += 1
+            avoided = len(bson.encode(record_details))
+            self.bytes_avoided += avoided
+            # Not worth a line in the table, but still one of the record actions in the events file.
+            log_event(self.log, logging.INFO, None, self._event("unchanged", job, fetch_seconds, last_modified=job.knackly_last_modified, bytes_avoided=avoided))
+            return
+
+        writer.update(
+            record_id=record_details.get("id"),
+            record_details=record_details,
+            billing_app=billing_app,
+            timeline_tail=job.existing.get("timeline_tail"),
+            history=job.existing["history"],
+            latest=job.existing.get("latest"),
+        )
+        self.modified_count += 1
+
+        # Log the heading information for this section
+        if not self.modified_heading_printed:
+            self.modified_heading_printed = True
+            self.log.info(f"{'-' * 117}")
+            self.log.info(
+                f"{str('Record id').ljust(23)} | {str('Catalog').ljust(20)} | {'Knackly last modified'.ljust(26)} | {'Mongo last modified'.ljust(26)} | Difference"
+            )
+            self.log.info(f"{'-' * 117}")
+        knackly_last_modified, mongo_last_modified = job.knackly_last_modified, job.existing["internally_modified"]
+        log_event(
+            self.log,
+            logging.INFO,
+            f"{id.ljust(23)} | {catalog.ljust(20)} | {str(knackly_last_modified).ljust(26)} | {str(mongo_last_modified).ljust(26)} | {knackly_last_modified - mongo_last_modified if knackly_last_modified else ''}",
+            self._event("update", job, fetch_seconds, last_modified=knackly_last_modified, internally_modified=mongo_last_modified, billing_app=billing_app),
+        )
+
+    def _deleted(self, job: RecordJob, fetch_seconds: float) -> None:
+        """A record that Knackly no longer has is finished with: there is nothing to write, and nothing to retry."""
+        self.deleted_count += 1
+        log_event(
+            self.log,
+            logging.WARNING,
+            f"{str(job.record_id).ljust(23)} | {str(job.catalog).ljust(20)} | WARNING: Record was deleted from Knackly. Not uploading anything to MongoDB.",
+            self._event("deleted", job, fetch_seconds),
+        )
+        if self.tracker:
+            self.tracker.done([job.record_id])
+
+    def _failed(self, job: RecordJob, error: Exception, fetch_seconds: float) -> None:
+        """Records a record that couldn't be fetched or formatted. It isn't marked done, so the watermark stays behind it and it is tried again."""
+        self.errors.append((job.record_id, error))
+        log_event(
+            self.log,
+            logging.ERROR,
+            f"{str(job.record_id).ljust(23)} | {str(job.catalog).ljust(20)} | ERROR: {type(error).__name__}: {error}",
+            self._event("failed", job, fetch_seconds, error=f"{type(error).__name__}: {error}"),
+        )
+        if self.on_error is not None:
+            self.on_error(job.record_id, error)
+
+    def counts(self) -> dict[str, int]:
+        """The pipeline's counters by name, so that they can be added up across catalogs and workers."""
+        return {
+            "new": self.new_count,
+            "inserted": self.inserted_count,
+            "matching": self.matching_count,
+            "modified": self.modified_count,
+            "unchanged": self.unchanged_count,
+            "bytes_avoided": self.bytes_avoided,
+            "deleted": self.deleted_count,
+            "failed": len(self.errors),
+        }
+
+    def run(self, catalogs: list[str], writer: BulkWriter, pages: Iterable[tuple] = None, show_progress: bool = True) -> None:
+        """Runs every stage until all of the catalogs have been reconciled. The write stage runs on the calling thread.
+        A record whose details can't be fetched or formatted doesn't stop the others. It ends up in `errors` instead.
+
+        Args:
+            catalogs (list[str]): The names of the catalogs to reconcile.
+            writer (BulkWriter): Where the inserts and updates are sent.
+            pages (Iterable[tuple], optional): (catalog, records) pages to reconcile instead of listing the catalogs,
+                such as the differences found by a full reconciliation. Consumed on the listing stage's thread. Defaults to None.
+            show_progress (bool, optional): Whether to show a progress bar. Defaults to True.
+        """
+        self.log.debug(f"Streaming record metadata across {len(catalogs)} catalogs into MongoDB...")
+        self._stage(self._list_catalogs, catalogs, pages)
+        self._stage(self._lookup)
+        self._stage(self._fetch)
+
+        # tqdm is imported here instead of at the top, so that it loads while the other stages are already waiting on Knackly,
+        # and not at all for runs (such as --plan) that never get this far.
+        from tqdm import tqdm
+
+        # The bar is only touched every PROGRESS_INTERVAL seconds, instead of formatting a new description for every record.
+        pbar = tqdm(desc="0 inserted, 0 replaced", unit=" records", disable=not show_progress, mininterval=PROGRESS_INTERVAL)
+        progressed = 0
+        next_progress = time.perf_counter() + PROGRESS_INTERVAL
+        try:
+            while True:
+                item = self._get(self.result_queue, timeout=writer.flush_interval)
+                if item is None:
+                    # Nothing has arrived for a while, so don't let the queued writes sit around.
+                    writer.flush()
+                    continue
+                if item is END:
+                    break
+                job, record_details, error, fetch_seconds = item
+                if isinstance(error, RecordNotFound):
+                    self._deleted(job, fetch_seconds)
+                elif error is not None:
+                    self._failed(job, error, fetch_seconds)
+                else:
+                    # Only formatting the record's details can fail this way. The write itself goes out in `flush_if_due`,
+                    # outside of this, so that losing MongoDB still stops the pipeline instead of failing records one by one.
+                    try:
+                        self._write(job, record_details, writer, fetch_seconds)
+                    except FORMAT_ERRORS as e:
+                        self._failed(job, e, fetch_seconds)
+                    writer.flush_if_due()
+                progressed += 1
+                if time.perf_counter() >= next_progress:
+                    next_progress = time.perf_counter() + PROGRESS_INTERVAL
+                    pbar.set_description(f"{self.inserted_count} inserted, {self.modified_count} replaced", refresh=False)
+                    pbar.update(progressed)
+                    progressed = 0
+        except StageFailed:
+            raise self.stage_errors[0]
+        except BaseException:
+            self.failed.set()
+            raise
+        finally:
+            pbar.set_description(f"{self.inserted_count} inserted, {self.modified_count} replaced", refresh=False)
+            pbar.update(progressed)
+            pbar.close()
+            writer.flush()
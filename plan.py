@@ -0,0 +1,132 @@
+import json
+from collections.abc import Iterator
+from datetime import UTC, datetime
+
+from pymongo.collection import Collection
+
+from knackly_api import KnacklyAPI
+from metadata_store import MICROSECOND, epoch_of, knackly_epoch
+from metrics import Metrics, find
+from mongo_db import find_existing_documents
+from pipeline import STALE_TOLERANCE
+
+INSERT = "insert"
+UPDATE = "update"
+
+
+def build_plan(
+    knackly: KnacklyAPI,
+    collection: Collection,
+    catalogs: list[str],
+    starts: dict[str, datetime],
+    out,
+    page_size: int = 1000,
+    max_concurrent_pages: int = 4,
+    chunk_size: int = 1000,
+) -> dict:
+    """Works out what a run would write, using only the catalog listing and the covered existence lookup.
+    No record details are fetched and nothing is written to MongoDB.
+
+    Every insert and timeline update is written to `out` as one JSON line, such as
+    `{"action": "update", "record_id": ..., "catalog": ..., "lastModified": ..., "created": ..., "internally_modified": ...}`.
+
+    Args:
+        knackly (KnacklyAPI): The Knackly API client.
+        collection (Collection): The pymongo collection that records are written to.
+        catalogs (list[str]): The names of the catalogs to plan for.
+        starts (dict[str, datetime]): Where each catalog's listing starts.
+        out: A text file to write the plan to.
+        page_size (int, optional): How many records to ask for per listing request. Defaults to 1000.
+        max_concurrent_pages (int, optional): How many listing requests may be in flight at once. Defaults to 4.
+        chunk_size (int, optional): How many ids to send per lookup query. Defaults to 1000.
+
+    Returns:
+        dict: How many inserts and updates were planned, and how many listed records were already up to date.
+    """
+    counts = {INSERT: 0, UPDATE: 0, "up_to_date": 0}
+
+    def plan_batch(catalog: str, records: list[dict]) -> None:
+        existing = find_existing_documents(col=collection, record_ids=[r["id"] for r in records], chunk_size=chunk_size)
+        for r in records:
+            entry = {"record_id": r["id"], "catalog": catalog, "lastModified": r.get("lastModified"), "created": r.get("created")}
+            if r["id"] not in existing:
+                entry["action"] = INSERT
+            else:
+                internally_modified = existing[r["id"]]["internally_modified"]
+                if knackly_epoch(r.get("lastModified")) <= epoch_of(internally_modified) + STALE_TOLERANCE // MICROSECOND:
+                    counts["up_to_date"] += 1
+                    continue
+                entry["action"] = UPDATE
+                entry["internally_modified"] = internally_modified.isoformat()
+            counts[entry["action"]] += 1
+            out.write(json.dumps(entry) + "\n")
+
+    for catalog in catalogs:
+        pages = knackly.iter_records_in_catalog(catalog=catalog, start=starts[catalog], status="Ok", page_size=page_size, max_concurrent_pages=max_concurrent_pages)
+        batch = []
+        for records in pages:
+            batch.extend(r for r in records if "id" in r)
+            if len(batch) >= chunk_size:
+                plan_batch(catalog, batch)
+                batch = []
+        if batch:
+            plan_batch(catalog, batch)
+    return counts
+
+
+def estimate_cost(counts: dict, metrics: Metrics, requests_per_second: float, workers: int) -> dict:
+    """Estimates what applying a plan will cost: one detail call per planned write, at whichever is slower of
+    the requests-per-second budget and the detail latency seen so far spread over the workers.
+    The plan's own listing calls stand in for the detail latency, since no detail calls were made."""
+    detail_calls = counts[INSERT] + counts[UPDATE]
+    snapshot = metrics.snapshot()
+    listing = find(snapshot, "histograms", "knackly_request_seconds", call="list")
+    latency = sum(h["sum"] for h in listing) / max(1, sum(h["count"] for h in listing)) if listing else 0.0
+    return {
+        "listing_calls": sum(h["count"] for h in listing),
+        "detail_calls": detail_calls,
+        "estimated_seconds": round(max(detail_calls / requests_per_second, detail_calls * latency / workers), 1),
+    }
+
+
+def iter_plan_pages(path: str, page_size: int = 1000) -> Iterator[tuple]:
+    """Reads a plan back as (catalog, records) pages for `ReconciliationPipeline.run`.
+    Every planned update is marked as changed, so it is applied even if the staleness check would now say otherwise,
+    and the content hash still keeps it from adding a timeline entry if nothing actually changed.
+    """
+    pages = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if "action" not in entry:
+                continue
+            record = {"id": entry["record_id"], "lastModified": entry["lastModified"], "created": entry.get("created"), "changed": entry["action"] == UPDATE}
+            page = pages.setdefault(entry["catalog"], [])
+            page.append(record)
+            if len(page) >= page_size:
+                yield entry["catalog"], pages.pop(entry["catalog"])
+    yield from pages.items()
+
+
+def plan_catalogs(path: str) -> list[str]:
+    """The catalogs that a plan touches, in the order they first show up."""
+    catalogs = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if "action" in entry:
+                catalogs.setdefault(entry["catalog"], None)
+    return list(catalogs)
+
+
+def write_summary(out, counts: dict, cost: dict, starts: dict[str, datetime]) -> None:
+    """Ends a plan with a summary line, which `iter_plan_pages` skips."""
+    summary = {
+        "planned": datetime.now(tz=UTC).isoformat(),
+        "inserts": counts[INSERT],
+        "updates": counts[UPDATE],
+        "up_to_date": counts["up_to_date"],
+        **cost,
+        "starts": {c: start.isoformat() for c, start in starts.items()},
+    }
+    out.write(json.dumps({"summary": summary}) + "\n")
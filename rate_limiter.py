@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """A thread-safe token bucket. Every worker that talks to Knackly draws from the same bucket,
+    so the whole job stays under a single requests-per-second budget no matter how many threads are running.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Args:
+            rate (float): How many tokens (requests) are added to the bucket per second.
+            capacity (float, optional): The most tokens the bucket can hold, which is the largest burst allowed. Defaults to `rate`.
+        """
+        if rate <= 0:
+            raise ValueError(f"rate must be greater than 0. received: {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Blocks until `tokens` tokens are available, and then takes them out of the bucket.
+
+        Args:
+            tokens (float, optional): How many tokens to take. Defaults to 1.0.
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from metadata_store import NO_TIME, knackly_epoch
+
+
+class DetailCache:
+    """A local SQLite cache of record details from Knackly, keyed by (record_id, lastModified).
+
+    Knackly returns the same details for as long as a record's lastModified doesn't change, so a rerun (or a run with an earlier `--date`)
+    can take them from here instead of asking Knackly again. Only the latest version of each record is kept.
+    Entries older than `ttl_seconds` count as misses, and once the cache is bigger than `max_bytes` the least recently used entries are dropped.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, ttl_seconds: float = 7 * 86400):
+        """
+        Args:
+            path (str): The SQLite file to keep the cache in. Created if it doesn't exist.
+            max_bytes (int, optional): How big the (compressed) details may get before the least recently used are dropped. Defaults to 512MB.
+            ttl_seconds (float, optional): How long an entry is trusted for. Defaults to 7 days.
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        # Losing the cache only costs requests, so it doesn't pay for the durability that the event queue needs.
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS details (
+                record_id TEXT PRIMARY KEY,
+                last_modified INTEGER NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS details_accessed ON details (accessed)")
+        self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM details").fetchone()[0]
+
+    def get(self, record_id: str, last_modified: int) -> dict:
+        """The cached details of a record, or None if they aren't cached for this lastModified (in microseconds since the epoch)."""
+        if last_modified == NO_TIME:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT body, stored FROM details WHERE record_id = ? AND last_modified = ?", (record_id, last_modified)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] < now - self.ttl_seconds:
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE details SET accessed = ? WHERE record_id = ?", (now, record_id))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, record_details: dict) -> None:
+        """Caches a record's details under the lastModified that they carry, replacing any older version of the record."""
+        last_modified = knackly_epoch(record_details.get("lastModified"))
+        if last_modified == NO_TIME or "id" not in record_details:
+            return
+        body = zlib.compress(json.dumps(record_details, separators=(",", ":")).encode(), 1)
+        now = time.time()
+        with self.lock:
+            previous = self.db.execute("SELECT size FROM details WHERE record_id = ?", (record_details["id"],)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO details (record_id, last_modified, body, size, stored, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (record_details["id"], last_modified, body, len(body), now, now),
+            )
+            self.size += len(body) - (previous[0] if previous else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drops expired entries, and then the least recently used ones, until the cache is back under 90% of `max_bytes`."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.db.execute("DELETE FROM details WHERE stored < ?", (time.time() - self.ttl_seconds,))
+            self.evicted += cursor.rowcount
+            self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM details").fetchone()[0]
+            target = 0.9 * self.max_bytes
+            if self.size > target:
+                dropped = 0
+                cutoff = None
+                oldest = self.db.execute("SELECT size, accessed FROM details ORDER BY accessed")
+                for size, accessed in oldest:
+                    if self.size - dropped <= target:
+                        break
+                    dropped += size
+                    cutoff = accessed
+                oldest.close()
+                cursor = self.db.execute("DELETE FROM details WHERE accessed <= ?", (cutoff,))
+                self.evicted += cursor.rowcount
+                self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM details").fetchone()[0]
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def stats(self) -> dict:
+        """How the cache has done so far in this run."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size_bytes": self.size,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -16,23 +16,26 @@ set "datetime=%datetime: =0%"
 REM Build log file path
 set "logfile=task_logs\etl_%datetime%.log"
 
+REM Remove the previous run's metrics, so that a crash before they are written doesn't report stale numbers
+if exist metrics.json del metrics.json
+
 REM Run the script using uv
 echo [%date% %time%] Running ETL job... >> "%logfile%"
 echo ------------------------------------------- >> "%logfile%"
-uv run main.py >> "%logfile%" 2>&1
+REM main.py sends its own Teams notification (with the performance table) once it has finished or failed
+uv run main.py --notify-teams --log-file "%cd%\%logfile%" >> "%logfile%" 2>&1
 REM powershell -Command "uv run main.py 2>&1 | Tee-Object -FilePath '%logfile%' -Append"
 echo [%date% %time%] ETL job finished. >> "%logfile%"
 
 REM Store the exit code of the script
 set "exitcode=%errorlevel%"
 
-REM Send message to Teams with status of the run
+REM main.py only writes metrics.json once it got far enough to notify Teams itself. If it didn't, send the failure from here instead.
 if %exitcode% neq 0 (
     echo [%date% %time%] ETL FAILED with exit code %exitcode%. >> "%logfile%"
-    call uv run notify_teams.py "[%date% %time%] ETL FAILED" "The ETL job failed with exit code %exitcode%. Check logs: %cd%\%logfile%" "False"
+    if not exist metrics.json call uv run notify_teams.py "[%date% %time%] ETL FAILED" "The ETL job failed with exit code %exitcode%. Check logs: %cd%\%logfile%" "False"
     echo here >> "%logfile%"
 ) else (
     echo [%date% %time%] ETL job completed successfully. >> "%logfile%"
-    call uv run notify_teams.py "[%date% %time%] ETL Succeeded" "The ETL job completed successfully." "True"
     echo here >> "%logfile%"
 )
\ No newline at end of file
@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+# How long a bearer token is reused for when it doesn't say when it expires.
+DEFAULT_TOKEN_TTL = 30 * 60
+
+# A token is not reused within this many seconds of its own expiry.
+TOKEN_EXPIRY_MARGIN = 5 * 60
+
+
+def cache_key(secret: str) -> bytes:
+    """Derives the cache's Fernet key from the Knackly secret.
+    The secret is a long random API secret, so it doesn't need stretching (which would only slow down every start)."""
+    return base64.urlsafe_b64encode(hmac.digest(secret.encode(), b"startup cache", "sha256"))
+
+
+def token_ttl(token: str) -> float:
+    """How many more seconds a bearer token can be reused for. A JWT is trusted until shortly before its `exp` claim,
+    and anything else for DEFAULT_TOKEN_TTL."""
+    try:
+        payload = token.split(".")[1]
+        expires = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"]
+    except (IndexError, ValueError, KeyError, TypeError):
+        return DEFAULT_TOKEN_TTL
+    return expires - time.time() - TOKEN_EXPIRY_MARGIN
+
+
+class StartupCache:
+    """A small encrypted file of things that every run otherwise has to ask Knackly for before it can start,
+    namely the bearer token and the catalog list. Every entry has its own expiry.
+
+    The file is encrypted and authenticated with Fernet, using a key derived from the Knackly secret, so it is no more sensitive than the
+    .env file that already holds it (file permissions alone don't protect it on Windows).
+    Entries are tied to a scope (the api url and key id), so a cache written for other credentials is ignored.
+    """
+
+    def __init__(self, path: str, secret: str, scope: str):
+        """
+        Args:
+            path (str): The file to keep the cache in. Created on the first write.
+            secret (str): The Knackly secret that the cache's keys are derived from.
+            scope (str): What the cached entries belong to, such as the api url and key id.
+        """
+        self.path = path
+        self.fernet = Fernet(cache_key(secret))
+        self.scope = hashlib.sha256(scope.encode()).hexdigest()
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "rb") as f:
+                data = self.fernet.decrypt(f.read())
+        except (FileNotFoundError, InvalidToken):
+            # A missing cache, one written with another secret, or one that was tampered with are all just empty.
+            return {}
+        contents = json.loads(data)
+        return contents["entries"] if contents.get("scope") == self.scope else {}
+
+    def _save(self) -> None:
+        """Writes the cache next to its final name first and then renames it, so a crash never leaves half of it behind.
+        Each process writes its own temporary file, since distributed workers on the same machine can share the cache."""
+        data = self.fernet.encrypt(json.dumps({"scope": self.scope, "entries": self.entries}).encode())
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self.path)
+
+    def get(self, name: str):
+        """The cached value for `name`, or None if there isn't one or it has expired."""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry["expires"] <= time.time():
+            return None
+        return entry["value"]
+
+    def set(self, name: str, value, ttl_seconds: float) -> None:
+        """Caches a JSON serializable value for `ttl_seconds`, and saves the cache right away."""
+        with self.lock:
+            if ttl_seconds <= 0:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = {"value": value, "expires": time.time() + ttl_seconds}
+            self._save()
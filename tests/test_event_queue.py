@@ -0,0 +1,74 @@
+import pytest
+
+from event_queue import DurableEventQueue
+
+CATALOG = "Catalog000"
+
+
+@pytest.fixture
+def events(tmp_path):
+    queue = DurableEventQueue(path=str(tmp_path / "events.sqlite3"), coalesce_seconds=0, max_delay_seconds=60)
+    yield queue
+    queue.close()
+
+
+def test_events_for_the_same_record_are_coalesced(events):
+    events.put([("a", CATALOG, "2024-07-01T10:00:00.000000Z"), ("b", CATALOG, None)])
+    events.put([("a", CATALOG, "2024-07-01T12:00:00.000000Z"), ("a", CATALOG, "2024-07-01T11:00:00.000000Z"), ("a", CATALOG, None)])
+
+    claimed = {e.record_id: e for e in events.claim(10)}
+    assert sorted(claimed) == ["a", "b"]
+    # The newest lastModified wins, whatever order the events came in.
+    assert (claimed["a"].hits, claimed["a"].last_modified) == (4, "2024-07-01T12:00:00.000000Z")
+    assert (claimed["b"].hits, claimed["b"].last_modified) == (1, None)
+
+
+def test_events_wait_for_the_coalescing_window_but_no_longer_than_the_max_delay(tmp_path):
+    events = DurableEventQueue(path=str(tmp_path / "events.sqlite3"), coalesce_seconds=60, max_delay_seconds=0)
+    try:
+        events.put([("a", CATALOG, None)])
+        assert events.claim(10) == []
+        assert events.depth() == {"waiting": 1, "due": 0, "dead": 0}
+        # A record that keeps getting events is still applied once it has waited max_delay_seconds since its first one.
+        events.put([("a", CATALOG, None)])
+        assert [e.record_id for e in events.claim(10)] == ["a"]
+    finally:
+        events.close()
+
+
+def test_claimed_events_are_leased(events):
+    events.put([("a", CATALOG, None)])
+    assert len(events.claim(10)) == 1
+    assert events.claim(10) == []
+
+
+def test_ack_removes_applied_events(events):
+    events.put([("a", CATALOG, None), ("b", CATALOG, None)])
+    events.ack(events.claim(10))
+    assert events.claim(10) == []
+    assert events.depth() == {"waiting": 0, "due": 0, "dead": 0}
+
+
+def test_an_event_that_arrives_while_applying_isnt_acked_away(events):
+    events.put([("a", CATALOG, "2024-07-01T10:00:00.000000Z")])
+    [applying] = events.claim(10)
+    events.put([("a", CATALOG, "2024-07-01T11:00:00.000000Z")])
+    events.ack([applying])
+
+    # The record is applied again, for the newer event.
+    [again] = events.claim(10)
+    assert again.version > applying.version
+    assert again.last_modified == "2024-07-01T11:00:00.000000Z"
+    events.ack([again])
+    assert events.claim(10) == []
+
+
+def test_events_that_keep_failing_are_set_aside_until_the_next_event(events):
+    events.put([("a", CATALOG, None)])
+    assert events.retry(events.claim(10), "boom", max_attempts=1) == 1
+    assert events.depth() == {"waiting": 0, "due": 0, "dead": 1}
+    assert events.claim(10) == []
+
+    events.put([("a", CATALOG, None)])
+    [revived] = events.claim(10)
+    assert (revived.record_id, revived.attempts) == ("a", 0)
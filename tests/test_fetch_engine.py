@@ -0,0 +1,35 @@
+import queue
+import threading
+from types import SimpleNamespace
+
+from fetch_engine import DetailFetcher
+
+
+class FakeKnackly:
+    def get_record_details(self, record_id: str, catalog: str, last_modified: str = None) -> dict:
+        return {"id": record_id, "catalog": catalog}
+
+
+def jobs(count: int):
+    for i in range(count):
+        yield SimpleNamespace(record_id=f"id-{i}", catalog="Catalog000")
+
+
+def test_every_job_gets_a_result():
+    results = queue.Queue()
+    DetailFetcher(FakeKnackly(), max_workers=3).fetch_into(jobs(20), results)
+    assert sorted(results.get_nowait()[1]["id"] for _ in range(20)) == sorted(f"id-{i}" for i in range(20))
+    assert results.empty()
+
+
+def test_stopping_doesnt_hang_on_results_nobody_takes():
+    # Like the write stage failing: the results queue fills up and is never emptied again.
+    results, stop = queue.Queue(maxsize=1), threading.Event()
+    thread = threading.Thread(target=DetailFetcher(FakeKnackly(), max_workers=4).fetch_into, args=(jobs(1000), results, stop), daemon=True)
+    thread.start()
+    thread.join(timeout=1)
+    assert thread.is_alive()
+
+    stop.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
@@ -0,0 +1,91 @@
+import random
+from collections import Counter
+from datetime import datetime
+
+import mongomock
+import pytest
+
+from fake_knackly import FakeKnackly, make_catalogs
+from full_reconciliation import MISSING, ORPHANED, STALE, external_sort, iter_knackly_ids, iter_mongo_ids, iter_reconciliation_pages, merge_diff
+from knackly_api import KnacklyAPI
+from mongo_db import ensure_indexes
+
+OLD = datetime(2024, 1, 1)
+
+
+def listed(record_id: str, last_modified: str = "2024-06-01T00:00:00.000Z", status: str = "Ok", catalog: str = "Catalog000") -> tuple:
+    """A record as `iter_knackly_ids` yields it."""
+    return (record_id, catalog, last_modified, status, "")
+
+
+def document(record_id: str, internally_modified: datetime = OLD) -> dict:
+    return {"record_id": record_id, "internally_modified": internally_modified}
+
+
+@pytest.mark.parametrize("run_size", [3, 1000])
+def test_external_sort_matches_sorted(tmp_path, run_size):
+    rng = random.Random(0)
+    items = [listed(f"id-{rng.randrange(10**6):07d}") for _ in range(250)]
+    assert list(external_sort(items, run_size=run_size, directory=str(tmp_path))) == sorted(items, key=lambda item: item[0])
+    # The runs that were spilled to disk are cleaned up afterwards.
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_merge_diff_outcomes():
+    knackly = [
+        listed("a"),
+        listed("b", last_modified="2023-12-31T23:00:00.000Z"),
+        listed("c"),
+        listed("c", catalog="Catalog001"),
+        listed("e"),
+    ]
+    mongo = [document("b"), document("c"), document("d"), document("e", internally_modified=datetime(2024, 6, 1))]
+    stats = Counter()
+    differences = list(merge_diff(knackly, mongo, stats))
+    assert differences == [(MISSING, knackly[0]), (STALE, knackly[2]), (ORPHANED, mongo[2])]
+    assert stats == Counter({MISSING: 1, STALE: 1, ORPHANED: 1, "up_to_date": 2, "duplicate": 1})
+
+
+def test_merge_diff_counts_records_that_arent_ok_only_once():
+    knackly = [listed("a", status="Deleted"), listed("b", status="Archived"), listed("c", status="Archived", last_modified="2023-01-01T00:00:00.000Z")]
+    mongo = [document("b"), document("c")]
+    stats = Counter()
+    assert list(iter_reconciliation_pages(merge_diff(knackly, mongo, stats), page_size=10)) == []
+    # A missing or stale record whose status isn't Ok isn't counted as missing or stale as well.
+    assert stats == Counter({"not_ok": 2, "up_to_date": 1})
+
+
+def test_reconciliation_pages_are_grouped_by_catalog():
+    orphans = []
+    differences = [(MISSING, listed(f"id-{i}", catalog=f"Catalog00{i % 2}")) for i in range(5)] + [(ORPHANED, document("zz"))]
+    pages = list(iter_reconciliation_pages(differences, page_size=2, on_orphan=orphans.append))
+    assert [(catalog, [r["id"] for r in records]) for catalog, records in pages] == [
+        ("Catalog000", ["id-0", "id-2"]),
+        ("Catalog001", ["id-1", "id-3"]),
+        ("Catalog000", ["id-4"]),
+    ]
+    assert orphans == [document("zz")]
+
+
+def test_full_diff_against_fake_knackly():
+    catalogs = make_catalogs(3, 20, days=2)
+    records = sorted((r for rs in catalogs.values() for r in rs), key=lambda r: r["id"])
+    col = mongomock.MongoClient().db.real_Records
+    ensure_indexes(col)
+    # The first half is up to date, every fourth of those is stale, and one document no longer has a record.
+    for i, r in enumerate(records[: len(records) // 2]):
+        modified = OLD if i % 4 == 0 else datetime.fromisoformat(r["lastModified"].replace("Z", "+00:00")).replace(tzinfo=None)
+        col.insert_one(document(r["id"], modified))
+    col.insert_one(document("~orphan"))
+
+    fake = FakeKnackly(catalogs)
+    try:
+        knackly = KnacklyAPI(key_id="test", secret="test", tenancy=fake.tenancy, base_url=fake.start(), max_retries=0)
+        stats = Counter()
+        differences = list(merge_diff(external_sort(iter_knackly_ids(knackly, list(catalogs), page_size=7), run_size=16), iter_mongo_ids(col), stats))
+    finally:
+        fake.stop()
+
+    assert stats == Counter({MISSING: 30, STALE: 8, "up_to_date": 22, ORPHANED: 1})
+    assert [item[0] for kind, item in differences if kind == STALE] == [r["id"] for r in records[:30:4]]
+    assert differences[-1] == (ORPHANED, document("~orphan"))
@@ -0,0 +1,104 @@
+from datetime import UTC, datetime, timedelta
+
+import mongomock
+from pymongo.errors import BulkWriteError
+
+from fake_knackly import make_record
+from mongo_db import BulkWriter, ensure_history_indexes, format_document, read_history
+from timeline import rebuild
+
+START = datetime(2024, 7, 1, tzinfo=UTC)
+RECORD_ID = "Catalog000-00000007"
+
+
+def version(v: int) -> dict:
+    record = make_record("Catalog000", 7, START + timedelta(hours=v), version=v + 1)
+    record["data"]["Amount"] += v
+    return record
+
+
+def new_writer(db, **kwargs) -> BulkWriter:
+    ensure_history_indexes(db.history)
+    return BulkWriter(db.real_Records, history_col=db.history, history_for_new_documents=True, bucket_size=2, timeline_format="delta", **kwargs)
+
+
+def update(writer: BulkWriter, document: dict, v: int) -> None:
+    """Queues version `v` against the document as it was read."""
+    writer.update(record_id=RECORD_ID, record_details=version(v), history=document["history"], latest=document["latest"])
+
+
+def stored_versions(db) -> list[dict]:
+    timeline = read_history(db.history, RECORD_ID)
+    return [{k: v for k, v in rebuild(timeline, i).items() if k != "responsible_app"} for i in range(len(timeline))]
+
+
+def setup_record(db, writer: BulkWriter) -> dict:
+    writer.insert(format_document(version(0), "Catalog000"))
+    writer.flush()
+    return db.real_Records.find_one({"record_id": RECORD_ID})
+
+
+def test_a_retry_after_the_main_write_failed_doesnt_duplicate_the_entry(monkeypatch):
+    db = mongomock.MongoClient().db
+    writer = new_writer(db)
+    document = setup_record(db, writer)
+
+    # The history bucket is written, but the write to the main document fails.
+    bulk_write = db.real_Records.bulk_write
+
+    def failing_bulk_write(operations, ordered=True):
+        monkeypatch.setattr(db.real_Records, "bulk_write", bulk_write)
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 91, "errmsg": "shutdown in progress"}], "nMatched": 0})
+
+    monkeypatch.setattr(db.real_Records, "bulk_write", failing_bulk_write)
+    update(writer, document, 1)
+    writer.flush()
+    assert [record_id for record_id, _ in writer.errors] == [RECORD_ID]
+    assert db.real_Records.find_one({"record_id": RECORD_ID})["history"]["entries"] == 1
+
+    # The record stays pending, and the retry reads the same document as before.
+    writer.errors.clear()
+    update(writer, db.real_Records.find_one({"record_id": RECORD_ID}), 1)
+    writer.flush()
+    assert writer.errors == []
+    assert db.real_Records.find_one({"record_id": RECORD_ID})["history"]["entries"] == 2
+    assert stored_versions(db) == [version(0), version(1)]
+
+
+def test_concurrent_writers_at_the_same_position_conflict():
+    db = mongomock.MongoClient().db
+    first, second = new_writer(db), new_writer(db)
+    document = setup_record(db, first)
+
+    update(first, document, 1)
+    update(second, document, 2)
+    first.flush()
+    second.flush()
+
+    assert first.errors == []
+    assert [record_id for record_id, _ in second.errors] == [RECORD_ID]
+    assert "changed since it was read" in str(second.errors[0][1])
+    assert stored_versions(db) == [version(0), version(1)]
+
+    # Tried again against the document as it is now, the second version goes after the first.
+    second.errors.clear()
+    update(second, db.real_Records.find_one({"record_id": RECORD_ID}), 2)
+    second.flush()
+    assert second.errors == []
+    assert stored_versions(db) == [version(0), version(1), version(2)]
+    # The third entry starts a new bucket.
+    assert db.history.count_documents({"record_id": RECORD_ID}) == 2
+
+
+def test_the_same_version_written_twice_isnt_a_conflict():
+    db = mongomock.MongoClient().db
+    first, second = new_writer(db), new_writer(db)
+    document = setup_record(db, first)
+
+    update(first, document, 1)
+    update(second, document, 1)
+    first.flush()
+    second.flush()
+
+    assert first.errors == second.errors == []
+    assert stored_versions(db) == [version(0), version(1)]
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+import ingest_daemon
+from event_queue import DurableEventQueue
+from ingest_daemon import is_loopback, make_handler, parse_webhook_events
+
+SECRET = "s3cret"
+MAX_BODY_BYTES = 200
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A webhook server on a free local port, and the queue its events go to."""
+    events = DurableEventQueue(path=str(tmp_path / "events.sqlite3"), coalesce_seconds=0)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(events, "/webhook", SECRET, logging.getLogger(__name__), max_body_bytes=MAX_BODY_BYTES))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/webhook", events
+    httpd.shutdown()
+    httpd.server_close()
+    events.close()
+
+
+def test_events_with_the_secret_are_queued(server):
+    url, events = server
+    response = requests.post(url, json=[{"id": "a", "catalog": "Catalog000"}, {"recordId": "b", "catalogName": "Catalog001"}], headers={"X-Webhook-Secret": SECRET})
+    assert (response.status_code, response.json()) == (202, {"queued": 2})
+    assert sorted((e.record_id, e.catalog) for e in events.claim(10)) == [("a", "Catalog000"), ("b", "Catalog001")]
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Webhook-Secret": "wrong"}])
+def test_events_without_the_secret_are_rejected(server, headers):
+    url, events = server
+    response = requests.post(url, json={"id": "a", "catalog": "Catalog000"}, headers=headers)
+    assert response.status_code == 401
+    assert events.depth()["waiting"] == 0
+
+
+def test_bodies_over_the_limit_are_rejected(server):
+    url, events = server
+    body = [{"id": f"record-{i}", "catalog": "Catalog000"} for i in range(10)]
+    response = requests.post(url, json=body, headers={"X-Webhook-Secret": SECRET})
+    assert response.status_code == 413
+    assert events.depth()["waiting"] == 0
+
+
+def test_malformed_events_are_rejected(server):
+    url, events = server
+    response = requests.post(url, json={"id": "a"}, headers={"X-Webhook-Secret": SECRET})
+    assert response.status_code == 400
+    assert events.depth()["waiting"] == 0
+
+
+def test_parse_webhook_events_normalizes_last_modified():
+    assert parse_webhook_events({"record_id": 7, "catalog": "Catalog000", "lastModified": "2024-07-01T12:00:00+02:00"}) == [
+        ("7", "Catalog000", "2024-07-01T10:00:00.000000Z")
+    ]
+
+
+@pytest.mark.parametrize(("host", "loopback"), [("127.0.0.1", True), ("::1", True), ("localhost", True), ("0.0.0.0", False), ("10.0.0.5", False), ("example.com", False)])
+def test_is_loopback(host, loopback):
+    assert is_loopback(host) is loopback
+
+
+def test_the_daemon_wont_listen_publicly_without_a_secret(monkeypatch):
+    monkeypatch.delenv("WEBHOOK_SECRET", raising=False)
+    monkeypatch.setattr(ingest_daemon, "load_dotenv", lambda: None)
+    monkeypatch.setattr(ingest_daemon, "initialize_logger", lambda: logging.getLogger(__name__))
+    with pytest.raises(SystemExit, match="WEBHOOK_SECRET"):
+        ingest_daemon.main(argparse.Namespace(host="0.0.0.0"))
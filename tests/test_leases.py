@@ -0,0 +1,50 @@
+import logging
+from datetime import timedelta
+
+import mongomock
+
+from leases import CatalogLeases, merge_summaries
+from main import reconcile_leased_catalogs
+
+COUNTS = ("new", "inserted", "matching", "modified", "unchanged", "bytes_avoided", "deleted", "failed")
+
+
+class FakePipeline:
+    """Stands in for `ReconciliationPipeline`, and only remembers which catalogs it was run on."""
+
+    runs = []
+
+    def run(self, catalogs: list[str], writer) -> None:
+        self.runs.extend(catalogs)
+
+    def counts(self) -> dict[str, int]:
+        return dict.fromkeys(COUNTS, 0) | {"new": 1}
+
+
+class FakeWriter:
+    errors = []
+
+
+class FakeTracker:
+    def save(self) -> None:
+        pass
+
+
+def test_a_dead_workers_catalog_is_taken_over_once_its_lease_runs_out():
+    col = mongomock.MongoClient().db.double_checker_leases
+    lease_duration = timedelta(seconds=0.6)
+    dead = CatalogLeases(col, "run-1", "dead", lease_duration)
+    dead.register(["Catalog000", "Catalog001"])
+    # This worker claims a catalog and is never heard from again.
+    assert dead.acquire() == "Catalog000"
+
+    FakePipeline.runs = []
+    live = CatalogLeases(col, "run-1", "live", lease_duration)
+    totals = reconcile_leased_catalogs(live, ["Catalog000", "Catalog001"], FakePipeline, FakeWriter(), FakeTracker(), logging.getLogger(__name__))
+
+    assert sorted(FakePipeline.runs) == ["Catalog000", "Catalog001"]
+    assert totals["new"] == 2
+    lease = col.find_one({"catalog": "Catalog000", "kind": "lease"})
+    assert (lease["status"], lease["owner"], lease["attempts"]) == ("done", "live", 2)
+    summary = merge_summaries(col, "run-1")
+    assert summary["outstanding"] == [] and summary["catalogs"] == 2
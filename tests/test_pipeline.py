@@ -0,0 +1,62 @@
+import argparse
+import logging
+from datetime import UTC, datetime, timedelta
+
+import mongomock
+import pytest
+
+from fake_knackly import make_record
+from mongo_db import BulkWriter
+from pipeline import ReconciliationPipeline
+
+START = datetime(2024, 7, 1, tzinfo=UTC)
+CATALOG = "Catalog000"
+
+
+class FakeKnackly:
+    """Hands out the details of the given records, which can differ from what was listed."""
+
+    def __init__(self, details: dict[str, dict]):
+        self.details = details
+
+    def get_record_details(self, record_id: str, catalog: str, last_modified: str = None) -> dict:
+        return self.details[record_id]
+
+
+def make_args() -> argparse.Namespace:
+    return argparse.Namespace(
+        timeline_format="full", snapshot_interval=10, date="2024-06-01T00:00", queue_depth=10, page_size=100, workers=2, mongo_chunk_size=100
+    )
+
+
+def run(records: list[dict], details: dict[str, dict], writer: BulkWriter) -> ReconciliationPipeline:
+    pipeline = ReconciliationPipeline(FakeKnackly(details), writer.col, make_args(), logging.getLogger(__name__))
+    pipeline.run([CATALOG], writer, pages=[(CATALOG, records)], show_progress=False)
+    return pipeline
+
+
+def test_a_record_that_cant_be_formatted_fails_on_its_own():
+    records = [make_record(CATALOG, i, START + timedelta(hours=i)) for i in range(3)]
+    details = {r["id"]: r for r in records}
+    details[records[1]["id"]] = {k: v for k, v in records[1].items() if k != "apps"}
+    writer = BulkWriter(mongomock.MongoClient().db.real_Records)
+
+    pipeline = run(records, details, writer)
+    writer.flush()
+
+    assert [record_id for record_id, _ in pipeline.errors] == [records[1]["id"]]
+    assert isinstance(pipeline.errors[0][1], KeyError)
+    assert sorted(d["record_id"] for d in writer.col.find()) == sorted([records[0]["id"], records[2]["id"]])
+
+
+def test_an_error_from_a_flush_stops_the_pipeline():
+    records = [make_record(CATALOG, i, START + timedelta(hours=i)) for i in range(3)]
+
+    def on_commit(record_ids: list[str]) -> None:
+        # Looks like a formatting error, but comes from the write, so it must not be blamed on whichever record was queued last.
+        raise KeyError("watermark")
+
+    # Every insert is due right away, so the flush happens while the pipeline is writing.
+    writer = BulkWriter(mongomock.MongoClient().db.real_Records, batch_size=1, on_commit=on_commit)
+    with pytest.raises(KeyError, match="watermark"):
+        run(records, {r["id"]: r for r in records}, writer)
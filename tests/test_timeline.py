@@ -0,0 +1,97 @@
+import copy
+from datetime import UTC, datetime, timedelta
+
+import mongomock
+import pytest
+
+from fake_knackly import make_record
+from mongo_db import BulkWriter, find_timeline_tails, format_document
+from timeline import DELTA, SNAPSHOT, encode_entry, encode_entry_at, encode_timeline, is_snapshot, iter_versions, rebuild
+
+START = datetime(2024, 7, 1, tzinfo=UTC)
+
+
+def make_versions(count: int, index: int = 7) -> list[dict]:
+    """Successive versions of one record, with changed, nested, added and removed fields along the way."""
+    versions = []
+    for v in range(count):
+        record = make_record("Catalog000", index, START + timedelta(hours=v), version=v + 1)
+        record["data"]["Amount"] += v
+        record["data"]["Parties"]["Lender"] = f"Lender {v % 3}"
+        if v % 2:
+            record["data"]["Notes"] = f"note {v}"
+        if v % 4 == 3:
+            del record["data"]["isTestFile"]
+        versions.append(record)
+    return versions
+
+
+def append_all(timeline: list[dict], versions: list[dict], snapshot_interval: int) -> list[dict]:
+    """Appends each version the way an update does, encoding it against the last `snapshot_interval` entries."""
+    timeline = list(timeline)
+    for version in versions:
+        timeline.append(encode_entry(timeline[-snapshot_interval:], copy.deepcopy(version), snapshot_interval))
+    return timeline
+
+
+@pytest.mark.parametrize("snapshot_interval", [1, 3, 10])
+def test_encode_entry_round_trip(snapshot_interval):
+    versions = make_versions(12)
+    timeline = append_all([], versions, snapshot_interval)
+    assert [rebuild(timeline, i) for i in range(len(versions))] == versions
+    assert list(iter_versions(timeline)) == versions
+
+
+@pytest.mark.parametrize("snapshot_interval", [1, 3, 10])
+def test_encode_timeline_round_trip(snapshot_interval):
+    versions = make_versions(12)
+    encoded = encode_timeline(versions, snapshot_interval)
+    assert len(encoded) == len(versions)
+    assert [rebuild(encoded, i) for i in range(len(versions))] == versions
+    # An already delta encoded timeline can be re-encoded too.
+    assert list(iter_versions(encode_timeline(encoded, snapshot_interval))) == versions
+
+
+def test_mixed_legacy_and_delta_tail():
+    versions = make_versions(9)
+    legacy = copy.deepcopy(versions[:3])
+    timeline = append_all(legacy, versions[3:], snapshot_interval=4)
+    # Legacy entries are read as snapshots, so the new entries start out as deltas against the last of them.
+    assert [entry.get("_kind") for entry in timeline] == [None, None, None, DELTA, DELTA, DELTA, SNAPSHOT, DELTA, DELTA]
+    assert [rebuild(timeline, i) for i in range(len(versions))] == versions
+    assert [rebuild(encode_timeline(timeline, 4), i) for i in range(len(versions))] == versions
+
+
+def test_tail_without_a_snapshot_cant_be_rebuilt():
+    timeline = append_all([], make_versions(3), snapshot_interval=10)
+    with pytest.raises(ValueError):
+        rebuild(timeline[1:])
+
+
+@pytest.mark.parametrize("snapshot_interval", [1, 2, 5])
+def test_snapshots_fall_on_interval_boundaries(snapshot_interval):
+    versions = make_versions(11)
+    expected = [i % snapshot_interval == 0 for i in range(len(versions))]
+    assert [is_snapshot(entry) for entry in append_all([], versions, snapshot_interval)] == expected
+    assert [is_snapshot(entry) for entry in encode_timeline(versions, snapshot_interval)] == expected
+    entries = [encode_entry_at(versions[i - 1] if i else None, versions[i], i, snapshot_interval) for i in range(len(versions))]
+    assert [is_snapshot(entry) for entry in entries] == expected
+
+
+def test_bulk_writer_delta_updates_round_trip():
+    col = mongomock.MongoClient().db.real_Records
+    versions = make_versions(8)
+    writer = BulkWriter(col, snapshot_interval=3, timeline_format="delta")
+    writer.insert(format_document(copy.deepcopy(versions[0]), "Catalog000", timeline_format="delta"))
+    writer.flush()
+    for version in versions[1:]:
+        record_id = version["id"]
+        tail = find_timeline_tails(col, [record_id], count=3)[record_id]
+        writer.update(record_id=record_id, record_details=copy.deepcopy(version), timeline_tail=tail)
+        writer.flush()
+
+    assert writer.errors == []
+    timeline = col.find_one({"record_id": versions[0]["id"]})["timeline"]
+    assert [is_snapshot(entry) for entry in timeline] == [i % 3 == 0 for i in range(len(versions))]
+    # Updates add which app is responsible to the stored record.
+    assert [{k: v for k, v in rebuild(timeline, i).items() if k != "responsible_app"} for i in range(len(versions))] == versions
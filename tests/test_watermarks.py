@@ -0,0 +1,83 @@
+from datetime import UTC, datetime, timedelta
+
+import mongomock
+
+from fake_knackly import knackly_time, make_record
+from metadata_store import CatalogTable, MetadataPage
+from watermarks import WATERMARK_OVERLAP, WatermarkTracker
+
+CATALOG = "Catalog000"
+LISTED_THROUGH = datetime(2024, 7, 2, tzinfo=UTC)
+
+
+def listed_page(*times: datetime) -> MetadataPage:
+    """A page with one record per time, with ids in the same order."""
+    return MetadataPage(CatalogTable().intern(CATALOG), [make_record(CATALOG, i, t) for i, t in enumerate(times)])
+
+
+def new_tracker() -> WatermarkTracker:
+    return WatermarkTracker(col=mongomock.MongoClient().db.double_checker_state)
+
+
+def test_nothing_is_committable_before_the_listing_is_done():
+    tracker = new_tracker()
+    tracker.listed(CATALOG, listed_page(datetime(2024, 7, 1, tzinfo=UTC)))
+    assert tracker.committable(CATALOG) is None
+
+
+def test_committable_stops_at_the_oldest_pending_record():
+    tracker = new_tracker()
+    page = listed_page(datetime(2024, 7, 1, 12, 30, 45, tzinfo=UTC), datetime(2024, 7, 1, 9, 15, 5, tzinfo=UTC), datetime(2024, 7, 1, 18, tzinfo=UTC))
+    tracker.listed(CATALOG, page)
+    tracker.listed_up_to(CATALOG, LISTED_THROUGH)
+    # Rounded down to the minute, since that is all the lastmod filter understands.
+    assert tracker.committable(CATALOG) == datetime(2024, 7, 1, 9, 15, tzinfo=UTC)
+
+    tracker.done([page.ids[1]])
+    assert tracker.committable(CATALOG) == datetime(2024, 7, 1, 12, 30, tzinfo=UTC)
+    tracker.done([page.ids[0], page.ids[2]])
+    assert tracker.committable(CATALOG) == LISTED_THROUGH
+
+
+def test_records_without_last_modified_dont_hold_the_watermark_back():
+    tracker = new_tracker()
+    record = make_record(CATALOG, 0, datetime(2024, 7, 1, tzinfo=UTC))
+    del record["lastModified"]
+    tracker.listed(CATALOG, MetadataPage(0, [record]))
+    tracker.listed_up_to(CATALOG, LISTED_THROUGH)
+    assert tracker.committable(CATALOG) == LISTED_THROUGH
+
+
+def test_other_catalogs_dont_hold_the_watermark_back():
+    tracker = new_tracker()
+    tracker.listed("Catalog001", listed_page(datetime(2024, 6, 1, tzinfo=UTC)))
+    tracker.listed_up_to(CATALOG, LISTED_THROUGH)
+    assert tracker.committable(CATALOG) == LISTED_THROUGH
+
+
+def test_saved_watermarks_only_move_forward():
+    tracker = new_tracker()
+    page = listed_page(datetime(2024, 7, 1, 6, tzinfo=UTC))
+    tracker.listed(CATALOG, page)
+    tracker.listed_up_to(CATALOG, LISTED_THROUGH)
+    tracker.done(page.ids)
+    tracker.save()
+
+    # A later run that only listed up to an earlier time (an explicit --date, say) doesn't move the stored watermark back.
+    other = WatermarkTracker(col=tracker.col)
+    other.listed_up_to(CATALOG, LISTED_THROUGH - timedelta(days=1))
+    other.save()
+    default_start = datetime(2024, 1, 1, tzinfo=UTC)
+    assert WatermarkTracker(col=tracker.col).load([CATALOG, "Catalog001"], default_start) == {
+        CATALOG: LISTED_THROUGH - WATERMARK_OVERLAP,
+        "Catalog001": default_start,
+    }
+
+
+def test_knackly_time_round_trips_through_the_page():
+    # The tracker keys pending records by the listed lastModified, so it has to survive the page's pre-parsing unchanged.
+    when = datetime(2024, 7, 1, 8, 5, 30, 123000, tzinfo=UTC)
+    tracker = new_tracker()
+    tracker.listed(CATALOG, MetadataPage(0, [{"id": "a", "lastModified": knackly_time(when)}]))
+    tracker.listed_up_to(CATALOG, LISTED_THROUGH)
+    assert tracker.committable(CATALOG) == when.replace(second=0, microsecond=0)
@@ -0,0 +1,172 @@
+import copy
+
+# Timeline entries written in the delta format are tagged with one of these kinds.
+# Entries without a kind are full Knackly records written in the original format, and are read as snapshots.
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+
+def diff(old: dict, new: dict, path: list = None) -> list[dict]:
+    """Produces the field-level changes that turn `old` into `new`. Nested dictionaries are compared key by key,
+    while anything else (including lists) is replaced as a whole when it differs.
+
+    Args:
+        old (dict): The previous version of the record.
+        new (dict): The next version of the record.
+        path (list, optional): The keys leading to `old` and `new` within the whole record. Defaults to None.
+
+    Returns:
+        list[dict]: A list of changes, each either {"path": [...], "value": ...} or {"path": [...], "unset": True}.
+            Paths are lists of keys rather than dotted strings, because Knackly field names can contain dots.
+    """
+    path = path or []
+    changes = []
+    for key, value in new.items():
+        if key not in old:
+            changes.append({"path": path + [key], "value": value})
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changes.extend(diff(old[key], value, path + [key]))
+        elif value != old[key]:
+            changes.append({"path": path + [key], "value": value})
+    for key in old:
+        if key not in new:
+            changes.append({"path": path + [key], "unset": True})
+    return changes
+
+
+def apply(record: dict, changes: list[dict]) -> dict:
+    """Applies the output of `diff` to a record.
+
+    Args:
+        record (dict): The version of the record that the changes were made against. It is not modified.
+        changes (list[dict]): The changes to apply.
+
+    Returns:
+        dict: The next version of the record.
+    """
+    record = copy.deepcopy(record)
+    for change in changes:
+        *parents, key = change["path"]
+        target = record
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        if change.get("unset"):
+            target.pop(key, None)
+        else:
+            target[key] = copy.deepcopy(change["value"])
+    return record
+
+
+def is_snapshot(entry: dict) -> bool:
+    return entry.get("_kind") != DELTA
+
+
+def snapshot_record(entry: dict) -> dict:
+    """Returns the full record held by a snapshot entry (or by an entry in the original, full-copy format)."""
+    return entry["record"] if entry.get("_kind") == SNAPSHOT else entry
+
+
+def encode_entry(tail: list[dict], record_details: dict, snapshot_interval: int) -> dict:
+    """Encodes the next timeline entry for a record, given the end of its current timeline.
+
+    A full snapshot is written when the timeline is empty, or when `snapshot_interval - 1` deltas already follow the latest snapshot.
+    Otherwise only the field-level changes since the latest version are stored.
+
+    Args:
+        tail (list[dict]): The last entries of the timeline. Must include the latest snapshot, which the last `snapshot_interval` entries always do.
+        record_details (dict): The new version of the record.
+        snapshot_interval (int): How many entries there are per full snapshot.
+
+    Returns:
+        dict: The entry to push onto the timeline.
+    """
+    if not tail:
+        return {"_kind": SNAPSHOT, "record": record_details}
+
+    deltas_since_snapshot = 0
+    for entry in reversed(tail):
+        if is_snapshot(entry):
+            break
+        deltas_since_snapshot += 1
+    if deltas_since_snapshot + 1 >= snapshot_interval:
+        return {"_kind": SNAPSHOT, "record": record_details}
+    return {"_kind": DELTA, "changes": diff(rebuild(tail), record_details)}
+
+
+def encode_entry_at(previous: dict, record_details: dict, position: int, snapshot_interval: int) -> dict:
+    """Encodes the timeline entry at a known position, for timelines whose length is tracked separately (such as bucketed history).
+    Every `snapshot_interval`th entry is a full snapshot, and the rest are diffs against the previous version.
+
+    Args:
+        previous (dict): The previous full version of the record, or None if there isn't one.
+        record_details (dict): The new version of the record.
+        position (int): The index that the new entry will have in the timeline.
+        snapshot_interval (int): How many entries there are per full snapshot.
+
+    Returns:
+        dict: The entry to store.
+    """
+    if previous is None or position % snapshot_interval == 0:
+        return {"_kind": SNAPSHOT, "record": record_details}
+    return {"_kind": DELTA, "changes": diff(previous, record_details)}
+
+
+def iter_versions(timeline: list[dict]):
+    """Yields every full version of a record, oldest first, from a timeline in either format (or a mix of both)."""
+    current = None
+    for entry in timeline:
+        if is_snapshot(entry):
+            current = snapshot_record(entry)
+        elif current is None:
+            raise ValueError("timeline starts with a delta entry, so it can't be rebuilt")
+        else:
+            current = apply(current, entry["changes"])
+        yield current
+
+
+def rebuild(timeline: list[dict], version: int = -1) -> dict:
+    """Rebuilds one version of a record from its timeline, starting at the nearest snapshot before it.
+
+    Args:
+        timeline (list[dict]): The timeline entries, in either format (or a mix of both).
+        version (int, optional): The index of the version to rebuild. Negative indexes count from the end. Defaults to -1, the latest version.
+
+    Returns:
+        dict: The full record as it was at that version.
+    """
+    if version < 0:
+        version += len(timeline)
+    if not 0 <= version < len(timeline):
+        raise IndexError(f"version {version} is out of range for a timeline with {len(timeline)} entries")
+
+    start = version
+    while not is_snapshot(timeline[start]):
+        start -= 1
+        if start < 0:
+            raise ValueError("timeline starts with a delta entry, so it can't be rebuilt")
+
+    record = snapshot_record(timeline[start])
+    for entry in timeline[start + 1 : version + 1]:
+        record = apply(record, entry["changes"])
+    return record
+
+
+def encode_timeline(timeline: list[dict], snapshot_interval: int) -> list[dict]:
+    """Re-encodes an entire timeline (in either format, or a mix of both) into the delta format.
+
+    Args:
+        timeline (list[dict]): The existing timeline entries.
+        snapshot_interval (int): How many entries there are per full snapshot.
+
+    Returns:
+        list[dict]: The delta encoded timeline, with one entry per version.
+    """
+    encoded = []
+    previous = None
+    for i, version in enumerate(iter_versions(timeline)):
+        if i % snapshot_interval == 0:
+            encoded.append({"_kind": SNAPSHOT, "record": version})
+        else:
+            encoded.append({"_kind": DELTA, "changes": diff(previous, version)})
+        previous = version
+    return encoded
@@ -0,0 +1,108 @@
+import threading
+from collections import defaultdict
+from datetime import UTC, datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+from metadata_store import NO_TIME, MetadataPage, from_epoch
+
+# The collection that holds the job's own bookkeeping, such as watermarks.
+STATE_COLLECTION = "double_checker_state"
+
+# Each run starts this far before a catalog's stored watermark, in case Knackly stamps a lastModified slightly in the past.
+# Records in the overlap were already written, so the staleness check skips them without fetching their details again.
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+
+def watermark_key(catalog: str) -> str:
+    return f"watermark:{catalog}"
+
+
+class WatermarkTracker:
+    """Keeps a per-catalog high-water mark of the lastModified time that every listed record has been committed up to.
+
+    A catalog's watermark only moves past a time once (1) the listing has covered everything modified before it, and
+    (2) every listed record modified before it has either been written to MongoDB or found to be up to date.
+    It is saved to a small state collection after every batch that is written, so the next run (or a rerun after a crash)
+    starts from where this one actually got to, instead of re-listing or leaving a gap.
+    """
+
+    def __init__(self, col: Collection):
+        """
+        Args:
+            col (Collection): The pymongo collection that holds the job's state documents.
+        """
+        self.col = col
+        self.lock = threading.Lock()
+        # catalog -> {record_id: lastModified as microseconds since the epoch} for every listed record that hasn't been committed yet.
+        self.pending = defaultdict(dict)
+        self.catalog_of = {}
+        # catalog -> the time that the listing has covered everything before
+        self.listed_through = {}
+        self.saved = {}
+
+    def load(self, catalogs: list[str], default_start: datetime) -> dict[str, datetime]:
+        """Works out where each catalog's listing should start.
+
+        Args:
+            catalogs (list[str]): The names of the catalogs that will be listed.
+            default_start (datetime): Where to start a catalog that doesn't have a watermark yet.
+
+        Returns:
+            dict[str, datetime]: A mapping of catalog name to the (timezone aware) time its listing should start at.
+        """
+        stored = self.col.find({"_id": {"$in": [watermark_key(c) for c in catalogs]}}, projection={"catalog": 1, "watermark": 1})
+        watermarks = {d["catalog"]: d["watermark"].replace(tzinfo=UTC) for d in stored}
+        self.saved.update(watermarks)
+        return {c: (watermarks[c] - WATERMARK_OVERLAP) if c in watermarks else default_start for c in catalogs}
+
+    def listed(self, catalog: str, page: MetadataPage) -> None:
+        """Registers a page of listed records that now have to be committed before the watermark can pass them."""
+        with self.lock:
+            for record_id, last_modified in zip(page.ids, page.last_modified):
+                if last_modified != NO_TIME:
+                    self.pending[catalog][record_id] = last_modified
+                    self.catalog_of[record_id] = catalog
+
+    def listed_up_to(self, catalog: str, time: datetime) -> None:
+        """Records that every record in a catalog modified before `time` has been listed (and registered)."""
+        with self.lock:
+            self.listed_through[catalog] = time
+
+    def done(self, record_ids: list[str]) -> None:
+        """Marks records as committed, either because they were written or because they were already up to date."""
+        with self.lock:
+            for record_id in record_ids:
+                catalog = self.catalog_of.pop(record_id, None)
+                if catalog is not None:
+                    self.pending[catalog].pop(record_id, None)
+
+    def committable(self, catalog: str) -> datetime:
+        """The furthest a catalog's watermark can safely move right now, or None if it can't move at all yet."""
+        with self.lock:
+            watermark = self.listed_through.get(catalog)
+            if watermark is None:
+                return None
+            if self.pending[catalog]:
+                watermark = min(watermark, from_epoch(min(self.pending[catalog].values())).replace(second=0, microsecond=0))
+            return watermark
+
+    def save(self) -> None:
+        """Writes every watermark that has moved forward since it was last saved. Watermarks in MongoDB never move backwards."""
+        now = datetime.now(tz=UTC)
+        operations = []
+        for catalog in list(self.listed_through):
+            watermark = self.committable(catalog)
+            if watermark is None or (catalog in self.saved and watermark <= self.saved[catalog]):
+                continue
+            self.saved[catalog] = watermark
+            operations.append(
+                UpdateOne(
+                    {"_id": watermark_key(catalog)},
+                    {"$max": {"watermark": watermark}, "$set": {"catalog": catalog, "updated": now}},
+                    upsert=True,
+                )
+            )
+        if operations:
+            self.col.bulk_write(operations, ordered=False)
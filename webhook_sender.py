@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import random
+import time
+from datetime import UTC, datetime
+
+import requests
+from dotenv import load_dotenv
+
+
+def parse_arguments() -> argparse.Namespace:
+    """Helper function to parse command line arguments cleanly
+
+    Returns:
+        argparse.Namespace: Namespace object containing the sender settings
+    """
+    parser = argparse.ArgumentParser(description="A local stand-in for Knackly's webhooks: POSTs record events to ingest_daemon.py.")
+    parser.add_argument("--url", default="http://localhost:8080/webhook", help="where to POST the events. Defaults to http://localhost:8080/webhook")
+    parser.add_argument("--catalog", default="TestCatalog", help="the catalog that the records are in. Defaults to TestCatalog")
+    parser.add_argument("--ids", nargs="*", help="the record ids to send events for. Defaults to --records made up ids")
+    parser.add_argument("--records", type=int, default=10, help="how many made up record ids to use without --ids. Defaults to 10")
+    parser.add_argument("--events", type=int, default=100, help="how many events to send, spread randomly over the records. Defaults to 100")
+    parser.add_argument("--rate", type=float, default=20, help="how many events to send per second. Defaults to 20")
+    args = parser.parse_args()
+    if args.records < 1 or args.events < 1 or args.rate <= 0:
+        parser.error("--records and --events must be at least 1, and --rate must be greater than 0")
+    return args
+
+
+def send_events(url: str, catalog: str, record_ids: list[str], count: int, rate: float, secret: str = None) -> dict:
+    """Sends `count` events for random records from `record_ids`, so that repeat events for the same record get coalesced.
+
+    Returns:
+        dict: The response status codes, and how many times each.
+    """
+    session = requests.Session()
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Webhook-Secret"] = secret
+    statuses = {}
+    for _ in range(count):
+        event = {"id": random.choice(record_ids), "catalog": catalog, "lastModified": datetime.now(tz=UTC).isoformat().replace("+00:00", "Z")}
+        response = session.post(url, data=json.dumps(event), headers=headers)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        time.sleep(1 / rate)
+    return statuses
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    args = parse_arguments()
+    record_ids = args.ids or [f"record-{i}" for i in range(args.records)]
+    statuses = send_events(args.url, args.catalog, record_ids, args.events, args.rate, os.getenv("WEBHOOK_SECRET"))
+    print(f"Sent {args.events} events for {len(record_ids)} records. Responses: {statuses}")